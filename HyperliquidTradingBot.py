@@ -1,5 +1,5 @@
 import tkinter as tk
-from tkinter import ttk, scrolledtext, filedialog, messagebox
+from tkinter import ttk, filedialog, messagebox, font as tkfont
 import threading
 import time
 import json
@@ -8,11 +8,2609 @@ import random
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
-from collections import defaultdict
+from numpy.lib.stride_tricks import sliding_window_view
+from collections import defaultdict, namedtuple, deque
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
+import zlib
+import struct
 import logging
+import logging.handlers
+import queue
+import gzip
+import shutil
+import atexit
+import re
 import sys
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import argparse
+import itertools
+import asyncio
+import http.server
+
+
+class HttpClient:
+    """共享HTTP客户端：连接池复用 + keep-alive + 统一超时与重试退避"""
+
+    def __init__(self, timeout=10, retries=2, backoff=0.5, pool_size=10):
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),  # 418为币安封禁，不重试
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        # pool_block=True：每个主机最多 pool_size 个并发连接
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+
+    def get(self, url, params=None, timeout=None):
+        return self.session.get(url, params=params, timeout=timeout or self.timeout)
+
+    def close(self):
+        self.session.close()
+
+
+BINANCE_API_URL = "https://api.binance.com/api/v3"
+
+
+def binance_kline_params(symbol, interval, limit, start_time=None):
+    """构造币安 /klines 请求参数"""
+    params = {
+        'symbol': f"{symbol.upper()}USDT",
+        'interval': interval,
+        'limit': limit
+    }
+    if start_time is not None:
+        params['startTime'] = start_time
+    return params
+
+
+def binance_ticker_to_price(symbol, data):
+    """把币安 24hr ticker 转为统一的价格数据格式"""
+    return {
+        'symbol': symbol,
+        'price': float(data['lastPrice']),
+        'change_24h': float(data['priceChangePercent']),
+        'high_24h': float(data['highPrice']),
+        'low_24h': float(data['lowPrice']),
+        'volume': float(data['volume']),
+        'timestamp': time.time(),
+        'source': 'Binance'
+    }
+
+
+class MarketDataEngine:
+    """asyncio行情引擎：在一个事件循环线程中并发拉取K线、24hr行情、all_mids、user_state
+
+    交易线程通过同步门面方法调用；安装了 aiohttp 时使用异步HTTP，
+    否则退回到共享 HttpClient（在默认执行器中运行）。
+    """
+
+    def __init__(self, http_client, max_concurrency=20, retries=2, backoff=0.5):
+        self.http = http_client
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self._aiohttp = None
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.metrics = None  # 可选 LatencyRecorder，记录K线/行情请求耗时
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            try:
+                import aiohttp
+                self._aiohttp = aiohttp
+            except ImportError:
+                self._aiohttp = None
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name="market-data", daemon=True)
+            self._thread.start()
+            self.run(self._open())
+
+    async def _open(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._aiohttp is not None:
+            connector = self._aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=10, keepalive_timeout=30)
+            self._session = self._aiohttp.ClientSession(
+                connector=connector, timeout=self._aiohttp.ClientTimeout(total=self.http.timeout)
+            )
+
+    def run(self, coro, timeout=60):
+        """在引擎事件循环中执行协程并等待结果"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def stop(self):
+        if self._loop is None:
+            return
+        if self._session is not None:
+            self.run(self._session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop = None
+        self._session = None
+
+    async def _get_json(self, url, params=None, metric=None):
+        """GET请求并解析JSON，失败返回None；指定 metric 时记录耗时"""
+        start = time.perf_counter()
+        result = None
+        try:
+            result = await self._fetch_json(url, params)
+            return result
+        finally:
+            if self.metrics is not None and metric:
+                self.metrics.observe(metric, time.perf_counter() - start, error=result is None)
+
+    async def _fetch_json(self, url, params=None):
+        """GET请求并解析JSON，失败返回None（429/5xx按指数退避重试）"""
+        async with self._semaphore:
+            if self._session is None:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(None, lambda: self.http.get(url, params=params))
+                return response.json() if response.status_code == 200 else None
+
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self._session.get(url, params=params) as response:
+                        if response.status == 200:
+                            return await response.json()
+                        if response.status not in (429, 500, 502, 503, 504):
+                            return None
+                except (self._aiohttp.ClientError, asyncio.TimeoutError):
+                    if attempt >= self.retries:
+                        raise
+                if attempt < self.retries:
+                    await asyncio.sleep(self.backoff * (2 ** attempt))
+            return None
+
+    async def _call_blocking(self, func, *args):
+        """在执行器中运行阻塞的SDK调用"""
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, func, *args)
+
+    async def _safe(self, coro):
+        """把异常转为返回值，单个请求失败不影响其他请求"""
+        try:
+            return await coro
+        except Exception as e:
+            return e
+
+    async def _load_klines(self, kline_store, symbol, interval, periods, now):
+        plan = kline_store.prepare(symbol, interval, periods, now)
+        rows = None
+        if plan is not None:
+            rows = await self._get_json(
+                f"{BINANCE_API_URL}/klines", binance_kline_params(symbol, interval, *plan), metric='binance_klines'
+            )
+            rows = None if rows is None else klines_to_records(rows)
+        return kline_store.complete(symbol, interval, periods, plan, rows, now)
+
+    async def _gather_market_data(self, kline_store, symbols, interval, periods, ticker_symbols, fetch_mids, fetch_user_state):
+        now = time.time()
+        kline_tasks = [self._safe(self._load_klines(kline_store, s, interval, periods, now)) for s in symbols]
+        ticker_tasks = [self._safe(self._get_json(f"{BINANCE_API_URL}/ticker/24hr", {'symbol': f"{s.upper()}USDT"},
+                                                  metric='binance_ticker'))
+                        for s in ticker_symbols]
+        extra_tasks = [
+            self._safe(self._call_blocking(fetch_mids)) if fetch_mids else self._safe(asyncio.sleep(0)),
+            self._safe(self._call_blocking(fetch_user_state)) if fetch_user_state else self._safe(asyncio.sleep(0)),
+        ]
+        results = await asyncio.gather(*kline_tasks, *ticker_tasks, *extra_tasks)
+        klines = results[:len(symbols)]
+        tickers = results[len(symbols):len(symbols) + len(ticker_symbols)]
+        all_mids, user_state = results[-2:]
+        return {
+            'closes': dict(zip(symbols, klines)),
+            'tickers': dict(zip(ticker_symbols, tickers)),
+            'all_mids': all_mids,
+            'user_state': user_state
+        }
+
+    def load_market_data(self, kline_store, symbols, interval, periods=100,
+                         ticker_symbols=(), fetch_mids=None, fetch_user_state=None):
+        """同步门面：一次并发拉取所有币种K线、24hr行情以及 all_mids / user_state
+
+        返回字典中失败的项为 Exception 实例或 None。
+        """
+        self._ensure_started()
+        return self.run(self._gather_market_data(
+            kline_store, list(symbols), interval, periods, list(ticker_symbols), fetch_mids, fetch_user_state
+        ))
+
+
+# 本地K线文件的定长记录格式
+KLINE_DTYPE = np.dtype([
+    ('open_time', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'),
+    ('close', '<f8'), ('volume', '<f8'), ('close_time', '<i8')
+])
+
+
+def klines_to_records(rows):
+    """币安 /klines 原始行 -> KLINE_DTYPE 数组"""
+    return np.array(
+        [(int(r[0]), float(r[1]), float(r[2]), float(r[3]), float(r[4]), float(r[5]), int(r[6])) for r in rows],
+        dtype=KLINE_DTYPE
+    )
+
+
+def records_to_frame(records):
+    """KLINE_DTYPE 数组 -> 回测使用的 DataFrame"""
+    return pd.DataFrame({
+        'open_time': pd.to_datetime(records['open_time'], unit='ms'),
+        'open': records['open'],
+        'high': records['high'],
+        'low': records['low'],
+        'close': records['close'],
+        'volume': records['volume'],
+        'close_time': records['close_time']
+    })
+
+
+def frame_to_records(df, interval=None):
+    """DataFrame（open_time 为时间类型或毫秒）-> KLINE_DTYPE 数组，缺失的价格列用收盘价补齐"""
+    open_time = df['open_time']
+    if np.issubdtype(open_time.dtype, np.datetime64):
+        open_time = open_time.to_numpy(dtype='datetime64[ms]').astype(np.int64)
+    else:
+        open_time = open_time.to_numpy(dtype=np.int64)
+    records = np.zeros(len(df), dtype=KLINE_DTYPE)
+    records['open_time'] = open_time
+    for column in ('open', 'high', 'low', 'close'):
+        records[column] = df[column].astype(float) if column in df else df['close'].astype(float)
+    if 'volume' in df:
+        records['volume'] = df['volume'].astype(float)
+    if 'close_time' in df:
+        records['close_time'] = df['close_time'].astype(np.int64)
+    else:
+        records['close_time'] = open_time + KLINE_INTERVAL_MS.get(interval, 0) - 1
+    return records
+
+
+class FileLock:
+    """跨进程独占文件锁（POSIX flock / Windows msvcrt），每次 with 使用新实例"""
+
+    def __init__(self, path, poll=0.05):
+        self.path = path
+        self.poll = poll
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, 'a+b')
+        if os.name == 'nt':
+            import msvcrt
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(self.poll)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+        return False
+
+
+class KlineFileStore:
+    """本地二进制K线库：每个 (symbol, interval) 一个文件，固定头 + 定长记录
+
+    文件可直接 np.memmap，新K线只追加不重写；按 open_time 二分查找做区间切片。
+    写入乱序或重叠数据（补缺口）时清除头部的有序标记，下次读取前整理一次。
+    追加与整理持有 {文件}.lock 跨进程文件锁，多个进程/线程可同时写同一币种；
+    整理以原子替换完成，已打开的 memmap 继续读取旧文件。
+    """
+
+    MAGIC = b'HLKLINE1'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIIB')
+    HEADER_SIZE = 64
+
+    def __init__(self, root="klines"):
+        self.root = root
+
+    def path(self, symbol, interval):
+        return os.path.join(self.root, f"{symbol.upper()}_{interval}.klines")
+
+    def lock(self, symbol, interval):
+        """该文件的跨进程写锁"""
+        return FileLock(self.path(symbol, interval) + ".lock")
+
+    def _read_header(self, path):
+        with open(path, 'rb') as f:
+            magic, version, record_size, is_sorted = self.HEADER.unpack(f.read(self.HEADER.size))
+        if magic != self.MAGIC or record_size != KLINE_DTYPE.itemsize:
+            raise ValueError(f"K线文件格式不匹配: {path}")
+        return bool(is_sorted)
+
+    def _header_bytes(self, is_sorted):
+        return self.HEADER.pack(self.MAGIC, self.VERSION, KLINE_DTYPE.itemsize, int(is_sorted)).ljust(self.HEADER_SIZE, b'\0')
+
+    def _set_sorted(self, path, is_sorted):
+        with open(path, 'r+b') as f:
+            f.write(self._header_bytes(is_sorted))
+
+    def count(self, symbol, interval):
+        path = self.path(symbol, interval)
+        if not os.path.exists(path):
+            return 0
+        return (os.path.getsize(path) - self.HEADER_SIZE) // KLINE_DTYPE.itemsize
+
+    def _last_open_time(self, path, count):
+        with open(path, 'rb') as f:
+            f.seek(self.HEADER_SIZE + (count - 1) * KLINE_DTYPE.itemsize)
+            return int(np.frombuffer(f.read(KLINE_DTYPE.itemsize), dtype=KLINE_DTYPE)['open_time'][0])
+
+    def append(self, symbol, interval, records):
+        """追加K线记录，返回追加条数"""
+        if len(records) == 0:
+            return 0
+        records = np.sort(np.asarray(records, dtype=KLINE_DTYPE), order='open_time')
+        path = self.path(symbol, interval)
+        with self.lock(symbol, interval):
+            count = self.count(symbol, interval)
+            if count == 0:
+                with open(path, 'wb') as f:
+                    f.write(self._header_bytes(True))
+                    f.write(records.tobytes())
+                return len(records)
+
+            in_order = records['open_time'][0] > self._last_open_time(path, count)
+            if not in_order:
+                self._set_sorted(path, False)
+            with open(path, 'ab') as f:
+                f.write(records.tobytes())
+        return len(records)
+
+    def compact(self, symbol, interval):
+        """排序并按 open_time 去重（后写入的记录优先），原子替换文件"""
+        with self.lock(symbol, interval):
+            return self._compact(symbol, interval)
+
+    def _compact(self, symbol, interval):
+        path = self.path(symbol, interval)
+        count = self.count(symbol, interval)
+        records = np.fromfile(path, dtype=KLINE_DTYPE, count=count, offset=self.HEADER_SIZE)
+        # 逆序后 np.unique 取到的首个即最后写入的记录
+        reversed_records = records[::-1]
+        _, index = np.unique(reversed_records['open_time'], return_index=True)
+        records = reversed_records[index]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self._header_bytes(True))
+            f.write(records.tobytes())
+        os.replace(tmp_path, path)
+        return len(records)
+
+    def load(self, symbol, interval):
+        """返回全部记录（只读 memmap，按 open_time 升序）"""
+        path = self.path(symbol, interval)
+        if self.count(symbol, interval) <= 0:
+            return np.empty(0, dtype=KLINE_DTYPE)
+        if not self._read_header(path):
+            with self.lock(symbol, interval):
+                # 等锁期间可能已被其他进程整理
+                if not self._read_header(path):
+                    self._compact(symbol, interval)
+        return np.memmap(path, dtype=KLINE_DTYPE, mode='r', offset=self.HEADER_SIZE,
+                         shape=(self.count(symbol, interval),))
+
+    def load_range(self, symbol, interval, start_ms=None, end_ms=None):
+        """按 open_time 闭区间 [start_ms, end_ms] 切片"""
+        records = self.load(symbol, interval)
+        times = records['open_time']
+        lo = 0 if start_ms is None else int(np.searchsorted(times, start_ms, side='left'))
+        hi = len(records) if end_ms is None else int(np.searchsorted(times, end_ms, side='right'))
+        return records[lo:hi]
+
+    def bounds(self, symbol, interval):
+        """返回 (首根open_time, 末根open_time)，无数据返回None"""
+        records = self.load(symbol, interval)
+        if len(records) == 0:
+            return None
+        return int(records['open_time'][0]), int(records['open_time'][-1])
+
+    def missing_ranges(self, symbol, interval, start_ms, end_ms):
+        """返回 [start_ms, end_ms] 内缺失K线的 open_time 闭区间列表（按周期对齐）"""
+        step = KLINE_INTERVAL_MS[interval]
+        start_ms = -(-start_ms // step) * step
+        end_ms = end_ms // step * step
+        if start_ms > end_ms:
+            return []
+        times = np.asarray(self.load_range(symbol, interval, start_ms, end_ms)['open_time'])
+        if len(times) == 0:
+            return [(start_ms, end_ms)]
+
+        ranges = []
+        if times[0] > start_ms:
+            ranges.append((start_ms, int(times[0]) - step))
+        for i in np.nonzero(np.diff(times) > step)[0]:
+            ranges.append((int(times[i]) + step, int(times[i + 1]) - step))
+        if times[-1] < end_ms:
+            ranges.append((int(times[-1]) + step, end_ms))
+        return ranges
+
+    def import_csv(self, csv_file, symbol, interval):
+        """一次性迁移旧的 {symbol}_historical_{interval}.csv"""
+        df = pd.read_csv(csv_file, parse_dates=['open_time'])
+        if df.empty:
+            return 0
+        return self.append(symbol, interval, frame_to_records(df, interval))
+
+    def migrate_csv(self, symbol, interval):
+        """本地库为空且存在旧CSV时迁移，返回迁移条数"""
+        csv_file = f"{symbol}_historical_{interval}.csv"
+        if self.count(symbol, interval) == 0 and os.path.exists(csv_file):
+            return self.import_csv(csv_file, symbol, interval)
+        return 0
+
+
+def subtract_ranges(ranges, covered):
+    """从闭区间列表 ranges 中扣除 covered 覆盖的部分"""
+    result = []
+    covered = sorted(covered)
+    for start, end in ranges:
+        cursor = start
+        for c_start, c_end in covered:
+            if c_end < cursor or c_start > end:
+                continue
+            if c_start > cursor:
+                result.append((cursor, c_start - 1))
+            cursor = max(cursor, c_end + 1)
+            if cursor > end:
+                break
+        if cursor <= end:
+            result.append((cursor, end))
+    return result
+
+
+def merge_ranges(ranges):
+    """合并重叠或相邻的闭区间"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class WeightRateLimiter:
+    """按币安请求权重限速的令牌桶，供多个下载线程共享
+
+    默认按每分钟权重上限的80%匀速补充；根据响应头 X-MBX-USED-WEIGHT-1M
+    校准剩余额度，遇到 429/418 按 Retry-After 暂停。
+    """
+
+    def __init__(self, weight_per_minute=6000, safety=0.8):
+        self.capacity = weight_per_minute * safety
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, weight=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= weight:
+                        self.tokens -= weight
+                        return
+                    wait = (weight - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def observe(self, response):
+        """根据响应头校准额度"""
+        with self._lock:
+            used = response.headers.get('X-MBX-USED-WEIGHT-1M')
+            if used and used.isdigit():
+                self.tokens = min(self.tokens, max(self.capacity - int(used), 0))
+            if response.status_code in (418, 429):
+                retry_after = response.headers.get('Retry-After', '60')
+                delay = int(retry_after) if retry_after.isdigit() else 60
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+
+class HistoryDownloader:
+    """增量历史K线下载：只补本地库缺失的区间，多个区间/币种并发拉取
+
+    每页数据拉取后立即追加到 KlineFileStore，中断后重新运行即从缺口继续；
+    交易所确认无数据的区间（上市前、停机）记录在检查点文件中，不再重复请求。
+    """
+
+    KLINES_WEIGHT = 2   # limit=1000 时 /klines 的请求权重
+
+    def __init__(self, store, http_client, limiter=None, max_workers=4, page_size=1000, log=None):
+        self.store = store
+        self.http = http_client
+        self.limiter = limiter or WeightRateLimiter()
+        self.max_workers = max_workers
+        self.page_size = page_size
+        self.log = log or (lambda message, level="info": None)
+        self._checkpoint_lock = threading.Lock()
+
+    def checkpoint_path(self, symbol, interval):
+        return os.path.join(self.store.root, f"{symbol.upper()}_{interval}.checkpoint.json")
+
+    def load_checkpoint(self, symbol, interval):
+        path = self.checkpoint_path(symbol, interval)
+        if not os.path.exists(path):
+            return {'empty_ranges': []}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'empty_ranges': []}
+
+    def mark_empty(self, symbol, interval, ranges):
+        """记录交易所确认无数据的区间"""
+        if not ranges:
+            return
+        path = self.checkpoint_path(symbol, interval)
+        with self._checkpoint_lock, FileLock(path + ".lock"):
+            checkpoint = self.load_checkpoint(symbol, interval)
+            checkpoint['empty_ranges'] = merge_ranges(checkpoint['empty_ranges'] + [list(r) for r in ranges])
+            checkpoint['updated_at'] = int(time.time())
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(checkpoint, f)
+            os.replace(tmp_path, path)
+
+    def plan(self, symbol, interval, start_ms, end_ms):
+        """返回需要拉取的分页 [(page_start, page_end)]"""
+        step = KLINE_INTERVAL_MS[interval]
+        # 只下载已收盘的K线
+        end_ms = min(end_ms, int(time.time() * 1000) - step)
+        missing = self.store.missing_ranges(symbol, interval, start_ms, end_ms)
+        missing = subtract_ranges(missing, self.load_checkpoint(symbol, interval)['empty_ranges'])
+        pages = []
+        for range_start, range_end in missing:
+            # 扣除已确认区间后可能只剩不含任何K线起点的碎片
+            range_start = -(-range_start // step) * step
+            range_end = range_end // step * step
+            for page_start in range(range_start, range_end + 1, step * self.page_size):
+                pages.append((page_start, min(range_end, page_start + step * (self.page_size - 1))))
+        return pages
+
+    def fetch_page(self, symbol, interval, page_start, page_end):
+        """拉取一页并追加入库，返回追加条数"""
+        step = KLINE_INTERVAL_MS[interval]
+        params = binance_kline_params(symbol, interval, self.page_size, page_start)
+        params['endTime'] = page_end
+        self.limiter.acquire(self.KLINES_WEIGHT)
+        response = self.http.get(f"{BINANCE_API_URL}/klines", params=params)
+        self.limiter.observe(response)
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+
+        records = klines_to_records(response.json())
+        records = records[records['close_time'] < int(time.time() * 1000)]
+        appended = self.store.append(symbol, interval, records)
+
+        # 页内没有返回的时间段即交易所无数据
+        times = records['open_time']
+        if len(times) == 0:
+            empty = [(page_start, page_end)]
+        else:
+            empty = [(page_start, int(times[0]) - step)] if times[0] > page_start else []
+            empty += [(int(times[i]) + step, int(times[i + 1]) - step) for i in np.nonzero(np.diff(times) > step)[0]]
+            if times[-1] < page_end:
+                empty.append((int(times[-1]) + step, page_end))
+        self.mark_empty(symbol, interval, empty)
+        return appended
+
+    def sync(self, symbol, interval, start_ms, end_ms):
+        """补齐单个币种的历史K线"""
+        return self.sync_many([(symbol, interval, start_ms, end_ms)])[(symbol, interval)]
+
+    def sync_many(self, jobs):
+        """并发补齐多个 (symbol, interval, start_ms, end_ms)，返回 {(symbol, interval): 统计}"""
+        stats = {}
+        tasks = []
+        for symbol, interval, start_ms, end_ms in jobs:
+            pages = self.plan(symbol, interval, start_ms, end_ms)
+            stats[(symbol, interval)] = {'pages': len(pages), 'appended': 0, 'failed': 0}
+            tasks.extend((symbol, interval, page_start, page_end) for page_start, page_end in pages)
+            if pages:
+                self.log(f" 从Binance补齐 {symbol} {interval} 历史数据: {len(pages)}页", "info")
+        if not tasks:
+            return stats
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="history") as pool:
+            futures = {pool.submit(self.fetch_page, *task): task for task in tasks}
+            for future in as_completed(futures):
+                symbol, interval, page_start, _ = futures[future]
+                try:
+                    stats[(symbol, interval)]['appended'] += future.result()
+                except Exception as e:
+                    stats[(symbol, interval)]['failed'] += 1
+                    self.log(f" {symbol} 历史数据分页失败 (start={page_start}): {str(e)}", "warning")
+
+        for (symbol, interval), stat in stats.items():
+            if stat['pages']:
+                self.log(f"✅ {symbol} 拉取完成: {stat['appended']} 条数据, 失败{stat['failed']}页 (间隔: {interval})", "info")
+        return stats
+
+
+class CandleSource:
+    """K线数据源接口：按时间升序分批产出 KLINE_DTYPE 数组
+
+    回测与实时K线缓存都只依赖这个接口，大区间逐批处理，不一次性载入内存。
+    """
+
+    name = "base"
+
+    def batches(self, symbol, interval, start_ms, end_ms, batch_size=50000):
+        raise NotImplementedError
+
+
+class BinanceRestSource(CandleSource):
+    """币安 REST /klines"""
+
+    name = "binance"
+
+    def __init__(self, http_client, limiter=None):
+        self.http = http_client
+        self.limiter = limiter
+
+    def fetch(self, symbol, interval, limit, start_time=None, end_time=None):
+        """单次请求，返回 KLINE_DTYPE 数组，HTTP 错误返回 None"""
+        params = binance_kline_params(symbol, interval, limit, start_time)
+        if end_time is not None:
+            params['endTime'] = end_time
+        if self.limiter is not None:
+            self.limiter.acquire(HistoryDownloader.KLINES_WEIGHT)
+        response = self.http.get(f"{BINANCE_API_URL}/klines", params=params)
+        if self.limiter is not None:
+            self.limiter.observe(response)
+        if response.status_code != 200:
+            return None
+        return klines_to_records(response.json())
+
+    def batches(self, symbol, interval, start_ms, end_ms, batch_size=50000):
+        cursor = start_ms
+        while cursor <= end_ms:
+            records = self.fetch(symbol, interval, 1000, cursor, end_ms)
+            if records is None:
+                raise RuntimeError(f"Binance API失败 {symbol}")
+            records = records[records['close_time'] < int(time.time() * 1000)]
+            if len(records) == 0:
+                return
+            yield records
+            cursor = int(records['open_time'][-1]) + 1
+
+
+class LocalStoreSource(CandleSource):
+    """本地二进制K线库（可选先用下载器补齐缺失区间），按批返回 memmap 视图"""
+
+    name = "local"
+
+    def __init__(self, store, downloader=None):
+        self.store = store
+        self.downloader = downloader
+
+    def batches(self, symbol, interval, start_ms, end_ms, batch_size=50000):
+        self.store.migrate_csv(symbol, interval)
+        if self.downloader is not None:
+            self.downloader.sync(symbol, interval, start_ms, end_ms)
+        records = self.store.load_range(symbol, interval, start_ms, end_ms)
+        for start in range(0, len(records), batch_size):
+            yield records[start:start + batch_size]
+
+
+class ReplayFileSource(CandleSource):
+    """回放文件：.klines（KlineFileStore 格式）、.jsonl（每行一条币安原始K线）或 .csv"""
+
+    name = "replay"
+
+    def __init__(self, path):
+        self.path = path
+
+    def batches(self, symbol, interval, start_ms, end_ms, batch_size=50000):
+        def in_range(records):
+            times = records['open_time']
+            return records[(times >= start_ms) & (times <= end_ms)]
+
+        if self.path.endswith(".klines"):
+            # 回放文件为只读快照，要求已按时间排序
+            KlineFileStore()._read_header(self.path)
+            count = (os.path.getsize(self.path) - KlineFileStore.HEADER_SIZE) // KLINE_DTYPE.itemsize
+            records = np.memmap(self.path, dtype=KLINE_DTYPE, mode='r', offset=KlineFileStore.HEADER_SIZE, shape=(count,))
+            lo = int(np.searchsorted(records['open_time'], start_ms, side='left'))
+            hi = int(np.searchsorted(records['open_time'], end_ms, side='right'))
+            for start in range(lo, hi, batch_size):
+                yield records[start:min(start + batch_size, hi)]
+        elif self.path.endswith(".jsonl"):
+            rows = []
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        rows.append(json.loads(line))
+                    if len(rows) >= batch_size:
+                        yield in_range(klines_to_records(rows))
+                        rows = []
+            if rows:
+                yield in_range(klines_to_records(rows))
+        else:
+            for chunk in pd.read_csv(self.path, parse_dates=['open_time'], chunksize=batch_size):
+                yield in_range(frame_to_records(chunk, interval))
+
+
+class SyntheticSource(CandleSource):
+    """合成行情：按K线网格生成对数正态随机游走，同一 seed 与币种结果可复现"""
+
+    name = "synthetic"
+
+    def __init__(self, seed=0, start_price=100.0, volatility=0.01, drift=0.0):
+        self.seed = seed
+        self.start_price = start_price
+        self.volatility = volatility
+        self.drift = drift
+
+    def batches(self, symbol, interval, start_ms, end_ms, batch_size=50000):
+        step = KLINE_INTERVAL_MS[interval]
+        # 收益、影线、成交量各用独立的随机流，抽样序列与分批大小无关
+        key = zlib.crc32(symbol.upper().encode())
+        returns_rng, wick_rng, volume_rng = (np.random.default_rng([self.seed, key, stream]) for stream in range(3))
+        price = self.start_price
+        first = -(-start_ms // step) * step
+        for batch_start in range(first, end_ms + 1, step * batch_size):
+            open_time = np.arange(batch_start, min(end_ms, batch_start + step * (batch_size - 1)) + 1, step, dtype=np.int64)
+            returns = self.drift + self.volatility * returns_rng.standard_normal(len(open_time))
+            closes = price * np.exp(np.cumsum(returns))
+            opens = np.concatenate(([price], closes[:-1]))
+            wick = np.abs(wick_rng.standard_normal((2, len(open_time)))) * self.volatility / 2
+            records = np.zeros(len(open_time), dtype=KLINE_DTYPE)
+            records['open_time'] = open_time
+            records['open'] = opens
+            records['close'] = closes
+            records['high'] = np.maximum(opens, closes) * (1 + wick[0])
+            records['low'] = np.minimum(opens, closes) * (1 - wick[1])
+            records['volume'] = volume_rng.gamma(2.0, 500.0, len(open_time))
+            records['close_time'] = open_time + step - 1
+            price = closes[-1]
+            yield records
+
+
+class MarketSnapshot:
+    """单轮交易循环的只读市场快照：K线收盘价、实时价格、账户状态各获取一次"""
+
+    __slots__ = ('interval', 'periods', 'prices', 'closes', 'user_state', 'created_at')
+
+    def __init__(self, interval, periods, prices, closes, user_state, created_at=None):
+        object.__setattr__(self, 'interval', interval)
+        object.__setattr__(self, 'periods', periods)
+        object.__setattr__(self, 'prices', MappingProxyType({k: dict(v) for k, v in prices.items()}))
+        object.__setattr__(self, 'closes', MappingProxyType({k: tuple(v) for k, v in closes.items()}))
+        object.__setattr__(self, 'user_state', user_state)
+        object.__setattr__(self, 'created_at', created_at or time.time())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MarketSnapshot 为只读对象")
+
+    def get_price(self, symbol):
+        """返回价格数据副本，没有则返回None"""
+        price_data = self.prices.get(symbol)
+        return dict(price_data) if price_data else None
+
+    def get_closes(self, symbol, periods):
+        """按需切片收盘价，快照未覆盖时返回None"""
+        if periods > self.periods or symbol not in self.closes:
+            return None
+        series = self.closes[symbol]
+        return list(series[-periods:]) if periods > 0 else []
+
+
+# 策略指标窗口：含当前（未收盘）K线共多少根，实盘与回测一致
+SIGNAL_WINDOW = 100
+
+# K线周期对应的毫秒数（币安K线按UTC整点对齐）
+KLINE_INTERVAL_MS = {
+    '1m': 60_000, '3m': 180_000, '5m': 300_000, '15m': 900_000, '30m': 1_800_000,
+    '1h': 3_600_000, '2h': 7_200_000, '4h': 14_400_000, '6h': 21_600_000,
+    '8h': 28_800_000, '12h': 43_200_000, '1d': 86_400_000
+}
+
+
+class KlineStore:
+    """按 (symbol, interval) 缓存完整K线序列，只增量拉取最新K线"""
+
+    def __init__(self, fetcher, max_rows=1000, min_rows=100, live_ttl=5):
+        self.fetcher = fetcher      # fetcher(symbol, interval, limit, start_time) -> KLINE_DTYPE数组或None
+        self.max_rows = max_rows    # 币安单次最多1000根
+        self.min_rows = min_rows    # 首次拉取至少缓存的根数
+        self.live_ttl = live_ttl    # 未收盘K线的刷新间隔（秒）
+        self.hits = 0               # 无需请求的次数
+        self.misses = 0             # 需要请求（全量或增量）的次数
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def plan_refresh(self, symbol, interval, periods, now=None):
+        """计算需要的请求参数 (limit, start_time)，无需请求时返回None"""
+        now = now or time.time()
+        interval_ms = KLINE_INTERVAL_MS.get(interval)
+        entry = self._series.get((symbol, interval))
+        full_limit = min(max(periods, self.min_rows), self.max_rows)
+
+        if entry is None or interval_ms is None or not entry['rows']:
+            return full_limit, None
+        if len(entry['rows']) < periods and not entry['exhausted']:
+            return full_limit, None
+
+        last_open = entry['rows'][-1][0]
+        now_ms = int(now * 1000)
+        current_open = now_ms - now_ms % interval_ms
+
+        if current_open > last_open:
+            # 跨越周期边界：上一根已收盘，从它开始补齐
+            missing = (current_open - last_open) // interval_ms + 1
+            if missing >= self.max_rows:
+                return full_limit, None
+            return int(missing), last_open
+
+        if now - entry['fetched_at'] >= self.live_ttl:
+            # 同一周期内只刷新未收盘的那一根
+            return 1, last_open
+        return None
+
+    def merge(self, symbol, interval, rows, start_time, limit, now=None):
+        """合并拉取结果；全量拉取直接替换，增量拉取覆盖尾部"""
+        now = now or time.time()
+        key = (symbol, interval)
+        parsed = list(zip(rows['open_time'].tolist(), rows['close'].tolist()))
+        with self._lock:
+            entry = self._series.get(key)
+            if start_time is None or entry is None:
+                entry = {'rows': parsed, 'exhausted': len(parsed) < limit, 'fetched_at': now}
+            else:
+                kept = [row for row in entry['rows'] if row[0] < start_time]
+                entry = {'rows': (kept + parsed)[-self.max_rows:], 'exhausted': entry['exhausted'], 'fetched_at': now}
+            self._series[key] = entry
+
+    def get_closes(self, symbol, interval, periods, now=None):
+        """返回最近 periods 根收盘价，失败返回空列表"""
+        now = now or time.time()
+        plan = self.prepare(symbol, interval, periods, now)
+        rows = None
+        if plan is not None:
+            rows = self.fetcher(symbol, interval, plan[0], plan[1])
+        return self.complete(symbol, interval, periods, plan, rows, now)
+
+    def prepare(self, symbol, interval, periods, now=None):
+        """加锁计算请求参数，供同步与异步拉取共用"""
+        with self._lock:
+            plan = self.plan_refresh(symbol, interval, periods, now or time.time())
+            if plan is None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return plan
+
+    def complete(self, symbol, interval, periods, plan, rows, now=None):
+        """合并拉取结果并返回收盘价；rows为None表示请求失败"""
+        now = now or time.time()
+        if plan is not None:
+            if rows is None:
+                return self._stale_closes(symbol, interval, periods, now)
+            limit, start_time = plan
+            self.merge(symbol, interval, rows, start_time, limit, now)
+
+        with self._lock:
+            entry = self._series.get((symbol, interval))
+            if not entry:
+                return []
+            return [row[1] for row in entry['rows'][-periods:]]
+
+    def get_rows(self, symbol, interval, periods=None):
+        """返回缓存中的 (open_time, close) 行，不触发请求"""
+        with self._lock:
+            entry = self._series.get((symbol, interval))
+            if not entry:
+                return []
+            return list(entry['rows'][-periods:] if periods else entry['rows'])
+
+    def _stale_closes(self, symbol, interval, periods, now):
+        """请求失败时，仅在仍处于同一周期内才返回缓存数据"""
+        with self._lock:
+            entry = self._series.get((symbol, interval))
+            interval_ms = KLINE_INTERVAL_MS.get(interval)
+            if not entry or not entry['rows'] or interval_ms is None or len(entry['rows']) < periods:
+                return []
+            now_ms = int(now * 1000)
+            if entry['rows'][-1][0] < now_ms - now_ms % interval_ms:
+                return []
+            return [row[1] for row in entry['rows'][-periods:]]
+
+    def invalidate(self, symbol=None, interval=None):
+        """清除缓存（不传参数则全部清除）"""
+        with self._lock:
+            if symbol is None and interval is None:
+                self._series.clear()
+                return
+            for key in list(self._series):
+                if (symbol is None or key[0] == symbol) and (interval is None or key[1] == interval):
+                    del self._series[key]
+
+
+AssetMeta = namedtuple('AssetMeta', ['name', 'index', 'px_decimals', 'sz_decimals', 'max_leverage'])
+
+
+class AssetMetaIndex:
+    """info.meta() 资产元数据索引：币种名 -> AssetMeta，按较长间隔刷新"""
+
+    def __init__(self, fetcher, refresh_interval=3600):
+        self.fetcher = fetcher  # fetcher() -> info.meta() 返回值
+        self.refresh_interval = refresh_interval
+        self._records = {}
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """拉取 meta 并重建索引，返回资产数量"""
+        meta = self.fetcher() or {}
+        records = {}
+        for index, asset in enumerate(meta.get('universe', [])):
+            name = asset.get('name')
+            if not name:
+                continue
+            sz_decimals = int(asset.get('szDecimals', 2))
+            records[name] = AssetMeta(
+                name=name,
+                index=index,
+                # 永续合约价格小数位上限为 6 - szDecimals
+                px_decimals=int(asset.get('pxDecimals', max(0, 6 - sz_decimals))),
+                sz_decimals=sz_decimals,
+                max_leverage=int(asset.get('maxLeverage', 0)) or None
+            )
+        with self._lock:
+            self._records = records
+            self._loaded_at = time.time()
+        return len(records)
+
+    def is_stale(self):
+        return time.time() - self._loaded_at >= self.refresh_interval
+
+    def get(self, coin):
+        with self._lock:
+            return self._records.get(coin)
+
+    def __contains__(self, coin):
+        with self._lock:
+            return coin in self._records
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def names(self):
+        with self._lock:
+            return list(self._records)
+
+
+class PriceTable:
+    """监控币种价格表：价格与时间戳存于NumPy数组，按 币种->slot 索引"""
+
+    MID_SOURCE = 'Hyperliquid Mark Price'
+
+    def __init__(self, ttl=20):
+        self.ttl = ttl                  # 价格有效期（秒）
+        self.source_updated_at = {}     # 各数据源最近一次更新时间
+        self.hits = 0                   # get 命中有效价格次数
+        self.misses = 0                 # get 未命中（不存在或过期）次数
+        self._slots = {}
+        self._symbols = []
+        self._prices = np.full(0, np.nan)
+        self._timestamps = np.zeros(0)
+        self._sources = []
+        self._extras = []
+        self._lock = threading.Lock()
+
+    def _slot(self, symbol):
+        """返回币种所在slot，不存在时扩容数组"""
+        coin = symbol.upper()
+        slot = self._slots.get(coin)
+        if slot is None:
+            slot = len(self._symbols)
+            self._slots[coin] = slot
+            self._symbols.append(symbol)
+            self._prices = np.append(self._prices, np.nan)
+            self._timestamps = np.append(self._timestamps, 0.0)
+            self._sources.append(None)
+            self._extras.append({})
+        return slot
+
+    def set_tokens(self, symbols):
+        """登记需要跟踪的币种"""
+        with self._lock:
+            for symbol in symbols:
+                self._slot(symbol)
+
+    def update_mids(self, all_mids, now=None):
+        """用一次 all_mids 结果批量更新所有已登记币种，返回命中数量"""
+        now = now or time.time()
+        with self._lock:
+            coins = list(self._slots)
+            slots = np.fromiter((self._slots[c] for c in coins), dtype=np.int64, count=len(coins))
+            mids = np.fromiter((float(all_mids.get(c, np.nan)) for c in coins), dtype=float, count=len(coins))
+            hit = ~np.isnan(mids)
+            self._prices[slots[hit]] = mids[hit]
+            self._timestamps[slots[hit]] = now
+            for slot in slots[hit]:
+                self._sources[slot] = self.MID_SOURCE
+                self._extras[slot] = {}
+            self.source_updated_at[self.MID_SOURCE] = now
+            return int(hit.sum())
+
+    def put(self, price_data):
+        """写入单个币种的价格数据（如币安fallback）"""
+        with self._lock:
+            slot = self._slot(price_data['symbol'])
+            self._prices[slot] = float(price_data['price'])
+            self._timestamps[slot] = price_data.get('timestamp', time.time())
+            self._sources[slot] = price_data.get('source')
+            self._extras[slot] = {k: v for k, v in price_data.items()
+                                  if k not in ('symbol', 'price', 'timestamp', 'source')}
+            self.source_updated_at[self._sources[slot]] = self._timestamps[slot]
+
+    def get(self, symbol, max_age=None):
+        """返回有效期内的价格数据，过期或不存在返回None"""
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            slot = self._slots.get(symbol.upper())
+            if slot is None or np.isnan(self._prices[slot]) or time.time() - self._timestamps[slot] >= max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._price_data(symbol, slot)
+
+    def get_last(self, symbol):
+        """返回最后一次已知价格（不检查有效期）"""
+        with self._lock:
+            slot = self._slots.get(symbol.upper())
+            if slot is None or np.isnan(self._prices[slot]):
+                return None
+            return self._price_data(symbol, slot)
+
+    def _price_data(self, symbol, slot):
+        price_data = {
+            'symbol': symbol,
+            'price': float(self._prices[slot]),
+            'timestamp': float(self._timestamps[slot]),
+            'source': self._sources[slot]
+        }
+        price_data.update(self._extras[slot])
+        return price_data
+
+
+class AccountStateCache:
+    """账户状态 (user_state) 短时缓存，下单/成交/撤单后显式失效"""
+
+    def __init__(self, fetcher, ttl=5):
+        self.fetcher = fetcher  # fetcher() -> user_state
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._state = None
+        self._fetched_at = 0
+        self._fetching = False  # 是否有线程正在请求
+        self._epoch = 0         # put/invalidate 计数，请求期间变化则丢弃该结果
+        self._cond = threading.Condition()
+
+    def get(self, force=False):
+        """返回缓存的账户状态，过期或失效时重新获取
+
+        请求在锁外进行且同一时刻只有一个：其余读取者等待该次结果，
+        不会被一个慢请求长时间锁住。
+        """
+        with self._cond:
+            waited = False
+            while self._fetching:
+                waited = True
+                self._cond.wait()
+            # 等到的新结果同样满足 force（失效过的结果不会被写入）
+            if (self._state is not None and (waited or not force)
+                    and time.time() - self._fetched_at < self.ttl):
+                self.hits += 1
+                return self._state
+            self._fetching = True
+            self.misses += 1
+            epoch = self._epoch
+
+        fetched = False
+        state = None
+        try:
+            state = self.fetcher() or None
+            fetched = True
+        finally:
+            with self._cond:
+                self._fetching = False
+                if fetched and epoch == self._epoch:
+                    self._state = state
+                    self._fetched_at = time.time()
+                self._cond.notify_all()
+        return state
+
+    def put(self, state):
+        """写入外部已获取的账户状态"""
+        with self._cond:
+            self._epoch += 1
+            self._state = state or None
+            self._fetched_at = time.time()
+
+    def invalidate(self):
+        """标记失效，下次读取时重新获取"""
+        with self._cond:
+            self._epoch += 1
+            self._state = None
+            self._fetched_at = 0
+
+
+class LatencyRecorder:
+    """滚动延迟统计：每个名称保留最近 window 个样本（NumPy 环形数组），
+    提供 p50/p95/p99、调用次数与错误计数，线程安全"""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._samples = {}  # name -> [样本数组, 写入位置, 调用次数, 错误次数, 最近一次]
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds=None, error=False):
+        """记录一次耗时（秒）；seconds 为 None 时只计错误"""
+        with self._lock:
+            slot = self._samples.get(name)
+            if slot is None:
+                slot = self._samples[name] = [np.full(self.window, np.nan), 0, 0, 0, 0.0]
+            if seconds is not None:
+                slot[0][slot[1] % self.window] = seconds
+                slot[1] += 1
+                slot[2] += 1
+                slot[4] = seconds
+            if error:
+                slot[3] += 1
+
+    def timer(self, name):
+        """计时上下文：with recorder.timer('market_open'): ...，异常计入错误"""
+        return LatencyTimer(self, name)
+
+    def stage_clock(self, prefix):
+        """分阶段计时：clock.mark('阶段') 记录自上一标记以来的耗时"""
+        return StageClock(self, prefix)
+
+    def snapshot(self):
+        """{name: {'count', 'errors', 'p50', 'p95', 'p99', 'max', 'last'}}，耗时单位毫秒"""
+        with self._lock:
+            items = [(name, slot[0].copy(), slot[2], slot[3], slot[4]) for name, slot in self._samples.items()]
+        stats = {}
+        for name, samples, count, errors, last in sorted(items):
+            samples = samples[~np.isnan(samples)] * 1000
+            if samples.size:
+                p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+                peak = samples.max()
+            else:
+                p50 = p95 = p99 = peak = 0.0
+            stats[name] = {
+                'count': count, 'errors': errors,
+                'p50': round(float(p50), 2), 'p95': round(float(p95), 2), 'p99': round(float(p99), 2),
+                'max': round(float(peak), 2), 'last': round(last * 1000, 2)
+            }
+        return stats
+
+    def dump(self, path):
+        """写出统计快照（原子替换）"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'time': datetime.now().isoformat(timespec='seconds'), 'metrics': self.snapshot()},
+                      f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+
+class LatencyTimer:
+    """LatencyRecorder.timer 返回的计时上下文"""
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.recorder.observe(self.name, time.perf_counter() - self.start, error=exc_type is not None)
+        return False
+
+
+class StageClock:
+    """按阶段切分一次循环的耗时，finish() 记录总耗时"""
+
+    def __init__(self, recorder, prefix):
+        self.recorder = recorder
+        self.prefix = prefix
+        self.start = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.recorder.observe(f"{self.prefix}.{stage}", now - self.last)
+        self.last = now
+
+    def finish(self):
+        self.recorder.observe(self.prefix, time.perf_counter() - self.start)
+
+
+def prometheus_text(families):
+    """渲染 Prometheus 文本格式；families 为 [(name, type, help, [(labels, value), ...]), ...]"""
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(
+                '{}="{}"'.format(key, str(val).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                for key, val in labels.items()
+            )
+            lines.append(f"{name}{{{label_text}}} {float(value)!r}" if label_text else f"{name} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """本机 /metrics 端点（Prometheus 文本格式），在守护线程中运行；render() 返回文本"""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, render, port, host="127.0.0.1"):
+        self.render = render
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                try:
+                    body = server.render().encode('utf-8')
+                except Exception as e:
+                    self.send_error(500, str(e))
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", server.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # 抓取请求不写入日志
+
+        self._server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+DEFAULT_SLIPPAGE = 0.05  # 与 SDK market_open 默认滑点一致
+
+
+def slippage_price(mid, is_buy, sz_decimals, slippage=DEFAULT_SLIPPAGE):
+    """IOC 限价单的滑点价格：5位有效数字，且小数位不超过 6 - szDecimals（永续合约规则）"""
+    px = mid * (1 + slippage) if is_buy else mid * (1 - slippage)
+    px = float(f"{px:.5g}")
+    return round(px, max(0, 6 - sz_decimals))
+
+
+ORDER_SUBMITTED = 'submitted'
+ORDER_RESTING = 'resting'
+ORDER_PARTIAL = 'partially_filled'
+ORDER_FILLED = 'filled'
+ORDER_CANCELLED = 'cancelled'
+ORDER_REJECTED = 'rejected'
+ORDER_UNKNOWN = 'unknown'
+ACTIVE_ORDER_STATES = (ORDER_SUBMITTED, ORDER_RESTING, ORDER_PARTIAL)
+
+
+def new_cloid():
+    """生成客户端订单号（128位十六进制，Hyperliquid cloid 格式）"""
+    return "0x" + os.urandom(16).hex()
+
+
+class OrderManager:
+    """订单生命周期状态机：submitted → resting → partially_filled → filled/cancelled/rejected/unknown
+
+    交易循环每轮（或更频繁）调用 poll()，不阻塞等待：
+    有订单号的挂单通过 open_orders / query_order_by_oid 判定状态；
+    无订单号的已提交订单（市价单响应丢失、API报错）按 cloid 查询订单状态，
+    查不到时用下单时间之后的 user_fills 确认成交。两种方式都无法确认时
+    标记为 unknown，由调用方同步持仓后重新评估，不自动重新下单。
+    """
+
+    FILL_CLOCK_SKEW = 2.0  # 成交时间与本地下单时间的允许偏差（秒）
+    FIRST_POLL_DELAY = 1.0  # 新订单提交后首次检查的延迟（秒），不受 poll_interval 限制
+
+    def __init__(self, fetch_open_orders, query_order, query_order_by_cloid, fetch_fills, cancel_order,
+                 timeout=300, confirm_timeout=30, poll_interval=1.0, log=None):
+        self.fetch_open_orders = fetch_open_orders  # () -> [{'coin', 'oid', 'sz', 'origSz', ...}]
+        self.query_order = query_order  # (oid) -> query_order_by_oid 响应
+        self.query_order_by_cloid = query_order_by_cloid  # (cloid) -> query_order_by_cloid 响应
+        self.fetch_fills = fetch_fills  # (since_ms) -> user_fills_by_time 列表
+        self.cancel_order = cancel_order  # (symbol, oid)
+        self.timeout = timeout  # 挂单超时撤单
+        self.confirm_timeout = confirm_timeout  # 无订单号订单的确认期限
+        self.poll_interval = poll_interval
+        self.log = log or (lambda msg, level="info": None)
+        self.orders = {}  # 活动订单: key -> 订单字典（即 bot.pending_orders）
+        self.history = deque(maxlen=200)  # 已结束订单
+        self.listeners = []  # 订单结束回调 fn(order)
+        self._next_poll = 0
+        self._seq = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def track(self, symbol, side, size, price, oid=None, status=None, cloid=None):
+        """登记一笔已提交订单，返回其键"""
+        if status is None:
+            status = ORDER_RESTING if oid is not None else ORDER_SUBMITTED
+        key = oid if oid is not None else (cloid or f"local-{next(self._seq)}")
+        now = time.time()
+        with self._lock:
+            self.orders[key] = {
+                'symbol': symbol,
+                'side': side,
+                'size': float(size),
+                'filled': 0.0,
+                'price': price,
+                'oid': oid,
+                'cloid': cloid,
+                'status': status,
+                'timestamp': now,
+                'updated': now,
+            }
+            # 新订单尽快检查一次
+            self._next_poll = min(self._next_poll, now + self.FIRST_POLL_DELAY)
+        return key
+
+    def active(self, symbol=None, side=None):
+        """返回活动订单列表，可按币种/方向过滤"""
+        with self._lock:
+            return [order for order in self.orders.values()
+                    if order['status'] in ACTIVE_ORDER_STATES
+                    and (symbol is None or order['symbol'] == symbol)
+                    and (side is None or order['side'] == side)]
+
+    def poll(self, now=None, force=False):
+        """推进所有活动订单的状态，返回本次结束的订单列表"""
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self.orders or (not force and now < self._next_poll):
+                return []
+            self._next_poll = now + self.poll_interval
+            orders = list(self.orders.items())
+
+        resting = [(key, order) for key, order in orders if order['oid'] is not None]
+        unconfirmed = [(key, order) for key, order in orders if order['oid'] is None]
+
+        finished = []
+        if resting:
+            finished.extend(self._poll_resting(resting, now))
+        if unconfirmed:
+            finished.extend(self._poll_unconfirmed(unconfirmed, now))
+
+        for key, order in finished:
+            with self._lock:
+                self.orders.pop(key, None)
+                self.history.append(order)
+            for listener in self.listeners:
+                try:
+                    listener(order)
+                except Exception as e:
+                    self.log(f"订单回调出错: {str(e)}", "error")
+        return [order for _, order in finished]
+
+    def _poll_resting(self, resting, now):
+        """按 open_orders 快照推进有订单号的挂单"""
+        try:
+            open_by_oid = {o.get('oid'): o for o in self.fetch_open_orders() or []}
+        except Exception as e:
+            self.log(f"获取挂单列表失败: {str(e)}", "warning")
+            return []
+
+        finished = []
+        for key, order in resting:
+            live = open_by_oid.get(order['oid'])
+            if live is not None:
+                orig = float(live.get('origSz', order['size']) or order['size'])
+                remaining = float(live.get('sz', orig) or 0)
+                filled = max(0.0, orig - remaining)
+                if filled > order['filled']:
+                    order['filled'] = filled
+                    order['status'] = ORDER_PARTIAL
+                    order['updated'] = now
+                    self.log(f"挂单部分成交: {order['symbol']} {filled}/{orig}", "info")
+                if now - order['timestamp'] > self.timeout:
+                    self.log(f"挂单超时: {order['symbol']}，尝试取消", "warning")
+                    try:
+                        self.cancel_order(order['symbol'], order['oid'])
+                        order['status'] = ORDER_CANCELLED
+                        finished.append((key, order))
+                    except Exception as e:
+                        self.log(f"❌ 取消挂单失败 {order['symbol']}: {str(e)}", "error")
+                continue
+
+            # 已不在挂单列表：查询最终状态
+            status = self._final_status(order)
+            if status is None:
+                if now - order['timestamp'] > 600:
+                    self.log(f"无法确认挂单最终状态: {order['symbol']}，标记为未知", "error")
+                    order['status'] = ORDER_UNKNOWN
+                    finished.append((key, order))
+                continue
+            order['status'] = status
+            order['updated'] = now
+            if status == ORDER_FILLED:
+                order['filled'] = order['size']
+            finished.append((key, order))
+        return finished
+
+    def _final_status(self, order):
+        """通过 query_order_by_oid 判定已离开挂单簿的订单状态"""
+        try:
+            response = self.query_order(order['oid']) or {}
+        except Exception as e:
+            self.log(f"查询订单状态失败 {order['symbol']}: {str(e)}", "warning")
+            return None
+        return parse_order_status(response)[0]
+
+    def _poll_unconfirmed(self, unconfirmed, now):
+        """无订单号的订单：先按 cloid 查询，查不到再用下单后的成交记录确认"""
+        finished = []
+        pending = []
+        for key, order in unconfirmed:
+            if order['cloid'] and self._apply_cloid_status(order, now):
+                if order['status'] not in ACTIVE_ORDER_STATES:
+                    finished.append((key, order))
+                continue
+            pending.append((key, order))
+        if not pending:
+            return finished
+
+        fills = self._fills_since(min(order['timestamp'] for _, order in pending))
+        for key, order in pending:
+            same_side = [o for _, o in unconfirmed
+                         if o['symbol'] == order['symbol'] and o['side'] == order['side'] and o['oid'] is None]
+            filled = None
+            if fills is not None:
+                matched = self._match_fills(order, fills, attribute_by_side=len(same_side) == 1)
+                if matched is not None:
+                    filled = matched
+                    if filled > order['filled'] + 1e-12:
+                        order['filled'] = min(filled, order['size'])
+                        order['status'] = ORDER_FILLED if order['filled'] >= order['size'] * 0.999 else ORDER_PARTIAL
+                        order['updated'] = now
+                        self.log(f"✅ {order['symbol']} 成交确认: {order['filled']}/{order['size']}", "info")
+                        if order['status'] == ORDER_FILLED:
+                            finished.append((key, order))
+                            continue
+
+            if now - order['timestamp'] > self.confirm_timeout:
+                if order['filled'] > 0:
+                    order['status'] = ORDER_FILLED  # IOC 剩余部分已失效
+                elif filled is not None:
+                    order['status'] = ORDER_REJECTED
+                    self.log(f" {order['symbol']} 订单{self.confirm_timeout}秒内无成交记录，视为未成交", "warning")
+                else:
+                    order['status'] = ORDER_UNKNOWN
+                    self.log(f"❌ {order['symbol']} 订单结果无法确认（无订单号且无法按成交记录归属），"
+                             f"请核对持仓", "error")
+                order['updated'] = now
+                finished.append((key, order))
+        return finished
+
+    def _apply_cloid_status(self, order, now):
+        """按 cloid 查询并更新订单，交易所查到该订单时返回 True"""
+        try:
+            response = self.query_order_by_cloid(order['cloid']) or {}
+        except Exception as e:
+            self.log(f"按cloid查询订单失败 {order['symbol']}: {str(e)}", "warning")
+            return False
+        status, info = parse_order_status(response)
+        if info is None:
+            return False  # 交易所尚无此订单（未送达或尚未入库）
+
+        oid = info.get('oid')
+        orig = float(info.get('origSz', order['size']) or order['size'])
+        remaining = float(info.get('sz', 0) or 0)
+        filled = max(0.0, orig - remaining)
+        order['updated'] = now
+        if status is None:
+            # 仍在挂单簿：转为按订单号跟踪
+            order['oid'] = oid
+            order['filled'] = filled
+            order['status'] = ORDER_PARTIAL if filled > 0 else ORDER_RESTING
+            return True
+        order['oid'] = oid
+        if status == ORDER_FILLED:
+            order['filled'] = order['size'] if remaining <= 0 else filled
+        elif filled > 0:
+            order['filled'] = filled
+            status = ORDER_FILLED  # IOC/撤单前已部分成交
+        order['status'] = status
+        return True
+
+    def _fills_since(self, since):
+        """下单时间之后的成交记录，获取失败返回None"""
+        try:
+            return self.fetch_fills(int((since - self.FILL_CLOCK_SKEW) * 1000)) or []
+        except Exception as e:
+            self.log(f"获取成交记录失败，稍后确认订单: {str(e)}", "warning")
+            return None
+
+    def _match_fills(self, order, fills, attribute_by_side):
+        """返回归属于该订单的成交数量；无法可靠归属时返回None"""
+        since_ms = (order['timestamp'] - self.FILL_CLOCK_SKEW) * 1000
+        side = 'B' if order['side'] == 'buy' else 'A'
+        candidates = [f for f in fills if f.get('coin') == order['symbol'] and f.get('side') == side
+                      and f.get('time', 0) >= since_ms]
+        if order['cloid'] and any(f.get('cloid') for f in fills):
+            matched = [f for f in candidates if f.get('cloid') == order['cloid']]
+        elif attribute_by_side or not candidates:
+            matched = candidates
+        else:
+            return None
+        return sum(float(f.get('sz', 0)) for f in matched)
+
+
+def parse_order_status(response):
+    """解析 query_order_by_oid / query_order_by_cloid 响应，返回 (终态或None, 订单字段或None)"""
+    if not isinstance(response, dict) or response.get('status') != 'order':
+        return None, None
+    wrapper = response.get('order') or {}
+    info = wrapper.get('order') or {}
+    status = str(wrapper.get('status', '')).lower()
+    if status == 'filled':
+        return ORDER_FILLED, info
+    if 'cancel' in status:
+        return ORDER_CANCELLED, info
+    if 'reject' in status:
+        return ORDER_REJECTED, info
+    return None, info
+
+
+class TradingScheduler:
+    """交易循环事件调度：高频 tick 只做廉价风控，完整信号周期仅在事件发生时运行
+
+    事件：K线收盘、价格相对上次周期偏离超过阈值、订单成交、止盈/接近止损、心跳超时。
+    notify() 可从任意线程调用，并唤醒正在等待的交易循环。
+    """
+
+    def __init__(self, interval='1d', heartbeat=60, price_move_pct=0.5, stop_warning_ratio=0.75,
+                 tick=1.0, close_delay=2.0):
+        self.interval_ms = KLINE_INTERVAL_MS.get(interval, KLINE_INTERVAL_MS['1d'])
+        self.heartbeat = heartbeat  # 两次完整周期的最长间隔（秒）
+        self.price_move_pct = price_move_pct
+        self.stop_warning_ratio = stop_warning_ratio  # 亏损达到止损线该比例视为接近止损
+        self.tick = tick
+        self.close_delay = close_delay  # 收盘后稍等，确保拿到已收盘K线
+        self.wake = threading.Event()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """清空状态，下一次 due() 立即触发完整周期"""
+        with self._lock:
+            self.events = []
+        self.last_cycle = 0
+        self.next_close = 0
+        self.reference_prices = {}
+        self.near_stop = set()
+        self.wake.clear()
+
+    def configure(self, interval=None, heartbeat=None):
+        """同步界面上的K线周期与心跳间隔"""
+        interval_ms = KLINE_INTERVAL_MS.get(interval, self.interval_ms)
+        if interval_ms != self.interval_ms:
+            self.interval_ms = interval_ms
+            self.next_close = self.candle_close_after(time.time())
+        if heartbeat:
+            self.heartbeat = heartbeat
+
+    def candle_close_after(self, now):
+        """now 之后的下一次K线收盘时刻（含 close_delay）"""
+        step = self.interval_ms / 1000.0
+        return (int((now - self.close_delay) // step) + 1) * step + self.close_delay
+
+    def notify(self, reason):
+        """登记事件并唤醒交易循环"""
+        with self._lock:
+            if reason not in self.events:
+                self.events.append(reason)
+        self.wake.set()
+
+    def observe_prices(self, prices):
+        """价格相对上次完整周期偏离超过阈值时登记 price_move 事件，返回触发的币种"""
+        for symbol, price in prices.items():
+            reference = self.reference_prices.get(symbol)
+            if reference and abs(price - reference) / reference * 100 >= self.price_move_pct:
+                self.notify('price_move')
+                return symbol
+        return None
+
+    def observe_stop_distance(self, symbol, near):
+        """持仓跨入止损预警区间时登记一次 stop_distance 事件"""
+        if near and symbol not in self.near_stop:
+            self.near_stop.add(symbol)
+            self.notify('stop_distance')
+        elif not near:
+            self.near_stop.discard(symbol)
+
+    def due(self, now=None):
+        """取出触发完整周期的原因列表，为空表示本 tick 无需运行"""
+        now = time.time() if now is None else now
+        with self._lock:
+            reasons, self.events = self.events, []
+        if now >= self.next_close:
+            reasons.append('candle_close')
+        if now - self.last_cycle >= self.heartbeat:
+            reasons.append('heartbeat')
+        return reasons
+
+    def mark_cycle(self, prices, now=None):
+        """完整周期结束：记录时间、下一次收盘时刻与价格基准"""
+        now = time.time() if now is None else now
+        self.last_cycle = now
+        self.next_close = self.candle_close_after(now)
+        self.reference_prices = dict(prices)
+
+    def wait(self, timeout=None):
+        """等待下一个 tick，有事件通知时提前返回"""
+        self.wake.wait(self.tick if timeout is None else timeout)
+        self.wake.clear()
+
+
+def ema_kernel(values, period, block=256):
+    """向量化EMA：支持一维序列或二维（币种×K线）矩阵
+
+    与逐元素递推结果一致：第 period-1 根为前 period 根的SMA，之前为NaN。
+    递推 y[t] = a*x[t] + (1-a)*y[t-1] 按块展开为闭式矩阵乘法，
+    块内权重 a*(1-a)^(i-j) 不超过1，长序列也不会溢出。
+    """
+    x = np.asarray(values, dtype=float)
+    squeeze = x.ndim == 1
+    x = np.atleast_2d(x)
+    out = np.full(x.shape, np.nan)
+    n = x.shape[1]
+    if n < period:
+        return out[0] if squeeze else out
+
+    alpha = 2 / (period + 1.0)
+    decay = 1 - alpha
+    out[:, period - 1] = x[:, :period].mean(axis=1)
+
+    rest = x[:, period:]
+    if rest.shape[1]:
+        size = min(block, rest.shape[1])
+        lag = np.subtract.outer(np.arange(size), np.arange(size))
+        weights = np.where(lag >= 0, alpha * decay ** np.maximum(lag, 0), 0.0)
+        carry = decay ** np.arange(1, size + 1)
+        prev = out[:, period - 1]
+        for start in range(0, rest.shape[1], size):
+            chunk = rest[:, start:start + size]
+            m = chunk.shape[1]
+            block_out = chunk @ weights[:m, :m].T + prev[:, None] * carry[:m]
+            out[:, period + start:period + start + m] = block_out
+            prev = block_out[:, -1]
+
+    return out[0] if squeeze else out
+
+
+def macd_kernel(prices, fast=12, slow=26, signal=9):
+    """向量化MACD：返回 (macd序列, 信号线序列)，支持二维（币种×K线）矩阵"""
+    prices = np.asarray(prices, dtype=float)
+    macd_series = ema_kernel(prices, fast) - ema_kernel(prices, slow)
+    signal_series = np.full(macd_series.shape, np.nan)
+    # MACD 前 slow-1 根为NaN，信号线从第一根有效MACD开始计算
+    if macd_series.shape[-1] >= slow:
+        signal_series[..., slow - 1:] = ema_kernel(macd_series[..., slow - 1:], signal)
+    return macd_series, signal_series
+
+
+def backtest_indicator_series(closes, window=SIGNAL_WINDOW, fast=12, slow=26, signal=9, rsi_period=14,
+                              bb_period=20, bb_std=2, ma_short=10, ma_long=20, chunk=2048):
+    """一次性计算回测中每根K线的指标值
+
+    第 i 根K线的窗口为 closes[max(0, i-window+1):i+1]（含当前K线共 window 根），
+    与实盘逐根调用批量指标的口径一致；MACD 的EMA随窗口起点重新起算，
+    因此对每个完整窗口用二维EMA内核批量计算。
+    """
+    closes = np.asarray(closes, dtype=float)
+    n = len(closes)
+    keys = ('ma_short', 'ma_long', 'rsi', 'macd', 'macd_signal', 'bb_upper', 'bb_lower', 'bb_middle')
+    series = {key: np.full(n, np.nan) for key in keys}
+
+    if n >= ma_short:
+        series['ma_short'][ma_short - 1:] = sliding_window_view(closes, ma_short).mean(axis=1)
+    if n >= ma_long:
+        series['ma_long'][ma_long - 1:] = sliding_window_view(closes, ma_long).mean(axis=1)
+
+    if n > rsi_period:
+        deltas = np.diff(closes)
+        gains = sliding_window_view(np.where(deltas > 0, deltas, 0), rsi_period).mean(axis=1)
+        losses = sliding_window_view(np.where(deltas < 0, -deltas, 0), rsi_period).mean(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rsi = 100 - (100 / (1 + gains / losses))
+        series['rsi'][rsi_period:] = np.where(losses == 0, 100, rsi)
+
+    if n >= bb_period:
+        windows = sliding_window_view(closes, bb_period)
+        sma = windows.mean(axis=1)
+        std = windows.std(axis=1)
+        series['bb_upper'][bb_period - 1:] = sma + (std * bb_std)
+        series['bb_lower'][bb_period - 1:] = sma - (std * bb_std)
+        series['bb_middle'][bb_period - 1:] = sma
+
+    # 窗口未满时窗口从0开始，等价于对前缀计算完整序列
+    head = min(n, window)
+    if head >= slow + signal:
+        macd, signal_line = macd_kernel(closes[:head], fast, slow, signal)
+        series['macd'][:head] = macd
+        series['macd_signal'][:head] = signal_line
+    if n > window:
+        windows = sliding_window_view(closes, window)
+        for start in range(0, len(windows), chunk):
+            macd, signal_line = macd_kernel(windows[start:start + chunk], fast, slow, signal)
+            rows = slice(window - 1 + start, window - 1 + start + len(macd))
+            series['macd'][rows] = macd[:, -1]
+            series['macd_signal'][rows] = signal_line[:, -1]
+
+    # 与 calculate_macd 一致：信号线无效时两者均视为无效
+    invalid = np.isnan(series['macd_signal'])
+    series['macd'][invalid] = np.nan
+    return series
+
+
+def indicator_signal_labels(series, closes, enabled=('ma', 'rsi', 'macd', 'bollinger')):
+    """把指标序列转为每根K线的策略信号（买入/卖出/持有），规则与各 *_strategy_enhanced 一致"""
+    closes = np.asarray(closes, dtype=float)
+    n = len(closes)
+    labels = {}
+
+    def choose(buy, sell, default="持有"):
+        return np.where(buy, "买入", np.where(sell, "卖出", default)).astype(object)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'ma' in enabled:
+            ma_short, ma_long = series['ma_short'], series['ma_long']
+            price_vs_short = (closes - ma_short) / ma_short * 100
+            labels['ma'] = choose(
+                (ma_short > ma_long) & (closes > ma_short) & (price_vs_short > 1),
+                (ma_short < ma_long) & (closes < ma_short) & (price_vs_short < -1)
+            )
+            labels['ma'][np.isnan(ma_long)] = "数据不足"
+        else:
+            labels['ma'] = np.full(n, "未启用", dtype=object)
+
+        if 'rsi' in enabled:
+            rsi = series['rsi']
+            labels['rsi_signal'] = choose(rsi < 25, rsi > 75)
+        else:
+            labels['rsi_signal'] = np.full(n, "未启用", dtype=object)
+
+        if 'macd' in enabled:
+            macd, signal_line = series['macd'], series['macd_signal']
+            macd_diff = macd - signal_line
+            macd_strength = np.abs(macd_diff) / (np.abs(signal_line) + 1e-6)
+            active = signal_line != 0
+            labels['macd_signal'] = choose(
+                active & (macd > signal_line) & (macd_diff > 0) & (macd_strength > 0.1),
+                active & (macd < signal_line) & (macd_diff < 0) & (macd_strength > 0.1)
+            )
+            labels['macd_signal'][np.isnan(macd) | np.isnan(signal_line)] = "数据不足"
+        else:
+            labels['macd_signal'] = np.full(n, "未启用", dtype=object)
+
+        if 'bollinger' in enabled:
+            labels['bollinger'] = choose(closes < series['bb_lower'], closes > series['bb_upper'])
+        else:
+            labels['bollinger'] = np.full(n, "未启用", dtype=object)
+
+    return labels
+
+
+class RollingWindow:
+    """定长滑动窗口：O(1) 维护 sum / sumsq，定期全量重算消除浮点累积误差
+
+    peek(x) 返回“丢弃最旧值、加入 x”后的窗口统计，不修改状态，
+    用于未收盘K线（实时价格）的试算。
+    """
+
+    def __init__(self, size, recompute_every=500, centered=True):
+        self.size = size
+        self.recompute_every = recompute_every
+        self.centered = centered    # 以首个值为基准平移，降低 sumsq 的抵消误差
+        self.values = deque(maxlen=size)
+        self._shift = 0.0
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self._pushes = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def full(self):
+        return len(self.values) == self.size
+
+    def push(self, x):
+        x = float(x)
+        if not self.values and self.centered:
+            self._shift = x
+        if len(self.values) == self.size:
+            old = self.values[0] - self._shift
+            self._sum -= old
+            self._sumsq -= old * old
+        self.values.append(x)
+        d = x - self._shift
+        self._sum += d
+        self._sumsq += d * d
+        self._pushes += 1
+        if self._pushes % self.recompute_every == 0:
+            self._recompute()
+
+    def _recompute(self):
+        if self.centered:
+            self._shift = self.values[0]
+        deltas = np.asarray(self.values, dtype=float) - self._shift
+        self._sum = float(deltas.sum())
+        self._sumsq = float((deltas * deltas).sum())
+
+    def peek(self, x=None):
+        """返回 (mean, std)；std 为总体标准差，与 np.std 一致"""
+        n, total, total_sq = len(self.values), self._sum, self._sumsq
+        if x is not None:
+            if n == self.size:
+                old = self.values[0] - self._shift
+                total -= old
+                total_sq -= old * old
+            else:
+                n += 1
+            d = float(x) - self._shift
+            total += d
+            total_sq += d * d
+        if n == 0:
+            return np.nan, np.nan
+        mean = total / n
+        return self._shift + mean, np.sqrt(max(total_sq / n - mean * mean, 0.0))
+
+
+class StreamingRSI:
+    """增量RSI：滚动维护最近 period 个涨跌幅之和（与 calculate_rsi 的简单均值口径一致）"""
+
+    def __init__(self, period=14):
+        self.period = period
+        self.gains = RollingWindow(period, centered=False)
+        self.losses = RollingWindow(period, centered=False)
+        self.last_close = None
+
+    def update(self, close):
+        if self.last_close is not None:
+            delta = close - self.last_close
+            self.gains.push(max(delta, 0.0))
+            self.losses.push(max(-delta, 0.0))
+        self.last_close = float(close)
+
+    def ready(self):
+        # 试算时加入实时价格的涨跌幅，窗口只需 period-1 个已收盘涨跌幅
+        return len(self.gains) >= self.period - 1
+
+    def peek(self, price):
+        if self.last_close is None or not self.ready():
+            return 50
+        delta = price - self.last_close
+        avg_gain = self.gains.peek(max(delta, 0.0))[0]
+        avg_loss = self.losses.peek(max(-delta, 0.0))[0]
+        if avg_loss <= 0:
+            return 100
+        return 100 - (100 / (1 + avg_gain / avg_loss))
+
+
+class IndicatorState:
+    """单个币种的增量指标状态：K线收盘时 O(1) 更新 MA/RSI/布林带，实时价格只做试算
+
+    按K线 open_time 对齐：sync() 接收 KlineStore 的 (open_time, close) 行，最后一行视为
+    未收盘K线（live_open/live_close）；已收盘K线断档、回退或被修正（同一 open_time 的收盘价
+    变化）时从头重建。MACD 保留最近 window-1 根已收盘价，试算时对 window 根窗口调用
+    macd_kernel，EMA 起点与 calculate_macd 及回测的窗口口径完全一致。
+    """
+
+    def __init__(self, interval, window=SIGNAL_WINDOW, fast=12, slow=26, signal=9, rsi_period=14,
+                 bb_period=20, ma_short=10, ma_long=20):
+        self.interval = interval
+        self.window = window
+        self.params = (fast, slow, signal, rsi_period, bb_period, ma_short, ma_long)
+        self.reset()
+
+    def reset(self):
+        fast, slow, signal, rsi_period, bb_period, ma_short, ma_long = self.params
+        self.closed = deque(maxlen=self.window - 1)  # 最近已收盘的 (open_time, close)
+        self.rsi = StreamingRSI(rsi_period)
+        self.bollinger = RollingWindow(bb_period)
+        self.ma_short = RollingWindow(ma_short)
+        self.ma_long = RollingWindow(ma_long)
+        self.last_open = None
+        self.live_open = None
+        self.live_close = None
+        self.count = 0
+
+    def update(self, open_time, close):
+        """一根K线收盘"""
+        close = float(close)
+        self.closed.append((open_time, close))
+        self.rsi.update(close)
+        self.bollinger.push(close)
+        self.ma_short.push(close)
+        self.ma_long.push(close)
+        self.last_open = open_time
+        self.count += 1
+
+    def sync(self, rows):
+        """用缓存K线补齐新收盘的K线，并记录当前未收盘K线"""
+        closed = rows[:-1]
+        if not closed:
+            return
+        fresh = None
+        step = KLINE_INTERVAL_MS.get(self.interval)
+        if self.last_open is not None and step and closed[-1][0] >= self.last_open:
+            known = dict(self.closed)
+            if all(known.get(open_time, close) == close for open_time, close in closed if open_time <= self.last_open):
+                fresh = [row for row in closed if row[0] > self.last_open]
+                if fresh and fresh[0][0] != self.last_open + step:
+                    fresh = None    # 断档
+        if fresh is None:
+            self.reset()
+            fresh = closed
+        for open_time, close in fresh:
+            self.update(open_time, close)
+        self.live_open, self.live_close = rows[-1][0], float(rows[-1][1])
+
+    def ready(self):
+        return (self.live_open is not None and self.rsi.ready()
+                and self.bollinger.full() and self.ma_long.full())
+
+    def peek(self, live_close, std_dev=2):
+        """以未收盘K线的最新价试算全部指标"""
+        fast, slow, signal = self.params[:3]
+        macd = signal_value = np.nan
+        closes = np.fromiter((close for _, close in self.closed), dtype=float, count=len(self.closed))
+        closes = np.append(closes, float(live_close))
+        if len(closes) >= slow + signal:
+            macd_series, signal_series = macd_kernel(closes, fast, slow, signal)
+            if not np.isnan(signal_series[-1]):
+                macd, signal_value = macd_series[-1], signal_series[-1]
+        mean, std = self.bollinger.peek(live_close)
+        return {
+            'ma_short': self.ma_short.peek(live_close)[0],
+            'ma_long': self.ma_long.peek(live_close)[0],
+            'rsi': self.rsi.peek(live_close),
+            'macd': macd,
+            'macd_signal': signal_value,
+            'bb_upper': mean + std * std_dev,
+            'bb_lower': mean - std * std_dev,
+            'bb_middle': mean
+        }
+
+
+class DeferredFlushMixin:
+    """推迟 flush：逐条 emit 只写缓冲，由批量写线程每批调用一次 flush_batch"""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchStreamHandler(DeferredFlushMixin, logging.StreamHandler):
+    """控制台输出，按批 flush"""
+
+
+class GzipTimedRotatingFileHandler(DeferredFlushMixin, logging.handlers.TimedRotatingFileHandler):
+    """每日零点轮转的日志文件，轮转后的旧文件压缩为 .gz 归档，按批 flush"""
+
+    def __init__(self, filename, backup_count=30):
+        super().__init__(filename, when='midnight', backupCount=backup_count, encoding='utf-8')
+        self.suffix = "%Y%m%d"
+        self.extMatch = re.compile(r"^\d{8}(\.gz)?$", re.ASCII)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self.gzip_rotate
+
+    @staticmethod
+    def gzip_rotate(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+
+class BatchLogListener:
+    """后台日志写线程：批量取出 QueueHandler 入队的记录，写完一批后每个 handler 只 flush 一次
+
+    交易线程的日志调用只做一次入队，不等待磁盘和控制台。
+    """
+
+    _STOP = object()
+
+    def __init__(self, log_queue, handlers, batch_size=500, flush_interval=0.5):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """写完队列中剩余记录后退出"""
+        if self._thread is None:
+            return
+        self.queue.put(self._STOP)
+        self._thread.join(timeout=5)
+        self._thread = None
+        for handler in self.handlers:
+            handler.close()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = False
+            for record in batch:
+                if record is self._STOP:
+                    stopping = True
+                    continue
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            for handler in self.handlers:
+                try:
+                    handler.flush_batch()
+                except Exception:
+                    pass
+            if stopping:
+                return
+
+
+def journal_default(value):
+    """JSON 序列化兜底：NumPy 数值转为 Python 数值，其余转字符串"""
+    if isinstance(value, (np.integer, np.floating)):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class TradeJournal:
+    """结构化交易日志：每次信号评估、下单、成交、风控拒绝追加一行 JSON
+
+    当日记录写入 journal-YYYYMMDD.jsonl，跨日后压缩为 .jsonl.gz 归档；
+    index.json 记录每个文件的时间范围、币种、记录类型与条数，
+    查询时只打开时间范围和币种都匹配的文件。索引只在跨日和关闭时落盘，
+    未正常关闭留下的 .jsonl 文件在重新打开或归档时重新扫描。
+    """
+
+    INDEX = "index.json"
+    RESERVED_FIELDS = ('ts', 'kind', 'symbol')
+
+    def __init__(self, root="journal", flush_interval=1.0):
+        self.root = root
+        self.flush_interval = flush_interval
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._day = None
+        self._entry = None
+        self._last_flush = 0
+        self.index = self.load_index()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def load_index(self):
+        try:
+            with open(self.path(self.INDEX), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self):
+        tmp_path = self.path(self.INDEX + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path(self.INDEX))
+
+    @staticmethod
+    def _new_entry():
+        return {'start': None, 'end': None, 'count': 0, 'symbols': [], 'kinds': []}
+
+    @staticmethod
+    def _add_to_entry(entry, record):
+        ts = record['ts']
+        entry['start'] = ts if entry['start'] is None else min(entry['start'], ts)
+        entry['end'] = ts if entry['end'] is None else max(entry['end'], ts)
+        entry['count'] += 1
+        if record['symbol'] not in entry['symbols']:
+            entry['symbols'].append(record['symbol'])
+        if record['kind'] not in entry['kinds']:
+            entry['kinds'].append(record['kind'])
+
+    def _scan_entry(self, path):
+        """索引缺失时扫描文件重建条目"""
+        entry = self._new_entry()
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self._add_to_entry(entry, json.loads(line))
+                except ValueError:
+                    continue
+        return entry
+
+    def _archive(self, name):
+        """压缩已结束的日文件并更新索引（未压缩文件的索引条目可能过期，重新扫描）"""
+        path = self.path(name)
+        self.index.pop(name, None)
+        entry = self._scan_entry(path)
+        with open(path, 'rb') as src, gzip.open(path + ".gz", 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+        self.index[name + ".gz"] = entry
+
+    def _open_day(self, day):
+        """切换到 day 的日文件，之前未压缩的日文件一并归档"""
+        self._close_file()
+        name = f"journal-{day}.jsonl"
+        for stale in os.listdir(self.root):
+            if stale.endswith('.jsonl') and stale != name:
+                self._archive(stale)
+        path = self.path(name)
+        self.index[name] = self._scan_entry(path) if os.path.exists(path) else self._new_entry()
+        self._entry = self.index[name]
+        self._file = open(path, 'a', encoding='utf-8')
+        self._day = day
+        self._write_index()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def record(self, kind, symbol, **fields):
+        """追加一条记录：kind 为 signal / order / fill / risk 等
+
+        fields 不能覆盖 ts / kind / symbol，否则抛出 ValueError。
+        """
+        reserved = [key for key in self.RESERVED_FIELDS if key in fields]
+        if reserved:
+            raise ValueError(f"交易记录字段与保留字段冲突: {', '.join(reserved)}")
+        now = time.time()
+        record = {'ts': round(now, 3), 'kind': kind, 'symbol': (symbol or '').upper()}
+        record.update(fields)
+        line = json.dumps(record, ensure_ascii=False, default=journal_default)
+        day = datetime.fromtimestamp(now).strftime("%Y%m%d")
+        with self._lock:
+            if day != self._day:
+                self._open_day(day)
+            self._file.write(line + "\n")
+            self._add_to_entry(self._entry, record)
+            if now - self._last_flush >= self.flush_interval:
+                self._flush_locked(now)
+
+    def _flush_locked(self, now=None):
+        """刷新文件缓冲（索引只在跨日和关闭时写入）"""
+        if self._file is not None:
+            self._file.flush()
+        self._last_flush = now or time.time()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            if self._file is not None:
+                self._write_index()
+            self._close_file()
+            self._day = None
+
+    def query(self, symbols=None, start=None, end=None, kinds=None):
+        """按币种、时间范围（秒级时间戳）、记录类型过滤，逐条产出记录"""
+        self.flush()
+        symbols = {s.upper() for s in symbols} if symbols else None
+        kinds = set(kinds) if kinds else None
+        with self._lock:
+            entries = sorted(self.index.items(), key=lambda item: item[1]['start'] or 0)
+        for name, entry in entries:
+            if not entry['count']:
+                continue
+            if start is not None and entry['end'] < start:
+                continue
+            if end is not None and entry['start'] > end:
+                continue
+            if symbols and not symbols.intersection(entry['symbols']):
+                continue
+            if kinds and not kinds.intersection(entry['kinds']):
+                continue
+            path = self.path(name)
+            if not os.path.exists(path):
+                continue
+            opener = gzip.open if name.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if start is not None and record['ts'] < start:
+                        continue
+                    if end is not None and record['ts'] > end:
+                        continue
+                    if symbols and record['symbol'] not in symbols:
+                        continue
+                    if kinds and record['kind'] not in kinds:
+                        continue
+                    yield record
+
+
+class UiQueue:
+    """后台线程 -> Tk 主线程的有界界面更新队列
+
+    任意线程调用 post() 只入队、不阻塞；主线程定时 drain() 批量执行。
+    带 key 的更新（整表刷新）合并为最后一次；队列满时丢弃最旧的条目并计数。
+    """
+
+    def __init__(self, maxsize=2000):
+        self._calls = deque(maxlen=maxsize)
+        self._keyed = {}  # key -> (fn, args)，同 key 只保留最新一次
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def post(self, fn, *args, key=None):
+        """登记一次界面更新；key 相同的更新在下次 drain 前合并"""
+        with self._lock:
+            if key is not None:
+                self._keyed.pop(key, None)
+                self._keyed[key] = (fn, args)
+                return
+            if len(self._calls) == self._calls.maxlen:
+                self.dropped += 1
+            self._calls.append((fn, args))
+
+    def drain(self, max_calls=500):
+        """在主线程执行排队的更新，返回执行的条目数"""
+        with self._lock:
+            calls = [self._calls.popleft() for _ in range(min(max_calls, len(self._calls)))]
+            keyed = list(self._keyed.values())
+            self._keyed.clear()
+        for fn, args in calls + keyed:
+            fn(*args)
+        return len(calls) + len(keyed)
+
+
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+LogRecord = namedtuple('LogRecord', ['seq', 'timestamp', 'level', 'message'])
+
+
+class LogRingBuffer:
+    """固定容量的结构化日志环形缓冲区（线程安全），内存占用与运行时长无关
+
+    每个过滤级别维护一份增量视图：追加时按级别写入、淘汰时按序号截断，
+    切换过滤级别不需要重建整个显示文本。
+    """
+
+    def __init__(self, capacity=20000):
+        self.records = deque(maxlen=capacity)
+        self._views = {}  # 最低级别 -> 通过过滤的记录
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def append(self, level, message, timestamp=None):
+        """追加一条记录，返回 LogRecord"""
+        record = LogRecord(next(self._seq), timestamp or time.time(), level, message)
+        rank = LOG_LEVELS.get(level, LOG_LEVELS['info'])
+        with self._lock:
+            self.records.append(record)
+            oldest = self.records[0].seq
+            for min_level, view in self._views.items():
+                if rank >= min_level:
+                    view.append(record)
+                while view and view[0].seq < oldest:
+                    view.popleft()
+        return record
+
+    def _view(self, min_level):
+        view = self._views.get(min_level)
+        if view is None:
+            view = deque(r for r in self.records if LOG_LEVELS.get(r.level, 20) >= min_level)
+            self._views[min_level] = view
+        return view
+
+    def count(self, min_level=0):
+        """通过过滤的记录数"""
+        with self._lock:
+            return len(self._view(min_level))
+
+    def window(self, min_level, start, count):
+        """返回过滤后第 start 条起的 count 条记录"""
+        with self._lock:
+            view = self._view(min_level)
+            if start > len(view) // 2:
+                # 靠近尾部时从右侧截取，跟随最新日志时不必遍历整个视图
+                tail = list(itertools.islice(reversed(view), max(0, len(view) - start)))
+                return tail[::-1][:count]
+            return list(itertools.islice(view, start, start + count))
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+            self._views.clear()
+
+
+class LogConsole(ttk.Frame):
+    """虚拟化日志控制台：文本框只保留可见的若干行，滚动条按过滤后的记录数计算"""
+
+    LEVEL_COLORS = {'warning': '#b36b00', 'error': '#c00000', 'debug': '#808080'}
+
+    def __init__(self, parent, buffer, min_level='info', height=8, width=100):
+        super().__init__(parent)
+        self.buffer = buffer
+        self.min_level = LOG_LEVELS.get(min_level, LOG_LEVELS['info'])
+        self.height = height
+        self.top = 0
+        self.follow = True  # 停留在底部时跟随最新日志
+        self._linespace = None  # 行高缓存，仅在字体变化时重新测量
+        self._rows = height  # 可见行数缓存，仅在 <Configure> 时重新计算
+
+        self.text = tk.Text(self, height=height, width=width, wrap=tk.NONE, state=tk.DISABLED)
+        self.text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.on_scroll)
+        self.scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
+        self.columnconfigure(0, weight=1)
+        self.rowconfigure(0, weight=1)
+        for level, color in self.LEVEL_COLORS.items():
+            self.text.tag_configure(level, foreground=color)
+
+        self.text.bind('<MouseWheel>', lambda e: self.scroll_by(-1 if e.delta > 0 else 1, 'units'))
+        self.text.bind('<Button-4>', lambda e: self.scroll_by(-1, 'units'))
+        self.text.bind('<Button-5>', lambda e: self.scroll_by(1, 'units'))
+        self.text.bind('<Configure>', self.on_configure)
+
+    def visible_rows(self):
+        """可见行数（缓存值，刷新时不访问字体/窗口几何）"""
+        return self._rows
+
+    def on_configure(self, event=None):
+        """控件尺寸变化时重新计算可见行数并重绘"""
+        if self._linespace is None:
+            self._linespace = max(1, tkfont.Font(font=self.text.cget('font')).metrics('linespace'))
+        height = event.height if event is not None else self.text.winfo_height()
+        self._rows = max(1, height // self._linespace) if height > 1 else self.height
+        self.refresh()
+
+    def set_font(self, font):
+        """更换字体，重新测量行高"""
+        self.text.configure(font=font)
+        self._linespace = None
+        self.on_configure()
+
+    def set_level(self, level):
+        """切换显示的最低级别"""
+        self.min_level = LOG_LEVELS.get(level.lower(), LOG_LEVELS['info'])
+        self.follow = True
+        self.refresh()
+
+    def on_scroll(self, action, amount, unit=None):
+        """滚动条回调：moveto 分数 / scroll 行或页"""
+        if action == 'moveto':
+            total = self.buffer.count(self.min_level)
+            self.top = int(float(amount) * total)
+            self.follow = self.top >= total - self.visible_rows()
+            self.refresh()
+        else:
+            self.scroll_by(int(amount), unit)
+
+    def scroll_by(self, steps, unit):
+        rows = self.visible_rows()
+        self.top += steps * (rows if unit == 'pages' else 3)
+        self.follow = self.top >= self.buffer.count(self.min_level) - rows
+        self.refresh()
+        return 'break'
+
+    def refresh(self):
+        """重绘可见窗口"""
+        total = self.buffer.count(self.min_level)
+        rows = self.visible_rows()
+        if self.follow:
+            self.top = total - rows
+        self.top = max(0, min(self.top, total - rows))
+        records = self.buffer.window(self.min_level, self.top, rows)
+
+        self.text.configure(state=tk.NORMAL)
+        self.text.delete('1.0', tk.END)
+        for i, record in enumerate(records):
+            stamp = datetime.fromtimestamp(record.timestamp).strftime('%Y-%m-%d %H:%M:%S')
+            line = f"{stamp} - {record.message}" + ("\n" if i < len(records) - 1 else "")
+            self.text.insert(tk.END, line, record.level)
+        self.text.configure(state=tk.DISABLED)
+
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + rows) / total))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def clear(self):
+        self.buffer.clear()
+        self.top = 0
+        self.follow = True
+        self.refresh()
+
+
+class StaticVar:
+    """无界面运行时代替 tk 变量/输入框，只提供 get()/set()"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+# 策略权重预设配置（顺序: ma, rsi, macd, bollinger）
+PRESET_WEIGHTS = {
+    '趋势跟踪型': "2.0,1.0,1.5,1.0",
+    '震荡市型': "0.8,2.0,0.8,1.5",
+    '平衡稳健型': "1.5,1.2,1.0,0.8",
+    '激进交易型': "1.0,1.8,1.5,0.5",
+    '保守稳健型': "2.0,1.0,0.5,1.5",
+    '自定义': ""
+}
+
+
+def parse_weight_text(weights_text):
+    """把 "1.5,1.2,1.0,0.8" 解析为归一化的策略权重字典，缺失或无效项按1.0处理"""
+    weight_values = [w.strip() for w in weights_text.split(',') if w.strip()]
+    strategy_order = ['ma', 'rsi', 'macd', 'bollinger']
+    weights = {}
+
+    for i, weight_str in enumerate(weight_values[:len(strategy_order)]):
+        try:
+            weights[strategy_order[i]] = float(weight_str)
+        except ValueError:
+            weights[strategy_order[i]] = 1.0
+
+    for i in range(len(weight_values), len(strategy_order)):
+        weights[strategy_order[i]] = 1.0
+
+    total = sum(weights.values())
+    if total > 0:
+        for key in weights:
+            weights[key] = round(weights[key] / total, 4)
+    return weights
+
+
+class BacktestLedger:
+    """回测持仓与资金记录（简化：只做多、10%仓位、无杠杆/费用）"""
+
+    def __init__(self, balance=10000):
+        self.initial_balance = balance
+        self.balance = balance
+        self.positions = 0
+        self.entry_price = 0
+        self.trades = []
+
+    def check_exit(self, price, time_value, take_profit_pct=None, stop_loss_pct=None):
+        """持仓触及止盈/止损时平仓，返回是否平仓"""
+        if self.positions <= 0 or (take_profit_pct is None and stop_loss_pct is None):
+            return False
+        pnl_pct = (price - self.entry_price) / self.entry_price * 100
+        if take_profit_pct is not None and pnl_pct >= take_profit_pct:
+            self.close(price, time_value, 'take_profit')
+            return True
+        if stop_loss_pct is not None and pnl_pct <= -stop_loss_pct:
+            self.close(price, time_value, 'stop_loss')
+            return True
+        return False
+
+    def step(self, price, time_value, final_signal):
+        """按最终信号模拟执行"""
+        if final_signal == "买入" and self.positions == 0:
+            self.positions = self.balance / price * 0.1  # 10%仓位
+            self.entry_price = price
+            self.trades.append({'type': 'buy', 'price': price, 'time': time_value})
+        elif final_signal == "卖出" and self.positions > 0:
+            self.close(price, time_value, 'sell')
+
+    def close(self, price, time_value, trade_type):
+        pnl = (price - self.entry_price) / self.entry_price
+        self.balance += self.positions * price * pnl
+        self.trades.append({'type': trade_type, 'price': price, 'pnl': pnl, 'time': time_value})
+        self.positions = 0
+
+    def summary(self, include_trades=True):
+        """计算绩效"""
+        wins = len([t for t in self.trades if t.get('pnl', 0) > 0])
+        win_rate = wins / len(self.trades) if self.trades else 0
+        total_return = (self.balance - self.initial_balance) / self.initial_balance
+        result = {'win_rate': win_rate, 'total_return': total_return, 'trades': len(self.trades),
+                  'balance': self.balance}
+        if include_trades:
+            result['trade_log'] = self.trades
+        return result
+
+
+# 回测任务可从 trading_config.json 继承的配置项（不含钱包与私钥）
+BACKTEST_SETTING_KEYS = (
+    'kline_interval', 'execution_mode', 'signal_threshold', 'strategy_weights',
+    'take_profit_pct', 'stop_loss_pct', 'leverage'
+)
+
 
 class HyperliquidTradingBot:
     def __init__(self, root):
@@ -20,12 +2618,37 @@ class HyperliquidTradingBot:
         self.root.title("Hyperliquid 多策略自动化交易程序 by：8280998")
         self.root.geometry("1400x900")
 
+        # 界面更新队列：交易线程只入队，主线程定时批量刷新
+        self.ui_queue = UiQueue()
+        self.log_buffer = LogRingBuffer()  # 界面日志环形缓冲区
+        self.journal = TradeJournal()  # 结构化交易/信号记录
+        atexit.register(self.journal.close)
+        self.ui_interval_ms = 100
+        self.signal_rows = []
+
         # 交易状态变量
         self.trading_active = False
         self.current_positions = {}
         self.strategy_signals = {}
         self.config_file = "trading_config.json"
-        self.price_cache = {}
+        self.price_table = PriceTable(ttl=20)  # 监控币种价格表
+        self.http = HttpClient()  # 币安行情请求共用连接池
+        self.metrics = LatencyRecorder()  # 各阶段与外部调用耗时统计
+        self.metrics_file = os.path.join("logs", "metrics.json")
+        self.metrics_dump_interval = 60
+        self._metrics_dumped_at = 0
+        self.market_data = MarketDataEngine(self.http)  # asyncio并发行情引擎
+        self.market_data.metrics = self.metrics
+        self.metrics_server = None  # 本机 Prometheus /metrics 端点（端口为0时关闭）
+        self.signal_scores = {}  # 各币种最近一次信号评分
+        self.last_margin_state = None  # 最近一次保证金状态
+        self.market_snapshot = None  # 每轮循环共享的市场快照
+        self.live_source = BinanceRestSource(self.http)  # 实时K线数据源
+        self.kline_store = KlineStore(self.request_binance_klines)  # K线增量缓存
+        self.indicator_states = {}  # (symbol, interval) -> IndicatorState
+        self.account_cache = AccountStateCache(self.fetch_user_state)  # 账户状态缓存
+        self.asset_meta = AssetMetaIndex(self.fetch_meta)  # 资产元数据索引
+        self.symbol_configs = {}  # coins.json 与元数据合并后的币种配置
         self.historical_data = {}
         self.data_update_thread = None
         self.auto_update_active = False
@@ -34,22 +2657,25 @@ class HyperliquidTradingBot:
         self.info = None
         
 
-        # 挂单跟踪
-        self.pending_orders = {}  # 跟踪所有挂单
+        # 订单生命周期跟踪（pending_orders 为订单管理器的活动订单视图）
         self.order_timeout = 300  # 5分钟超时
+        self.order_poll_interval = 5  # 高频 tick 中订单状态查询的最小间隔（秒），新订单提交后另行尽快检查
+        self.order_manager = OrderManager(
+            self.fetch_open_orders, self.query_order_status, self.query_order_status_by_cloid,
+            self.fetch_user_fills, self.cancel_exchange_order, timeout=self.order_timeout,
+            poll_interval=self.order_poll_interval, log=self.log_message
+        )
+        self.order_manager.listeners.append(self.on_order_finished)
+        self.pending_orders = self.order_manager.orders
+        self.scheduler = TradingScheduler()  # 自动交易事件调度
+        self.trading_locks = {}  # 币种 -> 最近交易时间
+        self.cycle_count = 0
         
         # 初始化日志系统
         self.setup_logging()
         
         # 策略权重预设配置
-        self.preset_weights = {
-            '趋势跟踪型': "2.0,1.0,1.5,1.0",
-            '震荡市型': "0.8,2.0,0.8,1.5", 
-            '平衡稳健型': "1.5,1.2,1.0,0.8",
-            '激进交易型': "1.0,1.8,1.5,0.5",
-            '保守稳健型': "2.0,1.0,0.5,1.5",
-            '自定义': ""
-        }
+        self.preset_weights = dict(PRESET_WEIGHTS)
         
         # 策略权重配置
         self.strategy_weights_config = {
@@ -60,39 +2686,109 @@ class HyperliquidTradingBot:
         }
         
         self.trade_retry_count = 1
+
+        # 信号评估线程池（行情拉取与指标计算并发）
+        self.signal_workers = 8
+        self.worker_pool = None
+        self.backtest_vectorized = True  # 回测使用向量化指标计算（False 为逐根重算）
+        self.history_store = KlineFileStore()  # 本地二进制K线库
+        self.history_downloader = HistoryDownloader(self.history_store, self.http, log=self.log_message)
+        self.candle_source = self.make_candle_source("local")  # 回测数据源
         
         # 创建界面
         self.create_widgets()
+        self.root.after(self.ui_interval_ms, self.drain_ui_queue)
         
         # 加载配置
         self.load_config()
+        self.apply_metrics_port()
         self.coin_config = self.load_coin_config()
+        self.rebuild_symbol_configs()
         self.initialize_state_recovery()
 
 
+    @classmethod
+    def create_headless(cls, settings=None):
+        """创建无界面实例（回测子进程/命令行），界面变量用 StaticVar 代替"""
+        settings = settings or {}
+        bot = cls.__new__(cls)
+        bot.root = None
+        bot.journal = None
+        bot.trading_active = False
+        bot.current_positions = {}
+        bot.connection_status = False
+        bot.exchange = None
+        bot.info = None
+        bot.http = HttpClient()
+        bot.metrics = LatencyRecorder()
+        bot.signal_scores = {}
+        bot.symbol_configs = {}
+        bot.backtest_vectorized = settings.get('vectorized', True)
+        bot.history_store = KlineFileStore()
+        bot.history_downloader = HistoryDownloader(
+            bot.history_store, bot.http, WeightRateLimiter(settings.get('weight_budget', 6000)), log=bot.log_message
+        )
+        bot.candle_source = bot.make_candle_source(
+            settings.get('data_source', 'local'), settings.get('seed', 0), settings.get('sync_history', True)
+        )
+
+        bot.kline_interval_var = StaticVar(settings.get('kline_interval', '1d'))
+        bot.execution_mode_var = StaticVar(settings.get('execution_mode', 'weighted'))
+        bot.signal_threshold = StaticVar(str(settings.get('signal_threshold', '0.6')))
+        bot.take_profit_pct = StaticVar(str(settings.get('take_profit_pct', '15')))
+        bot.stop_loss_pct = StaticVar(str(settings.get('stop_loss_pct', '8')))
+        bot.leverage = StaticVar(str(settings.get('leverage', '3')))
+
+        strategies = settings.get('strategies', ('ma', 'rsi', 'macd', 'bollinger'))
+        bot.ma_strategy_var = StaticVar('ma' in strategies)
+        bot.rsi_strategy_var = StaticVar('rsi' in strategies)
+        bot.macd_strategy_var = StaticVar('macd' in strategies)
+        bot.bollinger_strategy_var = StaticVar('bollinger' in strategies)
+
+        bot.strategy_weights_config = {'ma': 0.3, 'rsi': 0.25, 'macd': 0.25, 'bollinger': 0.2}
+        if settings.get('weights'):
+            bot.strategy_weights_config.update(settings['weights'])
+        else:
+            bot.parse_strategy_weights(settings.get('strategy_weights', '1.5,1.2,1.0,0.8'))
+        return bot
+
+    def backtest_settings(self):
+        """收集当前界面上的回测相关配置（可序列化，供子进程使用）"""
+        return {
+            'kline_interval': self.kline_interval_var.get(),
+            'execution_mode': self.execution_mode_var.get(),
+            'signal_threshold': self.signal_threshold.get(),
+            'take_profit_pct': self.take_profit_pct.get(),
+            'stop_loss_pct': self.stop_loss_pct.get(),
+            'leverage': self.leverage.get(),
+            'strategies': self.enabled_strategies(),
+            'weights': dict(self.strategy_weights_config),
+            'vectorized': self.backtest_vectorized
+        }
+
     def setup_logging(self):
-        """设置完整的日志系统"""
+        """设置异步日志：调用方只入队，后台线程批量写文件/控制台，按天轮转并压缩旧日志"""
         try:
             # 创建logs目录
             log_dir = "logs"
             if not os.path.exists(log_dir):
                 os.makedirs(log_dir)
-        
-            # 按日期创建日志文件
-            current_date = datetime.now().strftime("%Y%m%d")
-            log_filename = f"{log_dir}/trading_log_{current_date}.txt"
-        
-            # 配置logging
-            logging.basicConfig(
-                level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                handlers=[
-                    logging.FileHandler(log_filename, encoding='utf-8'),
-                    logging.StreamHandler(sys.stdout)
-                ]
-            )
-        
-            self.logger = logging.getLogger(__name__)
+
+            formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+            file_handler = GzipTimedRotatingFileHandler(os.path.join(log_dir, "trading_log.txt"))
+            stream_handler = BatchStreamHandler(sys.stdout)
+            for handler in (file_handler, stream_handler):
+                handler.setFormatter(formatter)
+
+            self.log_queue = queue.Queue()
+            self.log_listener = BatchLogListener(self.log_queue, [file_handler, stream_handler])
+            self.log_listener.start()
+            atexit.register(self.log_listener.stop)
+
+            self.logger = logging.getLogger("HyperliquidTradingBot")
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+            self.logger.handlers = [logging.handlers.QueueHandler(self.log_queue)]
             self.logger.info("=" * 60)
             self.logger.info(" Hyperliquid 交易程序启动")
             self.logger.info(f"启动时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
@@ -106,10 +2802,13 @@ class HyperliquidTradingBot:
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         log_entry = f"{timestamp} - {message}"
         
-        # 输出到GUI日志框
-        self.log_text.insert(tk.END, f"{log_entry}\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        # 输出到GUI日志框（无界面模式直接打印）
+        if self.root is None:
+            if not hasattr(self, 'logger'):
+                print(log_entry)
+        else:
+            self.log_buffer.append(level, message)
+            self.ui_queue.post(self.refresh_log_console, key='log_console')
         
         # 根据级别记录到文件
         if hasattr(self, 'logger'):
@@ -122,6 +2821,19 @@ class HyperliquidTradingBot:
             else:
                 self.logger.info(message)
 
+    def drain_ui_queue(self):
+        """主线程定时执行排队的界面更新"""
+        try:
+            self.ui_queue.drain()
+        except Exception as e:
+            print(f"刷新界面时出错: {str(e)}")
+        finally:
+            self.root.after(self.ui_interval_ms, self.drain_ui_queue)
+
+    def refresh_log_console(self):
+        """重绘日志控制台可见窗口（主线程）"""
+        self.log_console.refresh()
+
     def log_trade(self, symbol, action, size, price, status, details=""):
         """记录交易详情"""
         try:
@@ -144,6 +2856,17 @@ class HyperliquidTradingBot:
         """记录风险检查"""
         risk_log = f" 风险 {symbol} | {status} | {details}"
         self.log_message(risk_log, "warning" if status != "通过" else "info")
+        if status != "通过":
+            self.journal_record('risk', symbol, status=status, details=details)
+
+    def journal_record(self, kind, symbol, **fields):
+        """写入结构化交易记录（无界面实例不记录）"""
+        if self.journal is None:
+            return
+        try:
+            self.journal.record(kind, symbol, **fields)
+        except Exception as e:
+            self.log_message(f"写入交易记录失败: {str(e)}", "debug")
 
     def create_widgets(self):
         """创建GUI组件"""
@@ -315,6 +3038,10 @@ class HyperliquidTradingBot:
         self.auto_rebalance_var = tk.BooleanVar(value=True)
         ttk.Checkbutton(center_frame, text="自动调仓", variable=self.auto_rebalance_var).grid(row=4, column=2, columnspan=2, sticky=tk.W, pady=1, padx=(5, 0))
         
+        ttk.Label(center_frame, text="指标端口:").grid(row=6, column=0, sticky=tk.W, pady=1)
+        self.metrics_port = ttk.Entry(center_frame, width=5)
+        self.metrics_port.grid(row=6, column=1, sticky=tk.W, pady=1, padx=(2, 0))
+        
         # 右侧：当前持仓
         right_frame = ttk.LabelFrame(middle_frame, text="当前持仓", padding="5")
         right_frame.grid(row=0, column=2, sticky=(tk.W, tk.E, tk.N, tk.S), padx=(5, 0))
@@ -369,6 +3096,7 @@ class HyperliquidTradingBot:
         log_level_combo.bind('<<ComboboxSelected>>', self.change_log_level)
         
         ttk.Button(control_frame, text="清空日志", command=self.clear_logs, width=8).grid(row=0, column=9, padx=(5, 0))
+        ttk.Button(control_frame, text="性能统计", command=self.show_metrics_panel, width=8).grid(row=0, column=10, padx=(5, 0))
         
         # 第四行：策略信号监控
         signal_frame = ttk.LabelFrame(main_frame, text="策略信号监控", padding="5")
@@ -403,8 +3131,8 @@ class HyperliquidTradingBot:
         log_frame.columnconfigure(0, weight=1)
         log_frame.rowconfigure(0, weight=1)
         
-        self.log_text = scrolledtext.ScrolledText(log_frame, height=8, width=100)
-        self.log_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.log_console = LogConsole(log_frame, self.log_buffer, self.log_level_var.get().lower(), height=8, width=100)
+        self.log_console.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         
         # 状态栏
         self.status_var = tk.StringVar(value="准备就绪")
@@ -423,11 +3151,12 @@ class HyperliquidTradingBot:
                 self.logger.setLevel(logging.WARNING)
             elif level == "ERROR":
                 self.logger.setLevel(logging.ERROR)
+        self.log_console.set_level(level)
         self.log_message(f"日志级别已更改为: {level}", "info")
 
     def clear_logs(self):
         """清空日志显示"""
-        self.log_text.delete(1.0, tk.END)
+        self.log_console.clear()
         self.log_message("日志显示已清空", "info")
 
     def load_coin_config(self):
@@ -540,8 +3269,11 @@ class HyperliquidTradingBot:
                 
                 self.info = Info(base_url, skip_ws=True)
                 self.log_message("✅ 对象创建成功，正在获取用户状态...", "info")
+
+                self.refresh_asset_meta(force=True)
             
                 user_state = self.info.user_state(wallet_address)
+                self.account_cache.put(user_state)
             
                 if user_state:
                     margin_summary = user_state.get('marginSummary', {})
@@ -587,6 +3319,7 @@ class HyperliquidTradingBot:
                 'margin_size': self.margin_size.get(),
                 'leverage': self.leverage.get(),
                 'check_interval': self.check_interval.get(),
+                'metrics_port': self.metrics_port.get(),
                 'auto_rebalance': self.auto_rebalance_var.get(),
                 'kline_interval': self.kline_interval_var.get(),
                 'save_time': datetime.now().isoformat()
@@ -596,6 +3329,7 @@ class HyperliquidTradingBot:
                 json.dump(config, f, indent=2, ensure_ascii=False)
         
             self.log_message("✅ 配置已保存到文件", "info")
+            self.apply_metrics_port()
         
         except Exception as e:
             self.log_message(f" 保存配置时出错: {str(e)}", "error")
@@ -639,15 +3373,24 @@ class HyperliquidTradingBot:
         except Exception as e:
             self.log_message(f"❌ 连接调试失败: {str(e)}", "error")
 
-    def update_real_positions(self):
-        """从交易所获取真实持仓"""
+    def fetch_user_state(self):
+        """向交易所请求账户状态（经 account_cache 调用）"""
+        wallet_address = self.wallet_address.get().strip()
+        with self.metrics.timer('user_state'):
+            return self.info.user_state(wallet_address)
+
+    def get_user_state(self, force=False):
+        """读取缓存的账户状态"""
+        return self.account_cache.get(force=force)
+
+    def update_real_positions(self, force=False):
+        """从交易所获取真实持仓（force 时绕过账户状态缓存）"""
         if not self.connection_status:
             return
-            
+
         try:
-            wallet_address = self.wallet_address.get().strip()
-            user_state = self.info.user_state(wallet_address)
-        
+            user_state = self.get_user_state(force=force)
+
             if user_state:
                 asset_positions = user_state.get('assetPositions', [])
             
@@ -668,39 +3411,75 @@ class HyperliquidTradingBot:
         except Exception as e:
             self.log_message(f"获取持仓时出错: {str(e)}", "error")
 
+    def fetch_meta(self):
+        """向交易所请求资产元数据（经 asset_meta 调用）"""
+        with self.metrics.timer('meta'):
+            return self.info.meta()
+
+    def refresh_asset_meta(self, force=False):
+        """加载或定时刷新资产元数据索引，并与 coins.json 配置合并"""
+        if self.info is None:
+            return
+        if not force and not self.asset_meta.is_stale():
+            return
+        try:
+            count = self.asset_meta.load()
+            self.rebuild_symbol_configs()
+            self.log_message(f"资产元数据已加载: {count}个资产", "debug")
+        except Exception as e:
+            self.log_message(f" 加载资产元数据失败: {str(e)}", "warning")
+
+    def rebuild_symbol_configs(self):
+        """合并 coins.json trading_config 与交易所元数据，生成按币种索引的配置"""
+        trading_config = self.coin_config.get("trading_config", {})
+        default_config = trading_config.get("DEFAULT", {})
+        coins = set(trading_config) | set(self.asset_meta.names())
+        coins.discard("DEFAULT")
+
+        configs = {}
+        for coin in coins:
+            record = self.asset_meta.get(coin)
+            if coin in trading_config:
+                config = dict(trading_config[coin])
+            else:
+                config = dict(default_config)
+                # coins.json 未配置的币种使用交易所精度与杠杆
+                if record is not None:
+                    config['price_precision'] = record.px_decimals
+                    config['size_precision'] = record.sz_decimals
+                    config['min_size'] = 10 ** -record.sz_decimals
+                    if record.max_leverage:
+                        config['max_leverage'] = record.max_leverage
+            if record is not None:
+                config['px_decimals'] = record.px_decimals
+                config['sz_decimals'] = record.sz_decimals
+                config['exchange_max_leverage'] = record.max_leverage
+                config['asset_index'] = record.index
+            configs[coin] = config
+
+        self.symbol_configs = configs
+
+    def get_symbol_config(self, symbol):
+        """获取币种交易配置（精度、最小数量、杠杆），无配置时返回 DEFAULT"""
+        config = self.symbol_configs.get(symbol.upper())
+        if config is None:
+            config = self.coin_config.get("trading_config", {}).get("DEFAULT", {})
+        return config
+
     def get_price_precision(self, symbol):
-        """从配置获取价格精度 (优先 SDK meta pxDecimals, fallback coins.json)"""
+        """获取价格精度 (优先交易所元数据 pxDecimals, fallback coins.json)"""
         try:
-            # 优先 SDK meta
-            if self.connection_status and hasattr(self, 'info'):
-                meta = self.info.meta()
-                coin = f"{symbol.upper()}"
-            
-                if 'universe' in meta:
-                    for asset in meta['universe']:
-                        if asset.get('name') == coin:
-                            px_decimals = asset.get('pxDecimals', 4)
-                            return px_decimals
-            
-            # Fallback coins.json
-            trading_config = self.coin_config.get("trading_config", {})
-            symbol_config = trading_config.get(symbol.upper(), {})
-        
+            record = self.asset_meta.get(symbol.upper())
+            if record is not None:
+                return record.px_decimals
+
+            symbol_config = self.symbol_configs.get(symbol.upper(), {})
             if "price_precision" in symbol_config:
-                precision = symbol_config["price_precision"]
-                return precision
-        
-            if not hasattr(self, '_price_precisions'):
-                self._price_precisions = {}
-        
-            if symbol in self._price_precisions:
-                return self._price_precisions[symbol]
-        
+                return symbol_config["price_precision"]
+
             # 默认
-            default_precision = 4
-            self._price_precisions[symbol] = default_precision
-            return default_precision
-        
+            return 4
+
         except Exception as e:
             self.log_message(f"获取价格精度失败 {symbol}: {str(e)}", "error")
             return 4
@@ -711,8 +3490,7 @@ class HyperliquidTradingBot:
             if not self.connection_status:
                 return False, "未连接交易所", 0
 
-            wallet_address = self.wallet_address.get().strip()
-            user_state = self.info.user_state(wallet_address)
+            user_state = self.get_user_state()
             margin_summary = user_state.get('marginSummary', {})
             total_margin_used = float(margin_summary.get('totalMarginUsed', 0))
             account_value = float(margin_summary.get('accountValue', 0))
@@ -782,8 +3560,11 @@ class HyperliquidTradingBot:
             self.log_message(f"❌ 风险检查出错: {str(e)}", "error")
             return False, "检查出错", 0
 
-    def calculate_position_size(self, symbol, is_long=True, available_margin=None, current_position_size=0):
-        """计算仓位大小 - 支持增量加仓 + 确认 json 配置"""
+    def calculate_position_size(self, symbol, is_long=True, available_margin=None, current_position_size=0, freed_margin=0):
+        """计算仓位大小 - 支持增量加仓 + 确认 json 配置
+
+        freed_margin: 同一批量下单中先行平仓将释放的保证金
+        """
         try:
             if not self.connection_status:
                 return 0
@@ -795,11 +3576,14 @@ class HyperliquidTradingBot:
 
             
             # 获取账户信息
-            wallet_address = self.wallet_address.get().strip()
-            user_state = self.info.user_state(wallet_address)
+            user_state = self.get_user_state()
             margin_summary = user_state.get('marginSummary', {})
             account_value = float(margin_summary.get('accountValue', 100))
             total_margin_used = float(margin_summary.get('totalMarginUsed', 0))
+            if freed_margin:
+                total_margin_used = max(0, total_margin_used - freed_margin)
+                if available_margin is not None:
+                    available_margin += freed_margin
             
             # 前置检查：总保证金限制
             total_margin_limit = float(self.total_margin_pct.get() or 60)
@@ -819,8 +3603,7 @@ class HyperliquidTradingBot:
                 return 0
             
             # 从 coins.json 获取配置 + 日志确认
-            trading_config = self.coin_config.get("trading_config", {})
-            symbol_config = trading_config.get(symbol.upper(), trading_config.get("DEFAULT", {}))
+            symbol_config = self.get_symbol_config(symbol)
             self.log_message(f"🔍 {symbol} 配置加载: {symbol_config}", "debug")
             
             configured_leverage = float(self.leverage.get() or 3)
@@ -834,7 +3617,7 @@ class HyperliquidTradingBot:
             single_coin_max_margin = account_value * (max_margin_pct / 100)
             
             # 修复：计算当前仓位已用单币保证金（增量）
-            current_price_data = self.get_stable_real_time_price(symbol)
+            current_price_data = self.get_execution_price(symbol)
             if not current_price_data:
                 return 0
             current_price = float(current_price_data['price'])
@@ -933,88 +3716,84 @@ class HyperliquidTradingBot:
 
     # 挂单管理相关方法
     def has_pending_order_for_symbol(self, symbol, side):
-        """检查是否已有相同方向的挂单 - 增强检查"""
-        if not hasattr(self, 'pending_orders') or not self.pending_orders:
-            return False
-            
-        current_time = time.time()
-        pending_count = 0
-        
-        for order_id, order_info in list(self.pending_orders.items()):
-            # 清理过期的挂单记录（超过10分钟）
-            if current_time - order_info['timestamp'] > 600:
-                self.log_message(f" 清理过期挂单记录: {symbol} {order_info['side']}", "debug")
-                del self.pending_orders[order_id]
-                continue
-                
-            if (order_info['symbol'] == symbol and 
-                order_info['side'] == side and 
-                order_info['status'] == 'pending'):
-                pending_count += 1
-                self.log_message(f"发现已有挂单: {symbol} {side} (共{pending_count}个)", "debug")
-        
-        return pending_count > 0
-
-    def track_pending_order(self, symbol, order_id, side, size, price):
-        """跟踪挂单"""
-        if not hasattr(self, 'pending_orders'):
-            self.pending_orders = {}
-    
-        self.pending_orders[order_id] = {
-            'symbol': symbol,
-            'side': side,
-            'size': size,
-            'price': price,
-            'timestamp': time.time(),
-            'status': 'pending'
-        }
-        self.log_message(f"开始跟踪挂单 {symbol} {side} {size} @ {price}", "info")
-
-    def check_pending_orders(self):
-        """检查所有挂单状态 - 更频繁检查"""
-        if not hasattr(self, 'pending_orders') or not self.pending_orders:
-            return
-    
-        completed_orders = []
-        current_time = time.time()
-        
-        for order_id, order_info in list(self.pending_orders.items()):
-            try:
-                symbol = order_info['symbol']
-                
-                # 检查订单状态
-                order_status = self.exchange.order_status(symbol, order_id)
-            
-                if order_status.get('status') == 'filled':
-                    self.log_message(f"✅ 挂单成交: {symbol} {order_info['side']} {order_info['size']}", "info")
-                    completed_orders.append(order_id)
-                elif order_status.get('status') == 'cancelled':
-                    self.log_message(f"❌ 挂单取消: {symbol}", "warning")
-                    completed_orders.append(order_id)
-                elif order_status.get('status') == 'pending':
-                    # 检查是否超时（超过5分钟）
-                    if current_time - order_info['timestamp'] > self.order_timeout:
-                        self.log_message(f"挂单超时: {symbol}，尝试取消", "warning")
-                        try:
-                            self.exchange.cancel_order(symbol, order_id)
-                            completed_orders.append(order_id)
-                        except Exception as e:
-                            self.log_message(f"❌ 取消挂单失败 {symbol}: {str(e)}", "error")
-                else:
-                    # 未知状态，保留记录但记录警告
-                    self.log_message(f"挂单未知状态: {symbol} {order_status.get('status')}", "warning")
-            
-            except Exception as e:
-                self.log_message(f"❌ 检查挂单状态失败 {order_info['symbol']}: {str(e)}", "error")
-                # 如果检查失败超过10分钟，清理记录
-                if current_time - order_info['timestamp'] > 600:
-                    self.log_message(f"清理无法检查的挂单记录: {order_info['symbol']}", "warning")
-                    completed_orders.append(order_id)
-    
-        # 移除已完成订单
-        for order_id in completed_orders:
-            if order_id in self.pending_orders:
-                del self.pending_orders[order_id]
+        """检查是否已有相同方向的活动订单"""
+        orders = self.order_manager.active(symbol, side)
+        if orders:
+            self.log_message(f"发现已有挂单: {symbol} {side} (共{len(orders)}个)", "debug")
+        return bool(orders)
+
+    def track_pending_order(self, symbol, order_id, side, size, price, cloid=None):
+        """登记订单到订单管理器（order_id 为 None 时按 cloid / 成交记录确认）"""
+        self.order_manager.track(symbol, side, size, price, oid=order_id, cloid=cloid)
+        if order_id is not None:
+            self.log_message(f"开始跟踪挂单 {symbol} {side} {size} @ {price}", "info")
+        else:
+            self.log_message(f"⏳ {symbol} {side} {size} 已提交，等待成交确认", "info")
+
+    def check_pending_orders(self, force=False):
+        """推进订单状态机（不阻塞）"""
+        if self.pending_orders:
+            self.order_manager.poll(force=force)
+
+    def on_order_finished(self, order):
+        """订单结束（成交/撤销/拒绝/未知）回调：记录并刷新账户状态
+
+        未成交或结果未知的订单不自动重下：登记事件，由下一轮完整周期
+        按最新持仓重新评估信号与风控后决定是否下单。
+        """
+        symbol = order['symbol']
+        self.journal_record(
+            'fill' if order['status'] == ORDER_FILLED else 'order_end', symbol,
+            side=order['side'], size=order['filled'] or order['size'], price=order['price'],
+            oid=order['oid'], status=order['status'], elapsed=round(order['updated'] - order['timestamp'], 3)
+        )
+        if order['status'] == ORDER_FILLED:
+            self.log_trade(symbol, order['side'], order['filled'] or order['size'], order['price'] or 0, "完全成交")
+        elif order['status'] == ORDER_CANCELLED:
+            self.log_message(f"❌ 挂单取消: {symbol}", "warning")
+        elif order['status'] == ORDER_UNKNOWN:
+            self.log_trade(symbol, order['side'], order['size'], order['price'] or 0, "未知",
+                           "无法确认是否成交，已同步持仓，不自动重下")
+        else:
+            self.log_trade(symbol, order['side'], order['size'], order['price'] or 0, "拒绝",
+                           "下一轮重新评估信号与风控")
+        # 挂单成交或撤销后账户状态已变化
+        self.account_cache.invalidate()
+        if order['status'] in (ORDER_FILLED, ORDER_UNKNOWN):
+            self.update_real_positions()
+        self.scheduler.notify('fill' if order['status'] == ORDER_FILLED else 'order_end')
+
+    def fetch_open_orders(self):
+        """向交易所查询当前挂单（经 order_manager 调用）"""
+        with self.metrics.timer('open_orders'):
+            return self.info.open_orders(self.wallet_address.get().strip())
+
+    def query_order_status(self, oid):
+        """按订单号查询订单状态（经 order_manager 调用）"""
+        with self.metrics.timer('query_order'):
+            return self.info.query_order_by_oid(self.wallet_address.get().strip(), oid)
+
+    def query_order_status_by_cloid(self, cloid):
+        """按客户端订单号查询订单状态（经 order_manager 调用）"""
+        with self.metrics.timer('query_order'):
+            return self.info.query_order_by_cloid(self.wallet_address.get().strip(), self.sdk_cloid(cloid))
+
+    def fetch_user_fills(self, since_ms):
+        """查询指定时间之后的成交记录（经 order_manager 调用）"""
+        with self.metrics.timer('user_fills'):
+            return self.info.user_fills_by_time(self.wallet_address.get().strip(), since_ms)
+
+    def sdk_cloid(self, cloid):
+        """十六进制 cloid -> SDK Cloid 对象"""
+        from hyperliquid.utils.types import Cloid
+        return Cloid.from_str(cloid)
+
+    def cancel_exchange_order(self, symbol, oid):
+        """撤销挂单（经 order_manager 调用）"""
+        with self.metrics.timer('cancel'):
+            result = self.exchange.cancel(symbol, oid)
+        self.account_cache.invalidate()
+        return result
 
     def get_effective_margin_usage(self):
         """获取有效保证金使用率（包括挂单占用）"""
@@ -1026,11 +3805,11 @@ class HyperliquidTradingBot:
         
             # 计算挂单占用的保证金
             pending_margin = 0
-            if hasattr(self, 'pending_orders') and self.pending_orders:
-                for order_id, order_info in self.pending_orders.items():
-                    # 估算挂单保证金占用
-                    order_margin = (abs(order_info['size']) * order_info['price']) / float(self.leverage.get() or 3)
-                    pending_margin += order_margin
+            for order_info in self.order_manager.active():
+                # 估算挂单未成交部分的保证金占用
+                remaining = max(0.0, abs(order_info['size']) - order_info['filled'])
+                order_margin = (remaining * (order_info['price'] or 0)) / float(self.leverage.get() or 3)
+                pending_margin += order_margin
         
             total_effective_used = base_used + pending_margin
             effective_ratio = (total_effective_used / account_value) * 100 if account_value > 0 else 0
@@ -1054,14 +3833,8 @@ class HyperliquidTradingBot:
             return self.get_current_margin_state()
 
     def has_pending_orders_for_token(self, token):
-        """检查指定币种是否有任何方向的挂单"""
-        if not hasattr(self, 'pending_orders') or not self.pending_orders:
-            return False
-            
-        for order_id, order_info in self.pending_orders.items():
-            if order_info['symbol'] == token and order_info['status'] == 'pending':
-                return True
-        return False
+        """检查指定币种是否有任何方向的活动订单"""
+        return bool(self.order_manager.active(token))
 
     def execute_signal_trade(self, symbol, final_signal, position_info, current_price, signal_strength=None, available_margin=None):
         """信号驱动交易 - 修复版本"""
@@ -1093,7 +3866,7 @@ class HyperliquidTradingBot:
             available_margin = risk_available_margin
 
         if not risk_ok:
-            self.log_message(f" 最终风险检查未通过: {risk_msg}，取消交易", "warning")
+            self.log_risk(symbol, "拒绝", f"最终风险检查未通过: {risk_msg}，取消交易")
             return
 
         if self.check_single_coin_position_limit(symbol, final_signal, position_info):
@@ -1125,20 +3898,10 @@ class HyperliquidTradingBot:
                 else:
                     self.log_message(f" {symbol} 计算仓位过小，跳过开多", "warning")
             elif is_short:
-                self.log_message(f"🔄 {symbol} 调仓: 先平空仓再开多仓", "info")
-                close_success = self.execute_close_position(symbol, size)
-                if close_success:
-                    time.sleep(2)
-                    self.update_real_positions()
-                    current_position = self.current_positions.get(symbol, {})
-                    current_size = current_position.get('size', 0)
-                    if abs(current_size) < 0.001:
-                        new_size = self.calculate_position_size(symbol, is_long=True, available_margin=available_margin)
-                        if abs(new_size) > 0.01:
-                            self.log_message(f"🟢 {symbol} 开立多仓，数量: {new_size:.4f}", "info")
-                            result = self.execute_trade(symbol, "buy", new_size, "market")
-                            if result == "pending":
-                                self.log_message(f"⏳ {symbol} 买入订单已挂单", "info")
+                self.log_message(f"🔄 {symbol} 调仓: 平空仓并开多仓（先平后开）", "info")
+                result = self.execute_flip(symbol, size, is_long=True, available_margin=available_margin)
+                if result == "pending":
+                    self.log_message(f"⏳ {symbol} 反手订单待确认", "info")
             else:
                 self.log_message(f"🟢 {symbol} 加多仓信号，当前多头持仓", "info")
                 add_size = self.calculate_position_size(symbol, is_long=True, available_margin=available_margin)
@@ -1161,20 +3924,10 @@ class HyperliquidTradingBot:
                 else:
                     self.log_message(f" {symbol} 计算空仓数量过小，跳过开空", "warning")
             elif is_long:
-                self.log_message(f"🔄 {symbol} 调仓: 先平多仓再开空仓", "info")
-                close_success = self.execute_close_position(symbol, size)
-                if close_success:
-                    time.sleep(2)
-                    self.update_real_positions()
-                    current_position = self.current_positions.get(symbol, {})
-                    current_size = current_position.get('size', 0)
-                    if abs(current_size) < 0.001:
-                        new_size = self.calculate_position_size(symbol, is_long=False, available_margin=available_margin)
-                        if abs(new_size) > 0.01:
-                            self.log_message(f"🔴 {symbol} 开立空仓，数量: {abs(new_size):.4f}", "info")
-                            result = self.execute_trade(symbol, "sell", abs(new_size), "market")
-                            if result == "pending":
-                                self.log_message(f"⏳ {symbol} 卖出订单已挂单", "info")
+                self.log_message(f"🔄 {symbol} 调仓: 平多仓并开空仓（先平后开）", "info")
+                result = self.execute_flip(symbol, size, is_long=False, available_margin=available_margin)
+                if result == "pending":
+                    self.log_message(f"⏳ {symbol} 反手订单待确认", "info")
             else:
                 self.log_message(f"🔴 {symbol} 加空仓信号，当前空头持仓", "info")
                 add_size = self.calculate_position_size(symbol, is_long=False, available_margin=available_margin)
@@ -1189,8 +3942,8 @@ class HyperliquidTradingBot:
         else:
             self.log_message(f"🟡 {symbol} 持有信号，不执行操作", "info")
 
-    def execute_trade(self, symbol, side, size, order_type="market", price=None, retry_count=None):
-        """执行交易订单 - 加强挂单检查"""
+    def execute_trade(self, symbol, side, size, order_type="market", price=None):
+        """执行交易订单（不阻塞）：成交返回 True，挂单/待确认返回 "pending"，由订单管理器跟踪"""
         if not self.connection_status:
             self.log_message("❌ 请先连接交易所", "error")
             return False
@@ -1226,8 +3979,7 @@ class HyperliquidTradingBot:
 
         # 新增检查：从交易所获取实际挂单状态
         try:
-            wallet_address = self.wallet_address.get().strip()
-            user_state = self.info.user_state(wallet_address)
+            user_state = self.get_user_state()
             open_orders = user_state.get('openOrders', [])
             
             pending_orders_count = 0
@@ -1245,8 +3997,7 @@ class HyperliquidTradingBot:
             self.log_message(f"检查交易所挂单状态失败: {str(e)}", "warning")
 
         # 新增：最终数量验证
-        trading_config = self.coin_config.get("trading_config", {})
-        symbol_config = trading_config.get(symbol.upper(), trading_config.get("DEFAULT", {}))
+        symbol_config = self.get_symbol_config(symbol)
         
         size_precision = symbol_config.get("size_precision", 2)
         min_size = symbol_config.get("min_size", 0.01)
@@ -1258,145 +4009,233 @@ class HyperliquidTradingBot:
         # 关键修复：对于精度为0的代币，确保是整数
         if size_precision == 0:
             size = int(size)
-            if size == 0:
-                size = 1 if side.lower() == "buy" else -1
-        
-        # 检查最小交易量
-        if abs(size) < min_size:
-            self.log_message(f"{symbol} 交易数量过小: {original_size} -> {size} < 最小要求 {min_size}", "error")
-            return False
+            if size == 0:
+                size = 1 if side.lower() == "buy" else -1
+        
+        # 检查最小交易量
+        if abs(size) < min_size:
+            self.log_message(f"{symbol} 交易数量过小: {original_size} -> {size} < 最小要求 {min_size}", "error")
+            return False
+
+        # 记录调整后的数量
+        if original_size != size:
+            self.log_message(f"🔧 {symbol} 数量精度调整: {original_size} -> {size} (精度: {size_precision})", "info")
+
+        old_position = self.current_positions.get(symbol, {}).get('size', 0)
+        self.log_message(f"📊 {symbol} 交易前持仓: {old_position}", "info")
+        cloid = new_cloid()  # 响应丢失时按客户端订单号确认结果
+
+        is_buy = (side.lower() == "buy")
+        coin = f"{symbol.upper()}"
+        trade_price = price or 0
+        try:
+            # 从 json 获取精度
+            precision = symbol_config.get("price_precision", 4)
+            tick_size = 10 ** (-precision)
+            self.log_message(f"🔍 {symbol} tick_size: {tick_size} (precision: {precision})", "debug")
+
+            if order_type == "market":
+                self.log_message(f"🔄 {symbol} Market {side} {size} (SDK market_open)", "info")
+                price_data = self.get_execution_price(symbol)
+                trade_price = price_data['price'] if price_data else 0  # 仅用于记录与保证金估算
+                with self.metrics.timer('market_open'):
+                    order_result = self.exchange.market_open(coin, is_buy, size, cloid=self.sdk_cloid(cloid))
+            else:
+                if price is None:
+                    price_data = self.get_execution_price(symbol)
+                    price = price_data['price'] if price_data else 0
+
+                if price == 0:
+                    self.log_message(f"❌ 无法获取 {symbol} 的有效价格", "error")
+                    return False
+
+                snapped_price = round(price / tick_size) * tick_size
+                snapped_price = round(snapped_price, precision)
+                trade_price = snapped_price
+                order_type_config = {"limit": {"tif": "Gtc"}}
+                with self.metrics.timer('order'):
+                    order_result = self.exchange.order(coin, is_buy, size, trade_price, order_type_config,
+                                                       cloid=self.sdk_cloid(cloid))
+                self.log_message(f"🔧 {symbol} Limit snap价格: ${trade_price:.{precision}f} (原: ${price:.4f})", "info")
+
+        except Exception as e:
+            # 请求异常时订单可能已到达交易所：登记为待确认，由订单管理器按 cloid / 成交记录判定
+            self.account_cache.invalidate()
+            self.log_message(f" 交易提交异常 {symbol}: {str(e)}，等待成交确认", "error")
+            self.journal_record('order', symbol, side=side, size=size, price=trade_price, cloid=cloid, error=str(e))
+            self.track_pending_order(symbol, None, side, size, trade_price, cloid)
+            return "pending"
+
+        # 下单后账户状态已变化，使缓存失效
+        self.account_cache.invalidate()
+        self.log_message(f"🔧 交易参数: {symbol} 数量{size} 类型{order_type}", "debug")
+
+        statuses = self.order_result_statuses(symbol, order_result)
+        result = self.apply_order_status(symbol, side, size, trade_price, statuses[0] if statuses else {}, cloid)
+        if result is True:
+            #  成交即时同步持仓（缓存已失效，重新获取一次）
+            self.update_real_positions()
+        return result
+
+    def order_result_statuses(self, symbol, order_result):
+        """取出下单响应中逐笔订单的 statuses，API 报错时返回空列表"""
+        if order_result and order_result.get("status") == "ok":
+            return order_result["response"]["data"].get("statuses", [])
+        response = order_result.get('response') if order_result else 'No response'
+        error_msg = response.get('error', 'Unknown error') if isinstance(response, dict) else response
+        self.log_message(f" {symbol} API返回错误，等待成交确认: {error_msg}", "warning")
+        return []
+
+    def apply_order_status(self, symbol, side, size, trade_price, status, cloid=None):
+        """按单笔订单状态登记结果：成交 True，挂单/待确认 "pending"，拒绝 False（拒绝不自动重试）"""
+        self.journal_record('order', symbol, side=side, size=size, price=trade_price, cloid=cloid, status=status or None)
+        if "resting" in status:
+            order_id = status['resting']['oid']
+            self.log_trade(symbol, side, size, trade_price, "挂单", f"订单号: {order_id}")
+            self.track_pending_order(symbol, order_id, side, size, trade_price, cloid)
+            return "pending"
+
+        if "filled" in status:
+            filled_size = status['filled']['totalSz']
+            fill_price = status['filled'].get('avgPx', trade_price)
+            self.log_trade(symbol, side, filled_size, fill_price, "完全成交")
+            self.journal_record('fill', symbol, side=side, size=float(filled_size), price=float(fill_price),
+                                oid=status['filled'].get('oid'))
+            return True
+
+        if "error" in status:
+            error_msg = status["error"]
+            self.log_trade(symbol, side, size, trade_price, "拒绝", f"错误: {error_msg}")
+            return False
+
+        if status:
+            self.log_message(f" {symbol} 订单未知状态: {status}，等待成交确认", "warning")
+        self.log_trade(symbol, side, size, trade_price, "处理中")
+        self.track_pending_order(symbol, None, side, size, trade_price, cloid)
+        return "pending"
+
+    def round_order_size(self, symbol, size):
+        """按币种精度取整下单数量（绝对值），低于最小交易量返回 0"""
+        symbol_config = self.get_symbol_config(symbol)
+        size_precision = symbol_config.get("size_precision", 2)
+        min_size = symbol_config.get("min_size", 0.01)
+        size = round(abs(float(size)), size_precision)
+        if size_precision == 0:
+            size = int(size)
+        return size if size >= min_size else 0
 
-        # 记录调整后的数量
-        if original_size != size:
-            self.log_message(f"🔧 {symbol} 数量精度调整: {original_size} -> {size} (精度: {size_precision})", "info")
+    def execute_batch(self, legs, slippage=DEFAULT_SLIPPAGE):
+        """多笔订单一次 bulk_orders 提交（IOC 滑点限价，模拟市价单）
 
-        #  修复：减少重试次数，增加重试间隔
-        if retry_count is None:
-            retry_count = 1  # 只重试1次，总共2次尝试
-        max_retries = retry_count + 1
+        legs: [{'symbol', 'side', 'size', 'reduce_only'}]，各笔结果互不依赖；
+        需要先确认前一笔成交的组合（如反手）应分次调用。返回与 legs 对应的结果列表
+        （True 成交 / "pending" 待确认 / False 拒绝或未提交）。
+        """
+        results = [False] * len(legs)
+        if not self.connection_status:
+            self.log_message("❌ 请先连接交易所", "error")
+            return results
+
+        order_requests, submitted = [], []
+        for i, leg in enumerate(legs):
+            symbol = leg['symbol']
+            size = self.round_order_size(symbol, leg['size'])
+            if size <= 0:
+                self.log_message(f"{symbol} 交易数量过小: {leg['size']}，跳过该笔", "warning")
+                continue
+            price_data = self.get_execution_price(symbol)
+            if not price_data or price_data['price'] <= 0:
+                self.log_message(f"❌ 无法获取 {symbol} 的有效价格，跳过该笔", "error")
+                continue
 
-        #  修复：记录交易前的持仓状态
-        old_position = self.current_positions.get(symbol, {}).get('size', 0)
-        self.log_message(f"📊 {symbol} 交易前持仓: {old_position}", "info")
+            is_buy = leg['side'] == "buy"
+            symbol_config = self.get_symbol_config(symbol)
+            sz_decimals = symbol_config.get("sz_decimals", symbol_config.get("size_precision", 2))
+            limit_px = slippage_price(price_data['price'], is_buy, sz_decimals, slippage)
+            cloid = new_cloid()
+
+            order_requests.append({
+                'coin': symbol.upper(),
+                'is_buy': is_buy,
+                'sz': size,
+                'limit_px': limit_px,
+                'order_type': {'limit': {'tif': 'Ioc'}},
+                'reduce_only': bool(leg.get('reduce_only', False)),
+                'cloid': self.sdk_cloid(cloid),
+            })
+            submitted.append((i, leg['side'], size, limit_px, cloid))
+
+        if not order_requests:
+            return results
+
+        summary = ", ".join(f"{r['coin']} {'买' if r['is_buy'] else '卖'}{r['sz']}{'(只减仓)' if r['reduce_only'] else ''}"
+                            for r in order_requests)
+        self.log_message(f"🔄 批量下单 {len(order_requests)}笔: {summary}", "info")
+        try:
+            with self.metrics.timer('bulk_orders'):
+                order_result = self.exchange.bulk_orders(order_requests)
+            statuses = self.order_result_statuses("批量订单", order_result)
+        except Exception as e:
+            self.log_message(f" 批量下单提交异常: {str(e)}，等待成交确认", "error")
+            statuses = []
+        # 下单后账户状态已变化，使缓存失效
+        self.account_cache.invalidate()
 
-        for attempt in range(max_retries):
-            try:
-                is_buy = (side.lower() == "buy")
-                coin = f"{symbol.upper()}"
-
-                #  再次检查挂单状态（防止在重试期间出现新挂单）
-                if self.has_pending_order_for_symbol(symbol, side):
-                    self.log_message(f" {symbol} 重试期间出现新挂单，取消重试", "warning")
-                    return "pending"
-
-                # 从 json 获取精度
-                precision = symbol_config.get("price_precision", 4)
-                tick_size = 10 ** (-precision)
-                self.log_message(f"🔍 {symbol} tick_size: {tick_size} (precision: {precision})", "debug")
-
-                if order_type == "market":
-                    self.log_message(f"🔄 {symbol} Market {side} {size} (SDK market_open)", "info")
-                    order_result = self.exchange.market_open(coin, is_buy, size)
-                    trade_price = 0
-                else:
-                    if price is None:
-                        price_data = self.get_stable_real_time_price(symbol)
-                        price = price_data['price'] if price_data else 0
-                    
-                    if price == 0:
-                        self.log_message(f"❌ 无法获取 {symbol} 的有效价格", "error")
-                        return False
-
-                    snapped_price = round(price / tick_size) * tick_size
-                    snapped_price = round(snapped_price, precision)
-                    trade_price = snapped_price
-                    order_type_config = {"limit": {"tif": "Gtc"}}
-                    order_result = self.exchange.order(coin, is_buy, size, trade_price, order_type_config)
-                    self.log_message(f"🔧 {symbol} Limit snap价格: ${trade_price:.{precision}f} (原: ${price:.4f})", "info")
-
-                self.log_message(f"🔧 交易参数: {symbol} 数量{size} 类型{order_type}", "debug")
-                self.log_message(f"🔄 交易尝试 {attempt+1}/{max_retries}: {side} {size} {symbol} ({order_type})", "info")
-
-                if order_result and order_result.get("status") == "ok":
-                    statuses = order_result["response"]["data"]["statuses"]
-                    if statuses:
-                        status = statuses[0]
-                    
-                        if "resting" in status:
-                            order_id = status['resting']['oid']
-                            self.log_trade(symbol, side, size, trade_price, "挂单", f"订单号: {order_id}")
-                            self.track_pending_order(symbol, order_id, side, size, trade_price)
-                            return "pending"
-                        
-                        elif "filled" in status:
-                            filled_size = status['filled']['totalSz']
-                            self.log_trade(symbol, side, filled_size, trade_price, "完全成交")
-                            #  立即更新持仓状态
-                            time.sleep(3)
-                            self.update_real_positions()
-                            return True
-                        
-                        elif "error" in status:
-                            error_msg = status["error"]
-                            raise ValueError(f"订单错误: {error_msg}")
-                        else:
-                            self.log_message(f" {symbol} 订单未知状态: {status}", "warning")
-                            time.sleep(5)
-                            self.update_real_positions()
-                            new_position = self.current_positions.get(symbol, {}).get('size', 0)
-                            if new_position != old_position:
-                                self.log_message(f"✅ {symbol} 实际持仓已变化: {old_position} -> {new_position}", "info")
-                                return True
-                            continue
-                    
-                    self.log_trade(symbol, side, size, trade_price, "处理中", f"尝试{attempt+1}")
-                    
-                    wait_time = 8 if attempt == 0 else 12
-                    self.log_message(f"⏳ 等待 {wait_time} 秒确认订单状态...", "info")
-                    time.sleep(wait_time)
-                    
-                    self.update_real_positions()
-                    new_position = self.current_positions.get(symbol, {}).get('size', 0)
-                    
-                    if new_position != old_position:
-                        actual_change = new_position - old_position
-                        self.log_message(f"✅ {symbol} 持仓确认: {old_position} -> {new_position} (变化: {actual_change})", "info")
-                        return True
-                    else:
-                        self.log_message(f" {symbol} 订单接受但持仓未变化，可能为挂单", "warning")
-                        if attempt < max_retries - 1:
-                            self.log_message(f"🔄 准备第{attempt+2}次尝试...", "info")
-                        return "pending" if attempt < max_retries - 1 else False
-                
-                else:
-                    error_msg = order_result.get('response', {}).get('error', 'Unknown error') if order_result else 'No response'
-                    self.log_message(f" {symbol} API返回错误，检查实际成交: {error_msg}", "warning")
-                    time.sleep(5)
-                    self.update_real_positions()
-                    new_position = self.current_positions.get(symbol, {}).get('size', 0)
-                    if new_position != old_position:
-                        self.log_message(f"✅ {symbol} 实际已成交，忽略API错误", "info")
-                        return True
-                    else:
-                        raise ValueError(f"订单失败: {error_msg}")
-            
-            except Exception as e:
-                self.log_message(f" 交易尝试{attempt+1}失败 {symbol}: {str(e)}", "error")
-                time.sleep(5)
-                self.update_real_positions()
-                new_position = self.current_positions.get(symbol, {}).get('size', 0)
-                if new_position != old_position:
-                    self.log_message(f"✅ {symbol} 实际已成交，忽略异常", "info")
-                    return True
-                    
-                if attempt < max_retries - 1:
-                    retry_delay = 10
-                    self.log_message(f" {retry_delay}秒后进行第{attempt+2}次尝试...", "info")
-                    time.sleep(retry_delay)
-                else:
-                    self.log_trade(symbol, side, size, trade_price if 'trade_price' in locals() else price, "最终失败", f"错误: {str(e)}")
-                    return False
-        return False
+        for n, (i, side, size, limit_px, cloid) in enumerate(submitted):
+            status = statuses[n] if n < len(statuses) else {}
+            results[i] = self.apply_order_status(legs[i]['symbol'], side, size, limit_px, status, cloid)
+
+        if any(result is True for result in results):
+            self.update_real_positions()
+        return results
+
+    def execute_flip(self, symbol, position_size, is_long, available_margin=None):
+        """反手：先只减仓平掉当前仓位，确认平仓成交后再反向开仓
+
+        两笔不合并提交：平仓被拒或待确认时不开新仓，避免开仓腿单独成交
+        造成反向加仓；平仓成交但开仓失败时告警并记入交易记录。
+        """
+        close_leg = {
+            'symbol': symbol,
+            'side': "buy" if position_size < 0 else "sell",
+            'size': abs(position_size),
+            'reduce_only': True
+        }
+        close_result = self.execute_batch([close_leg])[0]
+        if close_result == "pending":
+            self.log_message(f"⏳ {symbol} 反手平仓待确认，暂不反向开仓", "warning")
+            return "pending"
+        if not close_result:
+            self.log_message(f"❌ {symbol} 反手平仓未成交，取消反向开仓", "warning")
+            return False
+
+        remaining = self.current_positions.get(symbol, {}).get('size', 0)
+        if remaining * position_size > 0 and abs(remaining) > abs(position_size) * 0.01:
+            self.log_message(f" {symbol} 反手平仓仅部分成交（剩余{remaining}），不反向开仓", "warning")
+            self.journal_record('flip_incomplete', symbol, closed=False, remaining=remaining)
+            return False
+
+        # 平仓释放的保证金计入新仓位的可用保证金
+        price_data = self.get_execution_price(symbol)
+        freed_margin = 0
+        if price_data:
+            freed_margin = abs(position_size) * price_data['price'] / float(self.leverage.get() or 3)
+        new_size = self.calculate_position_size(
+            symbol, is_long=is_long, available_margin=available_margin, freed_margin=freed_margin
+        )
+        direction = "多" if is_long else "空"
+        if abs(new_size) <= 0.01:
+            self.log_message(f" {symbol} 反向开仓数量过小，仅平仓", "warning")
+            return True
+
+        self.log_message(f"🔄 {symbol} 反手: 已平仓{abs(position_size):.4f}，开{direction}{abs(new_size):.4f}", "info")
+        open_result = self.execute_batch([{'symbol': symbol, 'side': "buy" if is_long else "sell", 'size': abs(new_size)}])[0]
+        if not open_result:
+            self.log_message(f"❌ {symbol} 反手不完整: 原仓位已平，反向开{direction}失败，当前无持仓", "error")
+            self.journal_record('flip_incomplete', symbol, closed=True, side="buy" if is_long else "sell",
+                                size=abs(new_size))
+            return False
+        return open_result
 
     def execute_reduce_position(self, symbol):
         """执行减仓操作 - 修复版本"""
@@ -1481,8 +4320,6 @@ class HyperliquidTradingBot:
                 #  设置交易锁，确保同一轮询只执行一次
                 self._reduce_executed = True
                 self.log_message(f"✅ {symbol} 减仓成功", "info")
-                time.sleep(2)
-                self.update_real_positions()
                 return True
             else:
                 self.log_message(f"❌ {symbol} 减仓失败", "error")
@@ -1564,453 +4401,702 @@ class HyperliquidTradingBot:
             return False
 
     def auto_trading_loop(self):
-        """自动交易循环 - 修复减仓逻辑"""
-        loop_count = 0
+        """自动交易循环：每秒执行廉价风控 tick，事件触发时运行完整交易周期"""
         max_consecutive_errors = 5
         error_count = 0
-        
-        # 新增：交易锁，防止同一币种重复交易
-        trading_locks = {}
-    
+
+        # 交易锁，防止同一币种重复交易
+        self.trading_locks = {}
+        self.cycle_count = 0
+        self.scheduler.reset()
+
         while self.trading_active:
             try:
-                loop_count += 1
-                self.log_message(f"🔄 第{loop_count}轮自动交易检查开始...", "info")
-                #  重置减仓执行锁
-                self._reduce_executed = False
-    
-                #  第一步：检查并清理挂单状态
-                self.check_pending_orders()
-    
-                if not self.connection_status:
-                    self.log_message("❌ 交易连接已断开，停止自动交易", "error")
+                self.scheduler.configure(self.kline_interval_var.get(), int(self.check_interval.get() or 60))
+                with self.metrics.timer('fast_tick'):
+                    self.run_fast_risk_checks()
+
+                reasons = self.scheduler.due()
+                if reasons:
+                    self.log_message(f"触发完整交易周期: {', '.join(reasons)}", "debug")
+                    self.run_trading_cycle()
+                    self.scheduler.mark_cycle(self.watched_prices())
+                error_count = 0
+                self.dump_metrics()
+
+            except Exception as e:
+                self.market_snapshot = None
+                self.metrics.observe('cycle', error=True)
+                error_count += 1
+                self.log_message(f"自动交易循环出错 (第{error_count}次): {str(e)}", "error")
+                if error_count >= max_consecutive_errors:
+                    self.log_message(" 连续错误过多，停止自动交易", "error")
                     self.stop_trading()
                     break
+                self.scheduler.wait(min(30 * error_count, 300))
+                continue
+
+            self.scheduler.wait()
+
+    def run_trading_cycle(self):
+        """完整交易周期：快照、减仓、止盈止损、利润保护、信号收集与执行"""
+        self.cycle_count += 1
+        self.log_message(f"🔄 第{self.cycle_count}轮自动交易检查开始...", "info")
+        clock = self.metrics.stage_clock('cycle')
+        #  重置减仓执行锁
+        self._reduce_executed = False
+
+        #  第一步：推进订单状态
+        self.check_pending_orders(force=True)
+        clock.mark('pending_orders')
+
+        if not self.connection_status:
+            self.log_message("❌ 交易连接已断开，停止自动交易", "error")
+            self.stop_trading()
+            return
+
+        tokens = [t.strip() for t in self.tokens_entry.get().split(",") if t.strip()]
+        self.log_message(f" 监控代币: {tokens}", "debug")
+
+        # 元数据按较长间隔刷新
+        self.refresh_asset_meta()
+        clock.mark('meta')
+
+        # 构建本轮市场快照，减仓/止盈止损/利润保护/信号各阶段共享
+        self.market_snapshot = self.build_market_snapshot(tokens)
+        clock.mark('snapshot')
+
+        # 更新持仓和保证金状态
+        self.update_real_positions()
+
+        self.clear_signal_display()
+
+        # 初始获取保证金状态
+        margin_state = self.get_current_margin_state()
+        current_used_margin = margin_state['total_margin_used']
+        account_value = margin_state['account_value']
+        total_margin_limit = float(self.total_margin_pct.get() or 60)
     
-                # 更新持仓和保证金状态
+        self.log_message(f"当前保证金: {margin_state['current_ratio']:.1f}% / {total_margin_limit}%", "info")
+        clock.mark('position_sync')
+
+        #  获取止盈信号阈值
+        try:
+            profit_signal_threshold = float(self.profit_signal_threshold.get() or 0.7)
+        except ValueError:
+            profit_signal_threshold = 0.7
+            self.log_message(f" 止盈信号阈值格式错误，使用默认值: {profit_signal_threshold}", "warning")
+
+        executed_tokens = []
+        max_trades_per_cycle = 1
+        trades_executed = 0
+
+        #  修复：减仓检查
+        reduce_executed = False  # 确保每轮只执行一次减仓
+        for token, position in list(self.current_positions.items()):
+            if not self.trading_active or reduce_executed:
+                break
+            
+            # 检查交易锁
+            if self.is_trading_locked(token):
+                self.log_message(f" {token} 处于交易锁定期，跳过减仓检查", "debug")
+                continue
+            
+            # 直接调用减仓方法，方法内部会检查40%限制和10USDC条件
+            success = self.execute_reduce_position(token)
+            if success:
+                executed_tokens.append(token)
+                self.trading_locks[token] = time.time()
+                trades_executed += 1
+                reduce_executed = True  # 标记已执行减仓
+                self.log_message(f"✅ {token} 减仓执行成功", "info")
                 self.update_real_positions()
-    
-                tokens = [t.strip() for t in self.tokens_entry.get().split(",") if t.strip()]
-                self.log_message(f" 监控代币: {tokens}", "debug")
-    
-                for item in self.signal_tree.get_children():
-                    self.signal_tree.delete(item)
-    
-                # 初始获取保证金状态
+                # 更新保证金状态
                 margin_state = self.get_current_margin_state()
                 current_used_margin = margin_state['total_margin_used']
                 account_value = margin_state['account_value']
-                total_margin_limit = float(self.total_margin_pct.get() or 60)
+                break  # 执行一次减仓后就跳出
             
-                self.log_message(f"当前保证金: {margin_state['current_ratio']:.1f}% / {total_margin_limit}%", "info")
-    
-                #  获取止盈信号阈值
-                try:
-                    profit_signal_threshold = float(self.profit_signal_threshold.get() or 0.7)
-                except ValueError:
-                    profit_signal_threshold = 0.7
-                    self.log_message(f" 止盈信号阈值格式错误，使用默认值: {profit_signal_threshold}", "warning")
-    
-                executed_tokens = []
-                max_trades_per_cycle = 1
-                trades_executed = 0
-    
-                #  修复：减仓检查
-                reduce_executed = False  # 确保每轮只执行一次减仓
-                for token, position in list(self.current_positions.items()):
-                    if not self.trading_active or reduce_executed:
-                        break
-                    
-                    # 检查交易锁
-                    if token in trading_locks and trading_locks[token] > time.time() - 60:
-                        self.log_message(f" {token} 处于交易锁定期，跳过减仓检查", "debug")
-                        continue
-                    
-                    # 直接调用减仓方法，方法内部会检查40%限制和10USDC条件
-                    success = self.execute_reduce_position(token)
-                    if success:
-                        executed_tokens.append(token)
-                        trading_locks[token] = time.time()
-                        trades_executed += 1
-                        reduce_executed = True  # 标记已执行减仓
-                        self.log_message(f"✅ {token} 减仓执行成功", "info")
-                        time.sleep(3)
-                        self.update_real_positions()
-                        # 更新保证金状态
-                        margin_state = self.get_current_margin_state()
-                        current_used_margin = margin_state['total_margin_used']
-                        account_value = margin_state['account_value']
-                        break  # 执行一次减仓后就跳出
-                    
-                #  增强止盈策略：检查现有持仓的止盈止损
-                for token, position in list(self.current_positions.items()):
-                    if not self.trading_active:
-                        break
-                    
-                    #  检查交易锁
-                    if token in trading_locks and trading_locks[token] > time.time() - 60:
-                        self.log_message(f" {token} 处于交易锁定期，跳过止盈止损检查", "debug")
-                        continue
-                    
-                    #  新增：数据可用性验证
-                    price_data = self.get_stable_real_time_price(token)
-                    if not price_data:
-                        self.log_message(f"⚠️ {token} 无法获取实时价格，跳过止盈止损", "warning")
-                        continue
-        
-                    current_price = price_data['price']
-                    if current_price <= 0:
-                        self.log_message(f"⚠️ {token} 价格数据异常: ${current_price}，跳过止盈止损", "warning")
-                        continue
-    
-                    # 新增：历史数据验证
-                    historical_data = self.get_historical_prices(token, periods=60)
-                    if not historical_data or len(historical_data) < 60:
-                        self.log_message(f"⚠️ {token} 历史数据不足{len(historical_data) if historical_data else 0}/60，跳过止盈止损", "warning")
-                        continue
+        clock.mark('reduce')
 
-                    price_data = self.get_stable_real_time_price(token)
-                    if not price_data:
-                        continue
-                    
-                    pos_info = self.get_position_info(token, price_data['price'])
-                    action = self.check_take_profit_stop_loss(pos_info)
+        #  增强止盈策略：检查现有持仓的止盈止损，触发的平仓合并为一次批量下单
+        exit_orders = []
+        for token, position in list(self.current_positions.items()):
+            if not self.trading_active:
+                break
+            
+            #  检查交易锁
+            if self.is_trading_locked(token):
+                self.log_message(f" {token} 处于交易锁定期，跳过止盈止损检查", "debug")
+                continue
+            
+            #  新增：数据可用性验证
+            price_data = self.get_stable_real_time_price(token)
+            if not price_data:
+                self.log_message(f"⚠️ {token} 无法获取实时价格，跳过止盈止损", "warning")
+                continue
 
-                    
-                    if action:
-                        # 增强止盈逻辑：如果是止盈操作，检查信号强度
-                        if action == '止盈':
-                            # 获取当前信号强度
-                            token_signal_data = self.get_current_token_signal(token)
-                            if token_signal_data:
-                                current_strength = token_signal_data['signal_score']
-                                # 如果信号强度高于阈值，跳过止盈
-                                if current_strength >= profit_signal_threshold:
-                                    self.log_message(
-                                        f"{token} 达到止盈条件但信号强劲({current_strength:.2f}>={profit_signal_threshold})，跳过止盈", 
-                                        "info"
-                                    )
-                                    continue
-                                else:
-                                    self.log_message(
-                                        f"{token} 达到止盈条件且信号较弱({current_strength:.2f}<{profit_signal_threshold})，执行止盈", 
-                                        "info"
-                                    )
-                            else:
-                                self.log_message(f" {token} 无法获取信号数据，执行默认止盈", "warning")
-                        
-                        self.log_message(f"{token} {action}: pnl {pos_info['pnl_percent']:.2f}%，自动平仓", "warning")
-                        success = self.execute_close_position(token, position['size'])
-                        if success:
-                            self.log_message(f"✅ {token} {action} 平仓成功", "info")
-                            # 设置交易锁
-                            trading_locks[token] = time.time()
-                            time.sleep(3)
-                            self.update_real_positions()
-                        else:
-                            self.log_message(f" {token} {action} 平仓失败", "error")
-                        continue
+            current_price = price_data['price']
+            if current_price <= 0:
+                self.log_message(f"⚠️ {token} 价格数据异常: ${current_price}，跳过止盈止损", "warning")
+                continue
 
+            # 新增：历史数据验证
+            historical_data = self.get_historical_prices(token, periods=60)
+            if not historical_data or len(historical_data) < 60:
+                self.log_message(f"⚠️ {token} 历史数据不足{len(historical_data) if historical_data else 0}/60，跳过止盈止损", "warning")
+                continue
+
+            price_data = self.get_stable_real_time_price(token)
+            if not price_data:
+                continue
+            
+            pos_info = self.get_position_info(token, price_data['price'])
+            action = self.check_take_profit_stop_loss(pos_info)
+
+            
+            if action:
+                # 增强止盈逻辑：如果是止盈操作，检查信号强度
+                if action == '止盈':
+                    # 获取当前信号强度
+                    token_signal_data = self.get_current_token_signal(token)
+                    if token_signal_data:
+                        current_strength = token_signal_data['signal_score']
+                        # 如果信号强度高于阈值，跳过止盈
+                        if current_strength >= profit_signal_threshold:
+                            self.log_message(
+                                f"{token} 达到止盈条件但信号强劲({current_strength:.2f}>={profit_signal_threshold})，跳过止盈", 
+                                "info"
+                            )
+                            continue
+                        else:
+                            self.log_message(
+                                f"{token} 达到止盈条件且信号较弱({current_strength:.2f}<{profit_signal_threshold})，执行止盈", 
+                                "info"
+                            )
+                    else:
+                        self.log_message(f" {token} 无法获取信号数据，执行默认止盈", "warning")
                 
-                #  新增：利润保护减仓（在止盈止损之后，信号交易之前）
-                for token, position in list(self.current_positions.items()):
-                    if not self.trading_active:
-                        break
+                self.log_message(f"{token} {action}: pnl {pos_info['pnl_percent']:.2f}%，自动平仓", "warning")
+                exit_orders.append((token, action, {
+                    'symbol': token,
+                    'side': "sell" if position['size'] > 0 else "buy",
+                    'size': abs(position['size']),
+                    'reduce_only': True
+                }))
+                continue
+
+        if exit_orders:
+            results = self.execute_batch([leg for _, _, leg in exit_orders])
+            for (token, action, _), success in zip(exit_orders, results):
+                if success:
+                    self.log_message(f"✅ {token} {action} 平仓成功", "info")
+                    # 设置交易锁
+                    self.trading_locks[token] = time.time()
+                else:
+                    self.log_message(f" {token} {action} 平仓失败", "error")
+
         
-                    # 检查交易锁
-                    if token in trading_locks and trading_locks[token] > time.time() - 60:
-                        continue
+        clock.mark('tp_sl')
+
+        #  新增：利润保护减仓（在止盈止损之后，信号交易之前）
+        for token, position in list(self.current_positions.items()):
+            if not self.trading_active:
+                break
+
+            # 检查交易锁
+            if self.is_trading_locked(token):
+                continue
+
+            price_data = self.get_stable_real_time_price(token)
+            if not price_data:
+                continue
+
+            pos_info = self.get_position_info(token, price_data['price'])
+            trend_strength = self.assess_trend_strength(token)  # 需要获取趋势强度
+
+            # 执行利润保护减仓
+            protection_executed = self.execute_profit_protection(token, pos_info, trend_strength)
+            if protection_executed:
+                # 设置交易锁，避免重复操作
+                self.trading_locks[token] = time.time()
+                self.update_real_positions()
+                continue  # 跳过本次循环的后续信号处理
+
+
+        clock.mark('profit_protection')
+
+        # 收集所有信号：跳过锁定币种后并发评估，结果按代币顺序合并
+        eligible_tokens = []
+        for token in tokens:
+            #  检查交易锁
+            if self.is_trading_locked(token):
+                self.log_message(f" {token} 处于交易锁定期，跳过信号计算", "debug")
+                continue
+            eligible_tokens.append(token)
+
+        token_signals = self.evaluate_token_signals(eligible_tokens)
+
+        for token_data in token_signals:
+            self.update_signal_display(
+                token_data['token'], token_data['price_data'], token_data['position_info'],
+                token_data['signals'], token_data['final_signal'], token_data['operation_advice']
+            )
+    
+        clock.mark('signals')
+
+        # 加仓优先策略：分离处理信号
+        new_position_signals = []
+        increase_position_signals = []
+        decrease_position_signals = []
+    
+        for token_data in token_signals:
+            token = token_data['token']
+            final_signal = token_data['final_signal']
+            position_info = token_data['position_info']
+            position_size = position_info['size']
+            is_long = position_info.get('is_long', False)
+            is_short = position_info.get('is_short', False)
+        
+            has_position = position_info['status'] != '无持仓'
+            is_opening_new_position = (final_signal != "持有" and not has_position)
+            is_increasing_position = has_position and (
+                (final_signal == "买入" and is_long) or 
+                (final_signal == "卖出" and is_short)
+            )
+            is_decreasing_position = has_position and (
+                (final_signal == "卖出" and is_long) or 
+                (final_signal == "买入" and is_short)
+            )
         
-                    price_data = self.get_stable_real_time_price(token)
-                    if not price_data:
-                        continue
+            self.log_message(
+                f"{token} 分类: {final_signal} | "
+                f"持仓: {position_info['status']} | "
+                f"新开: {is_opening_new_position} | 加仓: {is_increasing_position} | 减仓: {is_decreasing_position} | "
+                f"强度: {token_data['signal_score']:.2f}", 
+                "info"
+            )
         
-                    pos_info = self.get_position_info(token, price_data['price'])
-                    trend_strength = self.assess_trend_strength(token)  # 需要获取趋势强度
+            if is_opening_new_position:
+                new_position_signals.append(token_data)
+                self.log_message(f"✅ {token} 符合新开仓条件，加入执行队列", "info")
+            elif is_increasing_position:
+                increase_position_signals.append(token_data)
+                self.log_message(f"✅ {token} 符合加仓条件，加入执行队列", "info")
+            elif is_decreasing_position:
+                decrease_position_signals.append(token_data)
+                self.log_message(f"✅ {token} 符合减仓条件，加入执行队列", "info")
     
-                    # 执行利润保护减仓
-                    protection_executed = self.execute_profit_protection(token, pos_info, trend_strength)
-                    if protection_executed:
-                        # 设置交易锁，避免重复操作
-                        trading_locks[token] = time.time()
-                        time.sleep(3)
-                        self.update_real_positions()
-                        continue  # 跳过本次循环的后续信号处理
-
-
-                # 收集所有信号
-                token_signals = []
-            
-                for token in tokens:
-                    if not self.trading_active:
-                        break
+        self.log_message(f" 信号分类: 新开{len(new_position_signals)} | 加仓{len(increase_position_signals)} | 减仓{len(decrease_position_signals)}", "info")
     
-                    #  检查交易锁
-                    if token in trading_locks and trading_locks[token] > time.time() - 60:
-                        self.log_message(f" {token} 处于交易锁定期，跳过信号计算", "debug")
-                        continue
+        # 加仓优先：按主导强度排序
+        increase_position_signals.sort(key=lambda x: x['signal_score'], reverse=True)
+        new_position_signals.sort(key=lambda x: x['signal_score'], reverse=True)
+        decrease_position_signals.sort(key=lambda x: x['signal_score'], reverse=True)
     
-                    price_data = self.get_stable_real_time_price(token)
-                    if not price_data:
-                        continue
-                    
-                    current_price = price_data['price']
-                    position_info = self.get_position_info(token, current_price)
-                    historical_prices = self.get_historical_prices(token, periods=100)
-                    signals = self.calculate_strategy_signals(token, historical_prices, current_price)
+        # 第一优先级：加仓（增强已有盈利仓位）
+        for token_data in increase_position_signals:
+            if not self.trading_active or trades_executed >= max_trades_per_cycle:
+                break
+            
+            token = token_data['token']
+            
+            if self.is_trading_locked(token):
+                continue
+            
+            final_signal = token_data['final_signal']
+            signal_strength = token_data['signal_strength']
+            operation_advice = token_data['operation_advice']
+            position_info = token_data['position_info']
+            current_price = token_data['price_data']['price']
+        
+            self.log_message(f"开始处理加仓信号: {token} {final_signal}", "info")
+        
+            risk_ok, risk_msg, available_margin = self.enhanced_risk_check_dynamic(
+                token, False, current_used_margin, account_value
+            )
+        
+            if not risk_ok:
+                self.log_risk(token, "拒绝", f"风险检查失败: {risk_msg}")
+                continue
+        
+            #  执行加仓交易
+            success = self.execute_signal_trade(token, final_signal, position_info, current_price, signal_strength, available_margin)
+            if success:
+                executed_tokens.append(token)
+                self.trading_locks[token] = time.time()
+                trades_executed += 1
+                self.log_message(f" {token} 加仓执行成功: {final_signal}", "info")
+                self.update_real_positions()
+                margin_state = self.get_current_margin_state()
+                current_used_margin = margin_state['total_margin_used']
+                account_value = margin_state['account_value']
     
-                    final_signal, operation_advice, signal_strength = self.determine_final_signal_with_position(
-                        signals, position_info, token
-                    )
-                
-                    buy_str = signal_strength.get('buy_strength', 0)
-                    sell_str = signal_strength.get('sell_strength', 0)
-                    signal_score = max(buy_str, sell_str)
-                    dominant_dir = "买入" if buy_str > sell_str else "卖出" if sell_str > buy_str else "持有"
-                
-                    token_signals.append({
-                        'token': token,
-                        'final_signal': final_signal,
-                        'signal_strength': signal_strength,
-                        'operation_advice': operation_advice,
-                        'position_info': position_info,
-                        'price_data': price_data,
-                        'signals': signals,
-                        'signal_score': signal_score,
-                        'dominant_dir': dominant_dir
-                    })
-                
-                    self.update_signal_display(
-                        token, price_data, position_info, signals, final_signal, operation_advice
-                    )
-            
-                # 加仓优先策略：分离处理信号
-                new_position_signals = []
-                increase_position_signals = []
-                decrease_position_signals = []
-            
-                for token_data in token_signals:
-                    token = token_data['token']
-                    final_signal = token_data['final_signal']
-                    position_info = token_data['position_info']
-                    position_size = position_info['size']
-                    is_long = position_info.get('is_long', False)
-                    is_short = position_info.get('is_short', False)
-                
-                    has_position = position_info['status'] != '无持仓'
-                    is_opening_new_position = (final_signal != "持有" and not has_position)
-                    is_increasing_position = has_position and (
-                        (final_signal == "买入" and is_long) or 
-                        (final_signal == "卖出" and is_short)
-                    )
-                    is_decreasing_position = has_position and (
-                        (final_signal == "卖出" and is_long) or 
-                        (final_signal == "买入" and is_short)
-                    )
-                
-                    self.log_message(
-                        f"{token} 分类: {final_signal} | "
-                        f"持仓: {position_info['status']} | "
-                        f"新开: {is_opening_new_position} | 加仓: {is_increasing_position} | 减仓: {is_decreasing_position} | "
-                        f"强度: {token_data['signal_score']:.2f}", 
-                        "info"
-                    )
-                
-                    if is_opening_new_position:
-                        new_position_signals.append(token_data)
-                        self.log_message(f"✅ {token} 符合新开仓条件，加入执行队列", "info")
-                    elif is_increasing_position:
-                        increase_position_signals.append(token_data)
-                        self.log_message(f"✅ {token} 符合加仓条件，加入执行队列", "info")
-                    elif is_decreasing_position:
-                        decrease_position_signals.append(token_data)
-                        self.log_message(f"✅ {token} 符合减仓条件，加入执行队列", "info")
-            
-                self.log_message(f" 信号分类: 新开{len(new_position_signals)} | 加仓{len(increase_position_signals)} | 减仓{len(decrease_position_signals)}", "info")
-            
-                # 加仓优先：按主导强度排序
-                increase_position_signals.sort(key=lambda x: x['signal_score'], reverse=True)
-                new_position_signals.sort(key=lambda x: x['signal_score'], reverse=True)
-                decrease_position_signals.sort(key=lambda x: x['signal_score'], reverse=True)
-            
-                # 第一优先级：加仓（增强已有盈利仓位）
-                for token_data in increase_position_signals:
-                    if not self.trading_active or trades_executed >= max_trades_per_cycle:
-                        break
-                    
-                    token = token_data['token']
-                    
-                    if token in trading_locks and trading_locks[token] > time.time() - 60:
-                        continue
-                    
-                    final_signal = token_data['final_signal']
-                    signal_strength = token_data['signal_strength']
-                    operation_advice = token_data['operation_advice']
-                    position_info = token_data['position_info']
-                    current_price = token_data['price_data']['price']
+        #  第二优先级：新开仓
+        if trades_executed < max_trades_per_cycle:
+            for token_data in new_position_signals:
+                if not self.trading_active or trades_executed >= max_trades_per_cycle:
+                    break
                 
-                    self.log_message(f"开始处理加仓信号: {token} {final_signal}", "info")
+                token = token_data['token']
                 
-                    risk_ok, risk_msg, available_margin = self.enhanced_risk_check_dynamic(
-                        token, False, current_used_margin, account_value
-                    )
+                if self.is_trading_locked(token):
+                    continue
                 
-                    if not risk_ok:
-                        self.log_message(f"{token} 风险检查失败: {risk_msg}", "warning")
-                        continue
+                final_signal = token_data['final_signal']
+                signal_strength = token_data['signal_strength']
+                operation_advice = token_data['operation_advice']
+                position_info = token_data['position_info']
+                current_price = token_data['price_data']['price']
+            
+                self.log_message(f"开始处理新开仓信号: {token} {final_signal}", "info")
+            
+                risk_ok, risk_msg, available_margin = self.enhanced_risk_check_dynamic(
+                    token, True, current_used_margin, account_value
+                )
+            
+                if not risk_ok:
+                    self.log_risk(token, "拒绝", f"风险检查失败: {risk_msg}")
+                    continue
+            
+                if final_signal == "买入":
+                    new_size = self.calculate_position_size(token, is_long=True, available_margin=available_margin)
+                else:
+                    new_size = self.calculate_position_size(token, is_long=False, available_margin=available_margin)
+            
+                self.log_message(f"🔧 {token} 计算仓位: {new_size}", "info")
+            
+                if abs(new_size) <= 0.00001:
+                    self.log_message(f" {token} 计算仓位过小: {new_size}", "warning")
+                    continue
+            
+                self.log_message(f"✅ {token} 准备执行: {final_signal} {new_size}", "info")
+            
+                success = False
+                if final_signal == "买入":
+                    success = self.execute_trade(token, "buy", new_size, "market")
+                else:
+                    success = self.execute_trade(token, "sell", abs(new_size), "market")
+            
+                if success:
+                    executed_tokens.append(token)
+                    self.trading_locks[token] = time.time()
+                    trades_executed += 1
+                    self.log_message(f"{token} 新开仓执行成功: {final_signal}", "info")
+                    self.update_real_positions()
+                    margin_state = self.get_current_margin_state()
+                    current_used_margin = margin_state['total_margin_used']
+                    account_value = margin_state['account_value']
+                    break
+                else:
+                    self.log_message(f" {token} 交易执行失败", "warning")
+    
+        #  第三优先级：减仓（风险控制）
+        if trades_executed < max_trades_per_cycle:
+            for token_data in decrease_position_signals:
+                if not self.trading_active or trades_executed >= max_trades_per_cycle:
+                    break
                 
-                    #  执行加仓交易
-                    success = self.execute_signal_trade(token, final_signal, position_info, current_price, signal_strength, available_margin)
-                    if success:
-                        executed_tokens.append(token)
-                        trading_locks[token] = time.time()
-                        trades_executed += 1
-                        self.log_message(f" {token} 加仓执行成功: {final_signal}", "info")
-                        
-                        time.sleep(5)
-                        self.update_real_positions()
-                        margin_state = self.get_current_margin_state()
-                        current_used_margin = margin_state['total_margin_used']
-                        account_value = margin_state['account_value']
-            
-                #  第二优先级：新开仓
-                if trades_executed < max_trades_per_cycle:
-                    for token_data in new_position_signals:
-                        if not self.trading_active or trades_executed >= max_trades_per_cycle:
-                            break
-                        
-                        token = token_data['token']
-                        
-                        if token in trading_locks and trading_locks[token] > time.time() - 60:
-                            continue
-                        
-                        final_signal = token_data['final_signal']
-                        signal_strength = token_data['signal_strength']
-                        operation_advice = token_data['operation_advice']
-                        position_info = token_data['position_info']
-                        current_price = token_data['price_data']['price']
-                    
-                        self.log_message(f"开始处理新开仓信号: {token} {final_signal}", "info")
-                    
-                        risk_ok, risk_msg, available_margin = self.enhanced_risk_check_dynamic(
-                            token, True, current_used_margin, account_value
-                        )
-                    
-                        if not risk_ok:
-                            self.log_message(f" {token} 风险检查失败: {risk_msg}", "warning")
-                            continue
-                    
-                        if final_signal == "买入":
-                            new_size = self.calculate_position_size(token, is_long=True, available_margin=available_margin)
-                        else:
-                            new_size = self.calculate_position_size(token, is_long=False, available_margin=available_margin)
-                    
-                        self.log_message(f"🔧 {token} 计算仓位: {new_size}", "info")
-                    
-                        if abs(new_size) <= 0.00001:
-                            self.log_message(f" {token} 计算仓位过小: {new_size}", "warning")
-                            continue
-                    
-                        self.log_message(f"✅ {token} 准备执行: {final_signal} {new_size}", "info")
-                    
-                        success = False
-                        if final_signal == "买入":
-                            success = self.execute_trade(token, "buy", new_size, "market")
-                        else:
-                            success = self.execute_trade(token, "sell", abs(new_size), "market")
-                    
-                        if success:
-                            executed_tokens.append(token)
-                            trading_locks[token] = time.time()
-                            trades_executed += 1
-                            self.log_message(f"{token} 新开仓执行成功: {final_signal}", "info")
-                            
-                            time.sleep(5)
-                            self.update_real_positions()
-                            margin_state = self.get_current_margin_state()
-                            current_used_margin = margin_state['total_margin_used']
-                            account_value = margin_state['account_value']
-                            break
-                        else:
-                            self.log_message(f" {token} 交易执行失败", "warning")
+                token = token_data['token']
+                
+                if self.is_trading_locked(token):
+                    continue
+                
+                final_signal = token_data['final_signal']
+                signal_strength = token_data['signal_strength']
+                operation_advice = token_data['operation_advice']
+                position_info = token_data['position_info']
+                current_price = token_data['price_data']['price']
             
-                #  第三优先级：减仓（风险控制）
-                if trades_executed < max_trades_per_cycle:
-                    for token_data in decrease_position_signals:
-                        if not self.trading_active or trades_executed >= max_trades_per_cycle:
-                            break
-                        
-                        token = token_data['token']
-                        
-                        if token in trading_locks and trading_locks[token] > time.time() - 60:
-                            continue
-                        
-                        final_signal = token_data['final_signal']
-                        signal_strength = token_data['signal_strength']
-                        operation_advice = token_data['operation_advice']
-                        position_info = token_data['position_info']
-                        current_price = token_data['price_data']['price']
-                    
-                        self.log_message(f"开始处理减仓信号: {token} {final_signal}", "info")
-                    
-                        risk_ok, risk_msg, available_margin = self.enhanced_risk_check_dynamic(
-                            token, False, current_used_margin, account_value
-                        )
-                    
-                        if not risk_ok:
-                            self.log_message(f" {token} 风险检查失败: {risk_msg}", "warning")
-                            continue
-                    
-                        success = self.execute_signal_trade(token, final_signal, position_info, current_price, signal_strength, available_margin)
-                        if success:
-                            executed_tokens.append(token)
-                            trading_locks[token] = time.time()
-                            trades_executed += 1
-                            self.log_message(f" {token} 减仓执行成功: {final_signal}", "info")
-                            
-                            time.sleep(5)
-                            self.update_real_positions()
-                            margin_state = self.get_current_margin_state()
-                            current_used_margin = margin_state['total_margin_used']
-                            account_value = margin_state['account_value']
-                            break
-            
-                self.log_message(f"本轮执行交易: {len(executed_tokens)}个币种", "info")
+                self.log_message(f"开始处理减仓信号: {token} {final_signal}", "info")
+            
+                risk_ok, risk_msg, available_margin = self.enhanced_risk_check_dynamic(
+                    token, False, current_used_margin, account_value
+                )
             
-                error_count = 0
-                interval = int(self.check_interval.get() or 60)
-                for i in range(interval):
-                    if not self.trading_active:
-                        break
-                    time.sleep(1)
+                if not risk_ok:
+                    self.log_risk(token, "拒绝", f"风险检查失败: {risk_msg}")
+                    continue
             
-            except Exception as e:
-                error_count += 1
-                self.log_message(f"自动交易循环出错 (第{error_count}次): {str(e)}", "error")
-                if error_count >= max_consecutive_errors:
-                    self.log_message(" 连续错误过多，停止自动交易", "error")
-                    self.stop_trading()
+                success = self.execute_signal_trade(token, final_signal, position_info, current_price, signal_strength, available_margin)
+                if success:
+                    executed_tokens.append(token)
+                    self.trading_locks[token] = time.time()
+                    trades_executed += 1
+                    self.log_message(f" {token} 减仓执行成功: {final_signal}", "info")
+                    self.update_real_positions()
+                    margin_state = self.get_current_margin_state()
+                    current_used_margin = margin_state['total_margin_used']
+                    account_value = margin_state['account_value']
                     break
-                time.sleep(min(30 * error_count, 300))
+    
+        clock.mark('execution')
+        self.log_message(f"本轮执行交易: {len(executed_tokens)}个币种", "info")
+        self.market_snapshot = None
+        clock.finish()
+
+    def dump_metrics(self, force=False):
+        """按间隔把延迟统计写入 logs/metrics.json"""
+        now = time.time()
+        if not force and now - self._metrics_dumped_at < self.metrics_dump_interval:
+            return
+        self._metrics_dumped_at = now
+        try:
+            self.metrics.dump(self.metrics_file)
+        except Exception as e:
+            self.log_message(f"写入性能统计失败: {str(e)}", "warning")
+
+    def apply_metrics_port(self):
+        """按配置的端口启动/重启/关闭本机 /metrics 端点（0或空为关闭）"""
+        try:
+            port = int(self.metrics_port.get().strip() or 0)
+        except ValueError:
+            self.log_message(f" 指标端口无效: {self.metrics_port.get()}", "warning")
+            return
+        if self.metrics_server is not None:
+            if self.metrics_server.port == port:
+                return
+            self.metrics_server.stop()
+            self.metrics_server = None
+            self.log_message("指标端点已关闭", "info")
+        if port <= 0:
+            return
+        try:
+            self.metrics_server = MetricsServer(self.render_prometheus_metrics, port).start()
+            self.log_message(f"✅ 指标端点已启动: http://127.0.0.1:{port}/metrics", "info")
+        except OSError as e:
+            self.log_message(f" 指标端点启动失败（端口 {port}）: {str(e)}", "error")
+
+    def render_prometheus_metrics(self):
+        """汇总循环耗时、外部调用延迟/错误、缓存命中率、挂单、保证金与信号评分"""
+        stats = self.metrics.snapshot()
+        quantiles = [({'name': name, 'quantile': q}, stat[key] / 1000)
+                     for name, stat in stats.items() for q, key in (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99'))]
+
+        caches = {'account_state': self.account_cache, 'price_table': self.price_table, 'klines': self.kline_store}
+        cache_ratio = []
+        for name, cache in caches.items():
+            total = cache.hits + cache.misses
+            cache_ratio.append(({'cache': name}, cache.hits / total if total else 0))
+
+        pending = defaultdict(int)
+        for order in list(self.pending_orders.values()):
+            pending[order['symbol']] += 1
+        margin_state = self.last_margin_state or {}
+
+        families = [
+            ('hl_bot_latency_seconds', 'gauge', '最近窗口内耗时分位数（cycle 为完整交易周期）', quantiles),
+            ('hl_bot_latency_last_seconds', 'gauge', '最近一次耗时',
+             [({'name': name}, stat['last'] / 1000) for name, stat in stats.items()]),
+            ('hl_bot_calls_total', 'counter', '调用次数',
+             [({'name': name}, stat['count']) for name, stat in stats.items()]),
+            ('hl_bot_errors_total', 'counter', '出错次数',
+             [({'name': name}, stat['errors']) for name, stat in stats.items()]),
+            ('hl_bot_cache_hits_total', 'counter', '缓存命中次数',
+             [({'cache': name}, cache.hits) for name, cache in caches.items()]),
+            ('hl_bot_cache_misses_total', 'counter', '缓存未命中次数',
+             [({'cache': name}, cache.misses) for name, cache in caches.items()]),
+            ('hl_bot_cache_hit_ratio', 'gauge', '缓存命中率', cache_ratio),
+            ('hl_bot_pending_orders', 'gauge', '未完成订单数', [({}, sum(pending.values()))]),
+            ('hl_bot_pending_orders_by_symbol', 'gauge', '各币种未完成订单数',
+             [({'symbol': symbol}, n) for symbol, n in sorted(pending.items())]),
+            ('hl_bot_margin_ratio_percent', 'gauge', '保证金占用率(%)', [({}, margin_state.get('current_ratio', 0))]),
+            ('hl_bot_account_value', 'gauge', '账户价值', [({}, margin_state.get('account_value', 0))]),
+            ('hl_bot_signal_score', 'gauge', '各币种最近一次信号评分（买卖强度取大）',
+             [({'symbol': token}, score['score']) for token, score in sorted(self.signal_scores.items())]),
+            ('hl_bot_signal_strength', 'gauge', '各币种最近一次买入/卖出强度',
+             [({'symbol': token, 'side': side}, score[side])
+              for token, score in sorted(self.signal_scores.items()) for side in ('buy', 'sell')]),
+            ('hl_bot_trading_active', 'gauge', '自动交易是否运行', [({}, int(self.trading_active))]),
+            ('hl_bot_connected', 'gauge', '是否已连接交易所', [({}, int(self.connection_status))]),
+            ('hl_bot_cycles_total', 'counter', '本次运行的交易周期数', [({}, self.cycle_count)]),
+        ]
+        return prometheus_text(families)
+
+    def is_trading_locked(self, token, window=60):
+        """币种是否处于交易锁定期"""
+        locked_at = self.trading_locks.get(token)
+        return locked_at is not None and locked_at > time.time() - window
+
+    def watched_prices(self):
+        """价格表中监控币种与持仓币种的最新价格 {symbol: price}"""
+        tokens = [t.strip() for t in self.tokens_entry.get().split(",") if t.strip()]
+        prices = {}
+        for symbol in set(tokens) | set(self.current_positions):
+            price_data = self.price_table.get(symbol)
+            if price_data:
+                prices[symbol] = price_data['price']
+        return prices
+
+    def run_fast_risk_checks(self):
+        """高频风控 tick：按缓存中间价检查止损，止盈/接近止损/价格异动时登记事件
+
+        订单状态按 order_poll_interval 节流推进（新订单提交后尽快检查一次），
+        止损平仓前重新拉取持仓确认，避免按过期持仓下单。
+        """
+        self.check_pending_orders()
+        if not self.connection_status:
+            return
+
+        tokens = [t.strip() for t in self.tokens_entry.get().split(",") if t.strip()]
+        if not self.refresh_price_table(tokens + list(self.current_positions)):
+            return
+        prices = self.watched_prices()
+        moved = self.scheduler.observe_prices(prices)
+        if moved:
+            self.log_message(f" {moved} 价格偏离超过{self.scheduler.price_move_pct}%，触发交易周期", "debug")
+
+        stop_loss_pct = float(self.stop_loss_pct.get() or 8)
+        stop_candidates = []
+        for token in list(self.current_positions):
+            price = prices.get(token)
+            if price is None or self.is_trading_locked(token) or self.has_pending_orders_for_token(token):
+                continue
+            pos_info = self.get_position_info(token, price)
+            self.scheduler.observe_stop_distance(
+                token, pos_info['pnl_percent'] < -stop_loss_pct * self.scheduler.stop_warning_ratio
+            )
+            action = self.check_take_profit_stop_loss(pos_info)
+            if action == '止损':
+                stop_candidates.append(token)
+            elif action == '止盈':
+                # 止盈需结合信号强度判断，交给完整周期处理
+                self.scheduler.notify('take_profit')
+
+        exit_orders = []
+        if stop_candidates:
+            # 缓存持仓可能已过期（成交/手动平仓），下单前按最新持仓复核
+            self.update_real_positions(force=True)
+            for token in stop_candidates:
+                position = self.current_positions.get(token)
+                if not position or not position.get('size'):
+                    self.log_message(f"{token} 最新持仓已为空，跳过止损", "info")
+                    continue
+                pos_info = self.get_position_info(token, prices[token])
+                if self.check_take_profit_stop_loss(pos_info) != '止损':
+                    continue
+                self.log_message(f"{token} 止损: pnl {pos_info['pnl_percent']:.2f}%，立即平仓", "warning")
+                exit_orders.append((token, {
+                    'symbol': token,
+                    'side': "sell" if position['size'] > 0 else "buy",
+                    'size': abs(position['size']),
+                    'reduce_only': True
+                }))
+
+        if exit_orders:
+            results = self.execute_batch([leg for _, leg in exit_orders])
+            for (token, _), success in zip(exit_orders, results):
+                if success:
+                    self.log_message(f"✅ {token} 止损平仓成功", "info")
+                    self.trading_locks[token] = time.time()
+                else:
+                    self.log_message(f" {token} 止损平仓失败", "error")
+
+    def get_worker_pool(self):
+        """行情拉取与信号评估共用的有界线程池"""
+        if self.worker_pool is None:
+            self.worker_pool = ThreadPoolExecutor(max_workers=self.signal_workers, thread_name_prefix="signal")
+        return self.worker_pool
+
+    def map_tokens(self, func, tokens):
+        """在线程池中并发执行 func(token)，按输入顺序返回结果（出错为None）"""
+        if len(tokens) <= 1 or self.signal_workers <= 1:
+            futures = None
+        else:
+            pool = self.get_worker_pool()
+            futures = [pool.submit(func, token) for token in tokens]
+
+        results = []
+        for i, token in enumerate(tokens):
+            try:
+                results.append(futures[i].result() if futures else func(token))
+            except Exception as e:
+                self.log_message(f" {token} 并发任务出错: {str(e)}", "error")
+                results.append(None)
+        return results
+
+    def signal_settings(self):
+        """在调用线程读取信号评估用到的界面设置，供工作线程使用（Tk变量非线程安全）"""
+        return {
+            'execution_mode': self.execution_mode_var.get(),
+            'signal_threshold': self.signal_threshold.get(),
+            'kline_interval': self.kline_interval_var.get(),
+            'leverage': self.leverage.get(),
+            'max_margin_pct': self.max_margin_pct.get(),
+            'strategies': self.enabled_strategies()
+        }
+
+    def evaluate_token_signal(self, token, settings=None):
+        """评估单个币种：价格 + K线 + 策略信号 + 最终决策"""
+        if not self.trading_active:
+            return None
+        settings = settings or self.signal_settings()
+
+        price_data = self.get_stable_real_time_price(token)
+        if not price_data:
+            return None
+
+        current_price = price_data['price']
+        position_info = self.get_position_info(token, current_price)
+        interval = settings['kline_interval']
+        historical_prices = self.get_historical_prices(token, periods=SIGNAL_WINDOW, interval=interval)
+        signals = self.calculate_strategy_signals(
+            token, historical_prices, current_price,
+            state=self.get_indicator_state(token, interval), enabled=settings['strategies']
+        )
+
+        final_signal, operation_advice, signal_strength = self.determine_final_signal_with_position(
+            signals, position_info, token, settings
+        )
+
+        buy_str = signal_strength.get('buy_strength', 0)
+        sell_str = signal_strength.get('sell_strength', 0)
+        signal_score = max(buy_str, sell_str)
+        dominant_dir = "买入" if buy_str > sell_str else "卖出" if sell_str > buy_str else "持有"
+        self.signal_scores[token] = {'buy': buy_str, 'sell': sell_str, 'score': signal_score}
+        self.journal_record(
+            'signal', token, price=current_price, position=position_info['size'],
+            signals=signals, final_signal=final_signal, advice=operation_advice,
+            strength=signal_strength, score=signal_score, mode=settings['execution_mode'],
+            interval=interval
+        )
+
+        return {
+            'token': token,
+            'final_signal': final_signal,
+            'signal_strength': signal_strength,
+            'operation_advice': operation_advice,
+            'position_info': position_info,
+            'price_data': price_data,
+            'signals': signals,
+            'signal_score': signal_score,
+            'dominant_dir': dominant_dir
+        }
+
+    def evaluate_token_signals(self, tokens):
+        """并发评估多个币种，结果顺序与 tokens 一致；界面设置先在本线程读取再传给工作线程"""
+        settings = self.signal_settings()
+        results = self.map_tokens(lambda token: self.evaluate_token_signal(token, settings), tokens)
+        return [result for result in results if result]
 
     def get_current_margin_state(self):
         """获取当前保证金状态"""
         try:
             if not self.connection_status:
                 return {'total_margin_used': 0, 'account_value': 0, 'current_ratio': 0}
-            
-            wallet_address = self.wallet_address.get().strip()
-            user_state = self.info.user_state(wallet_address)
+
+            user_state = self.get_user_state()
             margin_summary = user_state.get('marginSummary', {})
             total_margin_used = float(margin_summary.get('totalMarginUsed', 0))
             account_value = float(margin_summary.get('accountValue', 0))
             current_ratio = (total_margin_used / account_value) * 100 if account_value > 0 else 0
         
-            return {
+            self.last_margin_state = {
                 'total_margin_used': total_margin_used,
                 'account_value': account_value,
                 'current_ratio': current_ratio
             }
+            return dict(self.last_margin_state)
         except Exception as e:
             self.log_message(f" 获取保证金状态出错: {str(e)}", "error")
             return {'total_margin_used': 0, 'account_value': 0, 'current_ratio': 0}
@@ -2046,7 +5132,7 @@ class HyperliquidTradingBot:
             
             #  修复：正确从 coins.json 获取杠杆配置
             trading_config = self.coin_config.get("trading_config", {})
-            symbol_config = trading_config.get(symbol.upper(), trading_config.get("DEFAULT", {}))
+            symbol_config = self.get_symbol_config(symbol)
             
             # 调试日志：显示实际配置
             self.log_message(
@@ -2092,7 +5178,7 @@ class HyperliquidTradingBot:
             self.log_message(f" 计算保证金比例失败 {symbol}: {str(e)}", "error")
             return 0
 
-    def check_single_coin_position_limit(self, symbol, final_signal, position_info):
+    def check_single_coin_position_limit(self, symbol, final_signal, position_info, settings=None):
         """检查单个币种仓位是否超过限制 - 基于保证金占用"""
         try:
             if not self.connection_status:
@@ -2126,13 +5212,12 @@ class HyperliquidTradingBot:
             #  关键修复：计算保证金占用而不是仓位价值比例
             # 从配置获取实际使用的杠杆
             try:
-                configured_leverage = float(self.leverage.get() or 3)
+                configured_leverage = float((settings['leverage'] if settings else self.leverage.get()) or 3)
             except ValueError:
                 configured_leverage = 3
                 
             # 从 coins.json 获取最大允许杠杆
-            trading_config = self.coin_config.get("trading_config", {})
-            symbol_config = trading_config.get(symbol.upper(), trading_config.get("DEFAULT", {}))
+            symbol_config = self.get_symbol_config(symbol)
             max_allowed_leverage = symbol_config.get("max_leverage", 5)
             used_leverage = min(configured_leverage, max_allowed_leverage)
             
@@ -2142,7 +5227,7 @@ class HyperliquidTradingBot:
 
             # 获取单币保证金限制（使用max_margin_pct配置）
             try:
-                single_margin_max_ratio = float(self.max_margin_pct.get() or 20)
+                single_margin_max_ratio = float((settings['max_margin_pct'] if settings else self.max_margin_pct.get()) or 20)
             except ValueError:
                 single_margin_max_ratio = 20.0
 
@@ -2346,16 +5431,12 @@ class HyperliquidTradingBot:
             return None
 
     def update_position_display(self):
-        """更新持仓显示"""
-        for item in self.position_tree.get_children():
-            self.position_tree.delete(item)
-    
+        """更新持仓显示：在调用线程整理行数据，整表刷新合并后交给主线程"""
+        rows = []
         if not self.current_positions:
-            self.position_tree.insert("", "end", values=(
-                "无持仓", "-", "-", "-", "-", "-"
-            ))
+            rows.append(("无持仓", "-", "-", "-", "-", "-"))
         else:
-            for symbol, position in self.current_positions.items():
+            for symbol, position in list(self.current_positions.items()):
                 current_price_data = self.get_stable_real_time_price(symbol)
                 if current_price_data:
                     current_price = current_price_data['price']
@@ -2371,7 +5452,7 @@ class HyperliquidTradingBot:
                 
                     direction = "多" if position_info['is_long'] else "空" if position_info['is_short'] else "-"
                 
-                    self.position_tree.insert("", "end", values=(
+                    rows.append((
                         f"{symbol}({direction})",
                         f"{position_size:.4f}",
                         f"${entry_price:.4f}",
@@ -2379,6 +5460,14 @@ class HyperliquidTradingBot:
                         f"{pnl_color}${unrealized_pnl:+.2f}",
                         f"{pnl_percent_color}{pnl_percent:+.2f}%"
                     ))
+        if self.root is not None:
+            self.ui_queue.post(self.render_tree, self.position_tree, rows, key='position_table')
+
+    def render_tree(self, tree, rows):
+        """用给定行整表重绘 Treeview（主线程）"""
+        tree.delete(*tree.get_children())
+        for values in rows:
+            tree.insert("", "end", values=values)
 
     def get_balance(self):
         """获取账户余额"""
@@ -2387,8 +5476,7 @@ class HyperliquidTradingBot:
             return
         
         try:
-            wallet_address = self.wallet_address.get().strip()
-            user_state = self.info.user_state(wallet_address)
+            user_state = self.get_user_state(force=True)
             margin_summary = user_state.get('marginSummary', {})
             account_value = margin_summary.get('accountValue', 'N/A')
             total_margin_used = margin_summary.get('totalMarginUsed', '0')
@@ -2406,8 +5494,7 @@ class HyperliquidTradingBot:
             return
             
         self.trading_active = True
-        self.start_button.config(state="disabled")
-        self.stop_button.config(state="normal")
+        self.set_trading_buttons(True)
         
         self.log_message(" 开始自动交易", "info")
         
@@ -2417,10 +5504,16 @@ class HyperliquidTradingBot:
     def stop_trading(self):
         """停止交易"""
         self.trading_active = False
-        self.start_button.config(state="normal")
-        self.stop_button.config(state="disabled")
+        self.scheduler.wake.set()
+        # 可能由交易线程调用，按钮状态交给主线程更新
+        self.ui_queue.post(self.set_trading_buttons, False, key='trading_buttons')
         self.log_message("🛑 停止自动交易", "info")
 
+    def set_trading_buttons(self, active):
+        """切换开始/停止按钮状态（主线程）"""
+        self.start_button.config(state="disabled" if active else "normal")
+        self.stop_button.config(state="normal" if active else "disabled")
+
     def load_config(self):
         """从文件加载配置"""
         try:
@@ -2484,6 +5577,9 @@ class HyperliquidTradingBot:
                 self.check_interval.delete(0, tk.END)
                 self.check_interval.insert(0, config.get('check_interval', '60'))
                 
+                self.metrics_port.delete(0, tk.END)
+                self.metrics_port.insert(0, config.get('metrics_port', '0'))
+                
                 self.auto_rebalance_var.set(config.get('auto_rebalance', True))
                 
                 weights_text = config.get('strategy_weights', '1.5,1.2,1.0,0.8')
@@ -2544,34 +5640,15 @@ class HyperliquidTradingBot:
         self.check_interval.delete(0, tk.END)
         self.check_interval.insert(0, "60")
         
+        self.metrics_port.delete(0, tk.END)
+        self.metrics_port.insert(0, "0")
+        
         self.log_message("默认配置已加载", "info")
 
     def parse_strategy_weights(self, weights_text):
         """解析策略权重配置"""
         try:
-            weight_values = [w.strip() for w in weights_text.split(',') if w.strip()]
-            strategy_order = ['ma', 'rsi', 'macd', 'bollinger']
-            weights = {}
-        
-            for i, weight_str in enumerate(weight_values):
-                if i < len(strategy_order):
-                    try:
-                        weight_value = float(weight_str)
-                        strategy = strategy_order[i]
-                        weights[strategy] = weight_value
-                    except ValueError:
-                        weights[strategy_order[i]] = 1.0
-                else:
-                    break
-        
-            for i in range(len(weight_values), len(strategy_order)):
-                weights[strategy_order[i]] = 1.0
-        
-            total = sum(weights.values())
-            if total > 0:
-                for key in weights:
-                    weights[key] = round(weights[key] / total, 4)
-        
+            weights = parse_weight_text(weights_text)
             self.strategy_weights_config.update(weights)
             self.log_message(f"✅ 策略权重已更新: {self.strategy_weights_config}", "info")
         
@@ -2594,8 +5671,7 @@ class HyperliquidTradingBot:
             
             self.log_message(" 开始策略测试...", "info")
             
-            for item in self.signal_tree.get_children():
-                self.signal_tree.delete(item)
+            self.clear_signal_display()
             
             for token in tokens:
                 self.log_message(f"测试 {token} 的策略信号...", "info")
@@ -2634,287 +5710,254 @@ class HyperliquidTradingBot:
             tokens = [t.strip() for t in self.tokens_entry.get().split(",") if t.strip()]
             start_date = "2025-01-01"
             end_date = "2025-10-30"
+            settings = self.backtest_settings()
             
             self.log_message(f" 开始回测: {tokens}, 期间 {start_date} to {end_date}", "info")
             
-            results = {}
-            for token in tokens:
-                historical_data = self.load_historical_data(token, start_date, end_date)
-                if not historical_data.empty:
-                    backtest_result = self.simulate_strategy(token, historical_data)
-                    results[token] = backtest_result
-                    self.log_message(f"✅ {token} 回测完成: 胜率 {backtest_result['win_rate']:.2%}, 总回报 {backtest_result['total_return']:.2%}", "info")
-                else:
-                    self.log_message(f" {token} 历史数据不足", "warning")
-            
-            self.display_backtest_results(results)
+            # 回测在进程池中并行执行，后台线程逐个接收结果，避免阻塞界面
+            def collect():
+                try:
+                    results = {}
+                    for token, backtest_result, error in run_parallel_backtests(tokens, start_date, end_date, settings):
+                        if error:
+                            self.log_message(f" {token} 回测出错: {error}", "error")
+                        elif backtest_result is None:
+                            self.log_message(f" {token} 历史数据不足", "warning")
+                        else:
+                            results[token] = backtest_result
+                            self.log_message(f"✅ {token} 回测完成: 胜率 {backtest_result['win_rate']:.2%}, 总回报 {backtest_result['total_return']:.2%}", "info")
+                    
+                    ordered = {token: results[token] for token in tokens if token in results}
+                    # 结果经界面队列交给主线程显示，后台线程不直接调用 Tk
+                    self.ui_queue.post(self.display_backtest_results, ordered, key='backtest_results')
+                    self.log_message(" 回测完成！", "info")
+                except Exception as e:
+                    self.log_message(f" 回测出错: {str(e)}", "error")
             
-            self.log_message(" 回测完成！", "info")
+            threading.Thread(target=collect, daemon=True).start()
             
         except Exception as e:
             self.log_message(f" 回测出错: {str(e)}", "error")
     
-    def simulate_strategy(self, symbol, data):
-        """模拟策略执行"""
-        if data.empty:
-            return {'win_rate': 0, 'total_return': 0, 'trades': 0}
-        
-        positions = 0
-        entry_price = 0
-        trades = []
-        balance = 10000  # 初始资金
-        
-        for i in range(len(data)):
-            row = data.iloc[i]
-            current_price = row['close']
-            
-            # 模拟信号（用真实calculate_strategy_signals）
-            historical = data['close'].iloc[max(0, i-100):i+1].tolist()  # 最近100点
-            if len(historical) < 60:
-                continue  # 跳过数据不足，避免警告
-            
-            signals = self.calculate_strategy_signals(symbol, historical, current_price)
-            
-            #  修复：用完整get_position_info模拟持仓
-            position_info = self.get_position_info(symbol, current_price)
-            position_info['size'] = positions  # 覆盖模拟持仓大小
-            
-            final_signal = self.determine_final_signal_with_position(signals, position_info, symbol)[0]
-            
-            # 模拟执行（简化，无杠杆/费用）
-            if final_signal == "买入" and positions == 0:
-                positions = balance / current_price * 0.1  # 10%仓位
-                entry_price = current_price
-                trades.append({'type': 'buy', 'price': current_price, 'time': row['open_time']})
-            elif final_signal == "卖出" and positions > 0:
-                pnl = (current_price - entry_price) / entry_price
-                balance += positions * current_price * pnl
-                trades.append({'type': 'sell', 'price': current_price, 'pnl': pnl, 'time': row['open_time']})
-                positions = 0
-            
-        # 计算绩效
-        wins = len([t for t in trades if t.get('pnl', 0) > 0])
-        win_rate = wins / len(trades) if trades else 0
-        total_return = (balance - 10000) / 10000
-        
-        return {'win_rate': win_rate, 'total_return': total_return, 'trades': len(trades), 'balance': balance}
-    
     def load_historical_data(self, symbol, start_date, end_date):
-        """加载历史数据（从CSV或API，支持分页拉取长历史）"""
-        import time  # 用于分页延时
-        
-        # 优先从本地CSV加载（预下载Binance数据）
-        csv_file = f"{symbol}_historical_{self.kline_interval_var.get()}.csv"  # 加间隔区分文件
-        if os.path.exists(csv_file):
-            df = pd.read_csv(csv_file, parse_dates=['open_time'])
-            df = df[(df['open_time'] >= start_date) & (df['open_time'] <= end_date)]
-            if not df.empty:
-                self.log_message(f" 从本地CSV加载 {symbol} {len(df)}条数据", "info")
-                return df
-        
-        # Fallback: 用API拉取（分页处理长历史）
-        self.log_message(f" 从Binance拉取 {symbol} 历史数据 (间隔: {self.kline_interval_var.get()})", "info")
-        binance_symbol = f"{symbol}USDT"
-        url = "https://api.binance.com/api/v3/klines"
-        
-        # 时间戳
-        start_ts = int(pd.to_datetime(start_date).timestamp() * 1000)
-        end_ts = int(pd.to_datetime(end_date).timestamp() * 1000)
-        
-        all_data = []
-        current_start = start_ts
-        
-        while current_start < end_ts:
-            params = {
-                'symbol': binance_symbol,
-                'interval': self.kline_interval_var.get(),
-                'startTime': current_start,
-                'endTime': end_ts,
-                'limit': 1000  # 最大1000条/次
-            }
-            response = requests.get(url, params=params, timeout=10)
-            
-            if response.status_code != 200:
-                self.log_message(f" Binance API失败 {symbol}: HTTP {response.status_code}", "warning")
-                break
-            
-            data_batch = response.json()
-            if not data_batch:
-                break
-            
-            all_data.extend(data_batch)
-            
-            # 分页推进：下一批从最后一条+1开始
-            current_start = data_batch[-1][0] + 1  # open_time +1ms
-            
-            self.log_message(f" 已拉取 {len(all_data)} 条 {symbol} 数据批次", "debug")
-            time.sleep(0.1)
-        
-        if not all_data:
+        """加载历史数据为 DataFrame（兼容旧接口；回测本身逐批读取，见 run_symbol_backtest）"""
+        start_ts, end_ts = self.date_range_ms(start_date, end_date)
+        batches = list(self.candle_source.batches(symbol, self.kline_interval_var.get(), start_ts, end_ts))
+        if not batches or not sum(len(batch) for batch in batches):
             self.log_message(f" {symbol} 无历史数据可用", "warning")
             return pd.DataFrame()
-        
-        # 修复：正确12列定义
-        columns = [
-            'open_time', 'open', 'high', 'low', 'close', 'volume', 
-            'close_time', 'quote_asset_volume', 'number_of_trades', 
-            'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore'
-        ]
-        df = pd.DataFrame(all_data, columns=columns)
-        
-        # 类型转换
-        df['open_time'] = pd.to_datetime(df['open_time'], unit='ms')
-        df['close'] = df['close'].astype(float)  # 用于信号计算
-        df['open'] = df['open'].astype(float)
-        df['high'] = df['high'].astype(float)
-        df['low'] = df['low'].astype(float)
-        df['volume'] = df['volume'].astype(float)
-        
-        # 过滤日期范围
-        df = df[(df['open_time'] >= start_date) & (df['open_time'] <= end_date)]
-        
-        # 保存本地CSV
-        df.to_csv(csv_file, index=False)
-        self.log_message(f"✅ {symbol} 拉取完成: {len(df)} 条数据 (间隔: {self.kline_interval_var.get()})", "info")
-        
-        return df
-    
-    def load_historical_data(self, symbol, start_date, end_date):
-        """加载历史数据"""
-        import time  # 用于分页延时
-        
-        # 优先从本地CSV加载
-        csv_file = f"{symbol}_historical_{self.kline_interval_var.get()}.csv"  # 加间隔区分文件
-        if os.path.exists(csv_file):
-            df = pd.read_csv(csv_file, parse_dates=['open_time'])
-            df = df[(df['open_time'] >= start_date) & (df['open_time'] <= end_date)]
-            if not df.empty:
-                self.log_message(f"从本地CSV加载 {symbol} {len(df)}条数据", "info")
-                return df
-        
-        # Fallback: 用API拉取（分页处理长历史）
-        self.log_message(f" 从Binance拉取 {symbol} 历史数据 (间隔: {self.kline_interval_var.get()})", "info")
-        binance_symbol = f"{symbol}USDT"
-        url = "https://api.binance.com/api/v3/klines"
-        
-        # 时间戳
-        start_ts = int(pd.to_datetime(start_date).timestamp() * 1000)
-        end_ts = int(pd.to_datetime(end_date).timestamp() * 1000)
-        
-        all_data = []
-        current_start = start_ts
-        
-        while current_start < end_ts:
-            params = {
-                'symbol': binance_symbol,
-                'interval': self.kline_interval_var.get(),
-                'startTime': current_start,
-                'endTime': end_ts,
-                'limit': 1000  # 最大1000条/次
-            }
-            response = requests.get(url, params=params, timeout=10)
-            
-            if response.status_code != 200:
-                self.log_message(f" Binance API失败 {symbol}: HTTP {response.status_code}", "warning")
-                break
-            
-            data_batch = response.json()
-            if not data_batch:
-                break
-            
-            all_data.extend(data_batch)
-            
-            # 分页推进：下一批从最后一条+1开始
-            current_start = data_batch[-1][0] + 1  # open_time +1ms
-            
-            self.log_message(f" 已拉取 {len(all_data)} 条 {symbol} 数据批次", "debug")
-            time.sleep(0.1)
-        
-        if not all_data:
+        return records_to_frame(np.concatenate(batches))
+
+    def date_range_ms(self, start_date, end_date):
+        return int(pd.to_datetime(start_date).timestamp() * 1000), int(pd.to_datetime(end_date).timestamp() * 1000)
+
+    def make_candle_source(self, spec="local", seed=0, download=True):
+        """按名称创建历史数据源：local / binance / synthetic / replay:<文件路径>
+
+        download=False 时本地库只读，不补齐缺失区间（由主进程预先补齐）
+        """
+        if spec == "binance":
+            return BinanceRestSource(self.http, self.history_downloader.limiter)
+        if spec == "synthetic":
+            return SyntheticSource(seed=seed)
+        if spec.startswith("replay:"):
+            return ReplayFileSource(spec[len("replay:"):])
+        return LocalStoreSource(self.history_store, self.history_downloader if download else None)
+
+    def run_symbol_backtest(self, symbol, start_date, end_date, source=None, batch_size=50000):
+        """从数据源逐批读取并回测单个币种，无数据返回None"""
+        start_ts, end_ts = self.date_range_ms(start_date, end_date)
+        source = source or self.candle_source
+        interval = self.kline_interval_var.get()
+        result = self.backtest_stream(
+            symbol, source.batches(symbol, interval, start_ts, end_ts, batch_size), self.backtest_vectorized
+        )
+        if not result['bars']:
             self.log_message(f" {symbol} 无历史数据可用", "warning")
-            return pd.DataFrame()
-        
-        # 修复：正确12列定义
-        columns = [
-            'open_time', 'open', 'high', 'low', 'close', 'volume', 
-            'close_time', 'quote_asset_volume', 'number_of_trades', 
-            'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore'
-        ]
-        df = pd.DataFrame(all_data, columns=columns)
-        
-        # 类型转换
-        df['open_time'] = pd.to_datetime(df['open_time'], unit='ms')
-        df['close'] = df['close'].astype(float)  # 用于信号计算
-        df['open'] = df['open'].astype(float)
-        df['high'] = df['high'].astype(float)
-        df['low'] = df['low'].astype(float)
-        df['volume'] = df['volume'].astype(float)
-        
-        # 过滤日期范围
-        df = df[(df['open_time'] >= start_date) & (df['open_time'] <= end_date)]
-        
-        # 保存本地CSV
-        df.to_csv(csv_file, index=False)
-        self.log_message(f"✅ {symbol} 拉取完成: {len(df)} 条数据 (间隔: {self.kline_interval_var.get()})", "info")
-        
-        return df
-    
+            return None
+        self.log_message(f" {symbol} 回测读取 {result['bars']}条数据 (来源: {source.name}, 间隔: {interval})", "info")
+        return result
+
+    def backtest_stream(self, symbol, batches, vectorized=True, take_profit_pct=None, stop_loss_pct=None, overlap=SIGNAL_WINDOW):
+        """逐批回测：每批拼接上一批末尾 overlap 根K线，指标窗口完整，结果与整段一次计算一致"""
+        ledger = BacktestLedger()
+        tail = np.empty(0, dtype=KLINE_DTYPE)
+        bars = 0
+        for batch in batches:
+            if len(batch) == 0:
+                continue
+            bars += len(batch)
+            combined = np.concatenate([tail, batch])
+            closes = combined['close'].astype(float)
+            times = pd.to_datetime(combined['open_time'], unit='ms').tolist()
+            self.replay_backtest(
+                symbol, closes.tolist(), times, self.backtest_signal_fn(symbol, closes, vectorized),
+                take_profit_pct=take_profit_pct, stop_loss_pct=stop_loss_pct, ledger=ledger, start=len(tail)
+            )
+            tail = combined[-overlap:]
+        return dict(ledger.summary(), bars=bars)
+
+    def backtest_signal_fn(self, symbol, closes, vectorized=True):
+        """返回 signal_at(i)：向量化模式一次算出整批信号，否则逐根重算（用真实calculate_strategy_signals）"""
+        if vectorized:
+            labels = indicator_signal_labels(backtest_indicator_series(closes), closes, self.enabled_strategies())
+            keys = list(labels)
+            return lambda i: {key: labels[key][i] for key in keys}
+        
+        close_list = closes.tolist()
+        # 与实盘相同的指标窗口（含当前K线共 SIGNAL_WINDOW 根）
+        return lambda i: self.calculate_strategy_signals(
+            symbol, close_list[max(0, i - SIGNAL_WINDOW + 1):i + 1], close_list[i]
+        )
+
     def simulate_strategy(self, symbol, data):
-        """模拟策略执行"""
+        """模拟策略执行（逐根重算指标）"""
         if data.empty:
             return {'win_rate': 0, 'total_return': 0, 'trades': 0}
-        
-        positions = 0
-        entry_price = 0
-        trades = []
-        balance = 10000  # 初始资金
-        
-        for i in range(len(data)):
-            row = data.iloc[i]
-            current_price = row['close']
-            
-            # 模拟信号（用真实calculate_strategy_signals）
-            historical = data['close'].iloc[max(0, i-100):i+1].tolist()  # 最近100点
-            if len(historical) < 60:
-                continue  # 跳过数据不足，避免警告
-            
-            signals = self.calculate_strategy_signals(symbol, historical, current_price)
-            
-            #  修复：模拟 position_info 字典
-            simulated_position = {
-                'size': positions,
-                'entry_price': entry_price if positions != 0 else 0,
-                'unrealized_pnl': 0,  # 模拟0
-            }
-            position_info = self.get_position_info(symbol, current_price)  # 基值
-            position_info.update(simulated_position)  # 覆盖模拟大小
-            position_info['status'] = '持有多头' if positions > 0 else '持有空头' if positions < 0 else '无持仓'  # 手动设置 'status'
-            position_info['is_long'] = positions > 0
-            position_info['is_short'] = positions < 0
-            position_info['pnl_percent'] = ((current_price - entry_price) / entry_price * 100) if entry_price > 0 and positions != 0 else 0
+        return self.backtest_stream(symbol, [frame_to_records(data, self.kline_interval_var.get())], vectorized=False)
+
+    def simulate_strategy_vectorized(self, symbol, data):
+        """向量化模拟：整段序列一次算出指标与信号，仅持仓状态机逐根执行"""
+        if data.empty:
+            return {'win_rate': 0, 'total_return': 0, 'trades': 0}
+        return self.backtest_stream(symbol, [frame_to_records(data, self.kline_interval_var.get())], vectorized=True)
+
+    def enabled_strategies(self):
+        """当前启用的策略"""
+        enabled = []
+        if self.ma_strategy_var.get():
+            enabled.append('ma')
+        if self.rsi_strategy_var.get():
+            enabled.append('rsi')
+        if self.macd_strategy_var.get():
+            enabled.append('macd')
+        if self.bollinger_strategy_var.get():
+            enabled.append('bollinger')
+        return tuple(enabled)
+
+    def simulated_position_info(self, symbol, current_price, positions, entry_price):
+        """构造回测中的模拟持仓信息"""
+        #  修复：模拟 position_info 字典
+        simulated_position = {
+            'size': positions,
+            'entry_price': entry_price if positions != 0 else 0,
+            'unrealized_pnl': 0,  # 模拟0
+        }
+        position_info = self.get_position_info(symbol, current_price)  # 基值
+        position_info.update(simulated_position)  # 覆盖模拟大小
+        position_info['status'] = '持有多头' if positions > 0 else '持有空头' if positions < 0 else '无持仓'  # 手动设置 'status'
+        position_info['is_long'] = positions > 0
+        position_info['is_short'] = positions < 0
+        position_info['pnl_percent'] = ((current_price - entry_price) / entry_price * 100) if entry_price > 0 and positions != 0 else 0
+        return position_info
+
+    def replay_backtest(self, symbol, closes, times, signal_at, min_bars=60,
+                        take_profit_pct=None, stop_loss_pct=None, ledger=None, start=0):
+        """按K线顺序执行持仓状态机（路径相关，必须逐根执行）
+
+        传入 ledger 时在其上继续执行并返回 ledger（分批回测），否则返回绩效汇总。
+        """
+        own_ledger = ledger is None
+        ledger = ledger or BacktestLedger()
+        
+        for i in range(max(min_bars - 1, start), len(closes)):  # 跳过数据不足，避免警告
+            current_price = closes[i]
+            if ledger.check_exit(current_price, times[i], take_profit_pct, stop_loss_pct):
+                continue
+            signals = signal_at(i)
+            position_info = self.simulated_position_info(symbol, current_price, ledger.positions, ledger.entry_price)
             
             final_signal = self.determine_final_signal_with_position(signals, position_info, symbol)[0]
-            
-            # 模拟执行（简化，无杠杆/费用）
-            if final_signal == "买入" and positions == 0:
-                positions = balance / current_price * 0.1  # 10%仓位
-                entry_price = current_price
-                trades.append({'type': 'buy', 'price': current_price, 'time': row['open_time']})
-            elif final_signal == "卖出" and positions > 0:
-                pnl = (current_price - entry_price) / entry_price
-                balance += positions * current_price * pnl
-                trades.append({'type': 'sell', 'price': current_price, 'pnl': pnl, 'time': row['open_time']})
-                positions = 0
-            
-        # 计算绩效
-        wins = len([t for t in trades if t.get('pnl', 0) > 0])
-        win_rate = wins / len(trades) if trades else 0
-        total_return = (balance - 10000) / 10000
-        
-        return {'win_rate': win_rate, 'total_return': total_return, 'trades': len(trades), 'balance': balance}
+            ledger.step(current_price, times[i], final_signal)
+        
+        return ledger.summary() if own_ledger else ledger
+
+    def decision_table(self, symbol, label_tuples):
+        """对每种策略信号组合分别求空仓/持多时的最终信号
+
+        无界面回测中未连接交易所，最终信号只取决于信号组合与是否持仓，
+        因此同一组参数下可查表代替逐根调用决策函数。
+        """
+        keys = ('ma', 'rsi_signal', 'macd_signal', 'bollinger')
+        flat_info = self.simulated_position_info(symbol, 1.0, 0, 0)
+        long_info = self.simulated_position_info(symbol, 1.0, 1.0, 1.0)
+        flat, long = [], []
+        for labels in label_tuples:
+            signals = dict(zip(keys, labels))
+            flat.append(self.determine_final_signal_with_position(signals, dict(flat_info), symbol)[0])
+            long.append(self.determine_final_signal_with_position(signals, dict(long_info), symbol)[0])
+        return np.array(flat, dtype=object), np.array(long, dtype=object)
+
+    def apply_sweep_config(self, config):
+        """把一组扫描参数写入（无界面）实例"""
+        self.strategy_weights_config = dict(config['weights'])
+        self.signal_threshold.set(str(config['signal_threshold']))
+        self.execution_mode_var.set(config['execution_mode'])
+
+    def sweep_token(self, symbol, records, periods, configs, min_bars=60):
+        """同一币种、同一组指标周期下批量评估多组参数，指标与信号只计算一次"""
+        closes = np.asarray(records['close'], dtype=float)
+        times = np.asarray(records['open_time']).tolist()
+        series = backtest_indicator_series(closes, **periods)
+        labels = indicator_signal_labels(series, closes, self.enabled_strategies())
+        keys = ('ma', 'rsi_signal', 'macd_signal', 'bollinger')
+        
+        # 把每根K线的信号组合编码为整数，便于按表查找最终信号
+        codes = {}
+        bar_codes = np.fromiter(
+            (codes.setdefault(combo, len(codes)) for combo in zip(*(labels[key] for key in keys))),
+            dtype=np.int64, count=len(closes)
+        )
+        label_tuples = list(codes)
+        price_list = closes.tolist()
+        
+        results = []
+        for config in configs:
+            self.apply_sweep_config(config)
+            flat, long = self.decision_table(symbol, label_tuples)
+            flat_signals, long_signals = flat[bar_codes].tolist(), long[bar_codes].tolist()
+            take_profit, stop_loss = config.get('take_profit_pct'), config.get('stop_loss_pct')
+            
+            ledger = BacktestLedger()
+            for i in range(min_bars - 1, len(price_list)):
+                price = price_list[i]
+                if ledger.check_exit(price, times[i], take_profit, stop_loss):
+                    continue
+                ledger.step(price, times[i], long_signals[i] if ledger.positions > 0 else flat_signals[i])
+            results.append(ledger.summary(include_trades=False))
+        return results
 
 
     
+    def show_metrics_panel(self):
+        """打开延迟统计窗口（各阶段与外部调用的 p50/p95/p99），每2秒刷新"""
+        window = getattr(self, 'metrics_window', None)
+        if window is not None and window.winfo_exists():
+            window.lift()
+            return
+
+        window = tk.Toplevel(self.root)
+        window.title("性能统计 (毫秒)")
+        self.metrics_window = window
+
+        columns = ('名称', '调用', '错误', 'p50', 'p95', 'p99', '最大', '最近')
+        tree = ttk.Treeview(window, columns=columns, show="headings", height=20)
+        for col in columns:
+            tree.heading(col, text=col)
+            tree.column(col, width=160 if col == '名称' else 70, anchor=tk.W if col == '名称' else tk.E)
+        tree.pack(fill=tk.BOTH, expand=True)
+
+        def refresh():
+            if not window.winfo_exists():
+                return
+            rows = [(name, stat['count'], stat['errors'], f"{stat['p50']:.1f}", f"{stat['p95']:.1f}",
+                     f"{stat['p99']:.1f}", f"{stat['max']:.1f}", f"{stat['last']:.1f}")
+                    for name, stat in self.metrics.snapshot().items()]
+            self.render_tree(tree, rows)
+            window.after(2000, refresh)
+
+        refresh()
+
     def display_backtest_results(self, results):
         """显示回测结果（日志或新窗口）"""
         self.log_message("回测报告:", "info")
@@ -2953,9 +5996,9 @@ class HyperliquidTradingBot:
         tree.pack(fill=tk.BOTH, expand=True)
 
 
-    def determine_final_signal_with_position(self, signals, position_info, symbol):
-        """根据执行模式和仓位状态确定最终交易信号"""
-        execution_mode = self.execution_mode_var.get()
+    def determine_final_signal_with_position(self, signals, position_info, symbol, settings=None):
+        """根据执行模式和仓位状态确定最终交易信号（settings 为 signal_settings() 快照，工作线程中必须传入）"""
+        execution_mode = settings['execution_mode'] if settings else self.execution_mode_var.get()
         has_position = position_info['status'] != '无持仓'
         
         active_signals = []
@@ -2976,7 +6019,7 @@ class HyperliquidTradingBot:
     
         if execution_mode == "weighted":
             result = self.weighted_decision(
-                strategy_details, signal_strength, has_position, position_info, symbol
+                strategy_details, signal_strength, has_position, position_info, symbol, settings
             )
             if result is not None:
                 final_signal, operation_advice = result
@@ -3042,10 +6085,10 @@ class HyperliquidTradingBot:
                 'hold_score': 1
             }
 
-    def weighted_decision(self, strategy_details, signal_strength, has_position, position_info, symbol):
+    def weighted_decision(self, strategy_details, signal_strength, has_position, position_info, symbol, settings=None):
         """权重决策模式"""
         try:
-            threshold = float(self.signal_threshold.get())
+            threshold = float(settings['signal_threshold'] if settings else self.signal_threshold.get())
         except:
             threshold = 0.5
     
@@ -3064,7 +6107,7 @@ class HyperliquidTradingBot:
                 elif sell_strength > 0.4 and buy_strength < 0.3:
                     return "持有", "考虑减仓"
                 elif buy_strength > threshold:
-                    if self.check_single_coin_position_limit(symbol, "买入", position_info):
+                    if self.check_single_coin_position_limit(symbol, "买入", position_info, settings):
                         return "持有", "多头仓位已达上限，保持持仓"
                     else:
                         return "买入", "考虑加仓"
@@ -3077,7 +6120,7 @@ class HyperliquidTradingBot:
                 elif buy_strength > 0.4 and sell_strength < 0.3:
                     return "持有", "考虑减空仓"
                 elif sell_strength > threshold:
-                    if self.check_single_coin_position_limit(symbol, "卖出", position_info):
+                    if self.check_single_coin_position_limit(symbol, "卖出", position_info, settings):
                         return "持有", "空头仓位已达上限，保持持仓"
                     else:
                         return "卖出", "考虑加空仓"
@@ -3158,7 +6201,7 @@ class HyperliquidTradingBot:
 
         display_price = f"${price_data['price']:.4f}"
 
-        self.signal_tree.insert("", "end", values=(
+        self.signal_rows.append((
             token,
             display_price,
             f"{position_colors.get(position_info['status'], '')}{position_info['status']}",
@@ -3170,6 +6213,14 @@ class HyperliquidTradingBot:
             f"{signal_colors.get(final_signal, '')}{final_signal}",
             operation_advice
         ))
+        if self.root is not None:
+            self.ui_queue.post(self.render_tree, self.signal_tree, list(self.signal_rows), key='signal_table')
+
+    def clear_signal_display(self):
+        """清空信号表（下一次刷新时生效）"""
+        self.signal_rows = []
+        if self.root is not None:
+            self.ui_queue.post(self.render_tree, self.signal_tree, [], key='signal_table')
 
     def check_take_profit_stop_loss(self, position_info):
         """检查单个仓位止盈止损 - 保持原样"""
@@ -3183,20 +6234,151 @@ class HyperliquidTradingBot:
             return '止损'
         return None
 
+    def build_market_snapshot(self, tokens, periods=SIGNAL_WINDOW):
+        """每轮循环开始时经行情引擎并发获取账户状态、全部中间价和各币种K线"""
+        interval = self.kline_interval_var.get()
+
+        # 监控币种 + 当前持仓币种
+        symbols = list(tokens)
+        for coin in self.current_positions:
+            if coin not in symbols:
+                symbols.append(coin)
+        self.price_table.set_tokens(symbols)
+
+        # 未连接时 all_mids 不可用，直接并发拉取币安24hr行情
+        ticker_symbols = [] if self.connection_status else [s for s in symbols if not self.price_table.get(s)]
+        data = self.market_data.load_market_data(
+            self.kline_store, symbols, interval, periods,
+            ticker_symbols=ticker_symbols,
+            fetch_mids=self.fetch_all_mids if self.connection_status else None,
+            fetch_user_state=self.get_user_state if self.connection_status else None
+        )
+
+        user_state = data['user_state']
+        if isinstance(user_state, Exception):
+            self.log_message(f" 快照获取账户状态失败: {str(user_state)}", "warning")
+            user_state = None
+
+        closes = {}
+        for symbol, series in data['closes'].items():
+            if isinstance(series, Exception):
+                self.log_message(f"获取历史价格失败 {symbol}: {str(series)}", "error")
+                series = []
+            closes[symbol] = series
+
+        # 账户中新增的持仓（上一轮未知），在写入中间价前登记
+        extra_symbols = []
+        for position in (user_state or {}).get('assetPositions', []):
+            coin = position.get('position', {}).get('coin', '').replace('-PERP', '')
+            if coin and coin not in closes and coin not in extra_symbols:
+                extra_symbols.append(coin)
+        self.price_table.set_tokens(extra_symbols)
+        symbols.extend(extra_symbols)
+
+        all_mids = data['all_mids']
+        if isinstance(all_mids, Exception):
+            self.log_message(f" Hyperliquid中间价获取失败: {str(all_mids)}", "warning")
+        elif all_mids:
+            self.price_table.update_mids(all_mids)
+
+        for symbol, ticker in data['tickers'].items():
+            if ticker and not isinstance(ticker, Exception):
+                self.price_table.put(binance_ticker_to_price(symbol, ticker))
+
+        # 第二阶段：补齐新增持仓的K线，以及中间价缺失币种的24hr行情
+        missing = [s for s in symbols if s not in data['tickers'] and not self.price_table.get(s)]
+        if extra_symbols or missing:
+            extra = self.market_data.load_market_data(
+                self.kline_store, extra_symbols, interval, periods, ticker_symbols=missing
+            )
+            for symbol, series in extra['closes'].items():
+                closes[symbol] = [] if isinstance(series, Exception) else series
+            for symbol, ticker in extra['tickers'].items():
+                if ticker and not isinstance(ticker, Exception):
+                    self.price_table.put(binance_ticker_to_price(symbol, ticker))
+
+        prices = {}
+        now = time.time()
+        for symbol in symbols:
+            price_data = self.get_stable_real_time_price(symbol)
+            if price_data:
+                prices[symbol] = price_data
+
+        self.log_message(f" 市场快照: {len(prices)}个价格 | {len(closes)}组K线 ({interval})", "debug")
+        return MarketSnapshot(interval, periods, prices, closes, user_state, now)
+
+    def fetch_all_mids(self):
+        """请求 Hyperliquid 全部中间价（计时）"""
+        with self.metrics.timer('all_mids'):
+            return self.info.all_mids()
+
+    def refresh_price_table(self, symbols=None):
+        """一次请求 all_mids 刷新价格表中所有币种，返回是否成功"""
+        if symbols:
+            self.price_table.set_tokens(symbols)
+        if not self.connection_status:
+            return False
+        try:
+            all_mids = self.fetch_all_mids() or {}
+            self.price_table.update_mids(all_mids)
+            return True
+        except Exception as e:
+            self.log_message(f" Hyperliquid中间价获取失败: {str(e)}", "warning")
+            return False
+
     def get_stable_real_time_price(self, symbol):
         """获取稳定的实时价格"""
-        if symbol in self.price_cache:
-            cached_data = self.price_cache[symbol]
-            if time.time() - cached_data['timestamp'] < 20:
-                return cached_data
+        snapshot = self.market_snapshot
+        if snapshot is not None:
+            price_data = snapshot.get_price(symbol)
+            if price_data:
+                return price_data
+
+        price_data = self.price_table.get(symbol)
+        if price_data:
+            return price_data
         
         price_data = self.get_real_time_price(symbol)
         if price_data:
-            self.price_cache[symbol] = price_data
+            self.price_table.put(price_data)
+        return price_data
+
+    def get_execution_price(self, symbol, max_age=3):
+        """下单/计算仓位用的最新价格：不使用本轮快照，价格表超过 max_age 秒时重新拉取中间价"""
+        price_data = self.price_table.get(symbol, max_age=max_age)
+        if price_data:
+            return price_data
+        if self.refresh_price_table([symbol]):
+            price_data = self.price_table.get(symbol, max_age=max_age)
+            if price_data:
+                return price_data
+        price_data = self.get_real_time_price(symbol)
+        if price_data:
+            self.price_table.put(price_data)
         return price_data
 
-    def calculate_strategy_signals(self, symbol, historical_prices, current_price):
-        """计算各种策略信号"""
+    def get_indicator_state(self, symbol, interval=None):
+        """返回与K线缓存同步后的增量指标状态，数据不足时返回None"""
+        try:
+            interval = interval or self.kline_interval_var.get()
+            rows = self.kline_store.get_rows(symbol.upper(), interval)
+            if len(rows) < 2:
+                return None
+            key = (symbol.upper(), interval)
+            state = self.indicator_states.get(key)
+            if state is None:
+                state = self.indicator_states[key] = IndicatorState(interval)
+            state.sync(rows)
+            return state if state.ready() else None
+        except Exception as e:
+            self.log_message(f" 增量指标同步失败 {symbol}: {str(e)}", "warning")
+            return None
+
+    def calculate_strategy_signals(self, symbol, historical_prices, current_price, state=None, enabled=None):
+        """计算各种策略信号（传入 state 时使用增量指标，否则按窗口批量计算）
+
+        enabled 为 enabled_strategies() 的结果，工作线程中必须传入
+        """
         #  新增：检查历史数据是否充足
         if not historical_prices or len(historical_prices) < 60:
             self.log_message(f" {symbol}: 历史数据不足，无法计算策略信号", "warning")
@@ -3209,23 +6391,28 @@ class HyperliquidTradingBot:
                 'bollinger': "数据不足"
             }
 
+        # 增量状态已按 open_time 与K线缓存同步（断档/修正时重建），实时K线取状态记录的收盘价
+        if state is not None:
+            return self.strategy_signals_from_state(state, state.live_close, current_price, enabled)
+
+        enabled = self.enabled_strategies() if enabled is None else enabled
         signals = {}
         
         prices = np.array(historical_prices)
         
-        if self.ma_strategy_var.get():
+        if 'ma' in enabled:
             signals['ma'] = self.ma_strategy_enhanced(prices, current_price)
         else:
             signals['ma'] = "未启用"
         
-        if self.rsi_strategy_var.get():
+        if 'rsi' in enabled:
             signals['rsi'] = self.calculate_rsi(prices)
             signals['rsi_signal'] = self.rsi_strategy_enhanced(signals['rsi'])
         else:
             signals['rsi'] = 0
             signals['rsi_signal'] = "未启用"
         
-        if self.macd_strategy_var.get():
+        if 'macd' in enabled:
             macd, signal_line = self.calculate_macd(prices)
             signals['macd'] = macd
             signals['macd_signal'] = self.macd_strategy_enhanced(macd, signal_line)
@@ -3233,7 +6420,7 @@ class HyperliquidTradingBot:
             signals['macd'] = 0
             signals['macd_signal'] = "未启用"
         
-        if self.bollinger_strategy_var.get():
+        if 'bollinger' in enabled:
             bb_upper, bb_lower, bb_middle = self.calculate_bollinger_bands_enhanced(prices)
             signals['bollinger'] = self.bollinger_strategy_enhanced(current_price, bb_upper, bb_lower, bb_middle)
         else:
@@ -3241,13 +6428,49 @@ class HyperliquidTradingBot:
         
         return signals
 
+    def strategy_signals_from_state(self, state, live_close, current_price, enabled=None):
+        """用增量指标状态计算策略信号，O(1)"""
+        enabled = self.enabled_strategies() if enabled is None else enabled
+        values = state.peek(live_close)
+        signals = {}
+
+        if 'ma' in enabled:
+            signals['ma'] = self.ma_signal(values['ma_short'], values['ma_long'], current_price)
+        else:
+            signals['ma'] = "未启用"
+
+        if 'rsi' in enabled:
+            signals['rsi'] = values['rsi']
+            signals['rsi_signal'] = self.rsi_strategy_enhanced(signals['rsi'])
+        else:
+            signals['rsi'] = 0
+            signals['rsi_signal'] = "未启用"
+
+        if 'macd' in enabled:
+            signals['macd'] = values['macd']
+            signals['macd_signal'] = self.macd_strategy_enhanced(values['macd'], values['macd_signal'])
+        else:
+            signals['macd'] = 0
+            signals['macd_signal'] = "未启用"
+
+        if 'bollinger' in enabled:
+            signals['bollinger'] = self.bollinger_strategy_enhanced(
+                current_price, values['bb_upper'], values['bb_lower'], values['bb_middle']
+            )
+        else:
+            signals['bollinger'] = "未启用"
+
+        return signals
+
     def ma_strategy_enhanced(self, prices, current_price):
         """均线策略"""
         if len(prices) < 20:
             return "数据不足"
         
-        ma_short = np.mean(prices[-10:])
-        ma_long = np.mean(prices[-20:])
+        return self.ma_signal(np.mean(prices[-10:]), np.mean(prices[-20:]), current_price)
+
+    def ma_signal(self, ma_short, ma_long, current_price):
+        """根据长短均线判断信号"""
         price_vs_short = (current_price - ma_short) / ma_short * 100
         
         if ma_short > ma_long and current_price > ma_short and price_vs_short > 1:
@@ -3295,19 +6518,7 @@ class HyperliquidTradingBot:
 
     def compute_ema_series(self, series, period):
         """计算EMA完整序列"""
-        series = np.array(series, dtype=float)
-        if len(series) < period:
-            return np.full_like(series, np.nan)
-    
-        ema = np.full_like(series, np.nan)
-        multiplier = 2 / (period + 1.0)
-    
-        ema[period-1] = np.mean(series[:period])
-    
-        for i in range(period, len(series)):
-            ema[i] = (series[i] * multiplier) + (ema[i-1] * (1 - multiplier))
-    
-        return ema
+        return ema_kernel(series, period)
 
     def calculate_macd(self, prices, fast=12, slow=26, signal=9):
         """计算MACD"""
@@ -3318,15 +6529,7 @@ class HyperliquidTradingBot:
         if np.any(~np.isfinite(prices)):
             return np.nan, np.nan
     
-        ema_fast = self.compute_ema_series(prices, fast)
-        ema_slow = self.compute_ema_series(prices, slow)
-    
-        valid_mask = ~np.isnan(ema_fast) & ~np.isnan(ema_slow)
-        if not np.any(valid_mask):
-            return np.nan, np.nan
-    
-        macd_series = ema_fast - ema_slow
-        signal_series = self.compute_ema_series(macd_series[~np.isnan(macd_series)], signal)
+        macd_series, signal_series = macd_kernel(prices, fast, slow, signal)
     
         if len(signal_series) > 0 and not np.isnan(signal_series[-1]):
             return macd_series[-1], signal_series[-1]
@@ -3420,32 +6623,21 @@ class HyperliquidTradingBot:
             return self.get_fallback_price(symbol)  # 直接使用get_fallback_price
         
         try:
-            all_mids = self.info.all_mids()
             coin = f"{symbol.upper()}"
+
+            # 一次 all_mids 同时刷新价格表中的所有币种
+            self.price_table.set_tokens([symbol])
+            if not self.refresh_price_table():
+                raise ValueError("all_mids 请求失败")
+
+            price_data = self.price_table.get(symbol, max_age=1)
+            if price_data and price_data['source'] == PriceTable.MID_SOURCE:
+                return price_data
             
-            if coin in all_mids:
-                mark_price = float(all_mids[coin])
-                return {
-                    'symbol': symbol,
-                    'price': mark_price,
-                    'timestamp': time.time(),
-                    'source': 'Hyperliquid Mark Price'
-                }
-            
-            meta = self.info.meta()
-            if 'universe' in meta:
-                for asset in meta['universe']:
-                    if asset.get('name') == coin:
-                        mark_price = float(asset.get('markPx', 0))
-                        if mark_price > 0:
-                            return {
-                                'symbol': symbol,
-                                'price': mark_price,
-                                'timestamp': time.time(),
-                                'source': 'Hyperliquid Universe'
-                            }
-            
-            self.log_message(f"Hyperliquid价格查询失败 {symbol}，使用fallback", "warning")
+            if len(self.asset_meta) and coin not in self.asset_meta:
+                self.log_message(f"{symbol} 不在Hyperliquid资产列表中，使用fallback", "debug")
+            else:
+                self.log_message(f"Hyperliquid价格查询失败 {symbol}，使用fallback", "warning")
             return self.get_fallback_price(symbol)  # 直接使用get_fallback_price
             
         except Exception as e:
@@ -3455,25 +6647,14 @@ class HyperliquidTradingBot:
     def get_fallback_price(self, symbol):
         """Fallback价格获取 - 完全使用币安API"""
         try:
-            time.sleep(0.5)
-            
             # 使用币安API获取实时价格
             binance_symbol = f"{symbol.upper()}USDT"
-            url = f"https://api.binance.com/api/v3/ticker/24hr?symbol={binance_symbol}"
-            response = requests.get(url, timeout=10)
+            url = f"{BINANCE_API_URL}/ticker/24hr"
+            with self.metrics.timer('binance_ticker'):
+                response = self.http.get(url, params={'symbol': binance_symbol})
             
             if response.status_code == 200:
-                data = response.json()
-                return {
-                    'symbol': symbol,
-                    'price': float(data['lastPrice']),
-                    'change_24h': float(data['priceChangePercent']),
-                    'high_24h': float(data['highPrice']),
-                    'low_24h': float(data['lowPrice']),
-                    'volume': float(data['volume']),
-                    'timestamp': time.time(),
-                    'source': 'Binance'
-                }
+                return binance_ticker_to_price(symbol, response.json())
             else:
                 self.log_message(f" 币安API请求失败 {symbol}: HTTP {response.status_code}", "warning")
                 
@@ -3481,8 +6662,9 @@ class HyperliquidTradingBot:
             self.log_message(f"获取实时价格失败 {symbol}: {str(e)}", "error")
         
         # 最终fallback：使用缓存或基础价格
-        if symbol in self.price_cache:
-            return self.price_cache[symbol]
+        price_data = self.price_table.get_last(symbol)
+        if price_data:
+            return price_data
         
         # 绝对fallback：基础价格
         base_prices = {
@@ -3498,45 +6680,52 @@ class HyperliquidTradingBot:
             'source': 'Base Price'
         }
         
-        self.price_cache[symbol] = price_data
+        self.price_table.put(price_data)
         return price_data
 
 
-    def get_historical_prices(self, symbol, periods=100):
-        """从币安API获取历史K线数据"""
+    def get_historical_prices(self, symbol, periods=100, interval=None):
+        """获取历史收盘价，交易循环中优先使用本轮快照"""
+        interval = interval or self.kline_interval_var.get()
+        snapshot = self.market_snapshot
+        if snapshot is not None and snapshot.interval == interval:
+            prices = snapshot.get_closes(symbol, periods)
+            if prices is not None:
+                return prices
+        return self.fetch_historical_prices(symbol, periods, interval)
+
+    def fetch_historical_prices(self, symbol, periods=100, interval=None):
+        """从K线缓存获取历史收盘价（缓存按周期增量向币安拉取）"""
         try:
             # 币安API限制，最大1000根K线
             limit = min(periods, 1000)
-            binance_symbol = f"{symbol.upper()}USDT"
-            url = "https://api.binance.com/api/v3/klines"
-    
+            interval = interval or self.kline_interval_var.get()
+            return self.kline_store.get_closes(symbol.upper(), interval, limit)
 
-            interval = self.kline_interval_var.get()       
-            params = {
-                'symbol': binance_symbol,
-                'interval': interval,
-                'limit': limit
-            }
-            
-            response = requests.get(url, params=params, timeout=10)
-            if response.status_code == 200:
-                kline_data = response.json()
-                # 提取收盘价（索引4）
-                prices = [float(kline[4]) for kline in kline_data]
-                self.log_message(f" {symbol}: 从币安获取{len(prices)}根K线数据", "debug")
-                return prices
-            else:
-                self.log_message(f" 币安API请求失败 {symbol}: HTTP {response.status_code}", "warning")
-                return []  # 直接返回空列表
-                
         except Exception as e:
             self.log_message(f"获取历史价格失败 {symbol}: {str(e)}", "error")
             return []  # 直接返回空列表
 
+    def request_binance_klines(self, symbol, interval, limit, start_time=None):
+        """经 BinanceRestSource 请求币安K线，返回 KLINE_DTYPE 数组，失败返回None"""
+        try:
+            with self.metrics.timer('binance_klines'):
+                kline_data = self.live_source.fetch(symbol, interval, limit, start_time)
+            if kline_data is not None:
+                self.log_message(f" {symbol}: 从币安获取{len(kline_data)}根K线数据 ({interval})", "debug")
+                return kline_data
+            else:
+                self.log_message(f" 币安API请求失败 {symbol}", "warning")
+                return None
+
+        except Exception as e:
+            self.log_message(f"获取历史价格失败 {symbol}: {str(e)}", "error")
+            return None
 
     def reload_coin_config(self):
         """重新加载币种配置"""
         self.coin_config = self.load_coin_config()
+        self.rebuild_symbol_configs()
         self.log_message("✅ 币种配置已重新加载", "info")
         #  添加：确认 BTC 配置
         trading_config = self.coin_config.get("trading_config", {})
@@ -3595,7 +6784,289 @@ class HyperliquidTradingBot:
             self.log_message(f" 判断波动率放大失败 {symbol}: {str(e)}", "error")
             return False
 
+def run_backtest_job(job):
+    """进程池任务：加载单个币种历史数据并回测，返回 (token, 结果, 错误信息)"""
+    token = job['token']
+    try:
+        bot = HyperliquidTradingBot.create_headless(job['settings'])
+        return token, bot.run_symbol_backtest(token, job['start_date'], job['end_date']), None
+    except Exception as e:
+        return token, None, str(e)
+
+
+def run_parallel_backtests(tokens, start_date, end_date, settings, workers=None):
+    """按币种把回测任务分发到进程池，按完成顺序逐个产出 (token, 结果, 错误信息)"""
+    jobs = [
+        {'token': token, 'start_date': start_date, 'end_date': end_date, 'settings': settings}
+        for token in tokens
+    ]
+    if not jobs:
+        return
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    # 各进程分摊币安请求权重额度
+    for job in jobs:
+        job['settings'] = dict(settings, weight_budget=settings.get('weight_budget', 6000) // workers)
+    # spawn：交易线程/事件循环线程运行时 fork 可能继承已加锁的锁
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(run_backtest_job, job) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+SWEEP_PERIOD_DEFAULTS = {'fast': 12, 'slow': 26, 'signal': 9, 'rsi_period': 14,
+                         'bb_period': 20, 'ma_short': 10, 'ma_long': 20}
+
+
+def expand_sweep_grid(grid):
+    """把扫描网格展开为 (指标周期组, 参数组列表)；权重可写预设名或 "1.5,1.2,1.0,0.8" """
+    weight_options = grid.get('weights') or ['平衡稳健型']
+    weights = []
+    for option in weight_options:
+        text = PRESET_WEIGHTS.get(option, option)
+        if text:
+            weights.append((option, parse_weight_text(text)))
+
+    configs = [
+        {
+            'weights_label': label,
+            'weights': weight,
+            'signal_threshold': threshold,
+            'execution_mode': mode,
+            'take_profit_pct': take_profit,
+            'stop_loss_pct': stop_loss
+        }
+        for (label, weight), threshold, mode, take_profit, stop_loss in itertools.product(
+            weights,
+            grid.get('signal_threshold') or [0.6],
+            grid.get('execution_mode') or ['weighted'],
+            grid.get('take_profit_pct') or [None],
+            grid.get('stop_loss_pct') or [None]
+        )
+    ]
+    period_sets = [dict(SWEEP_PERIOD_DEFAULTS, **periods) for periods in (grid.get('periods') or [{}])]
+    return period_sets, configs
+
+
+def run_sweep_job(job):
+    """进程池任务：单个币种 × 单组指标周期 × 一批参数组，返回结果行列表"""
+    token = job['token']
+    try:
+        bot = HyperliquidTradingBot.create_headless(job['settings'])
+        start_ts, end_ts = bot.date_range_ms(job['start_date'], job['end_date'])
+        # 参数扫描需对整段数据反复回放，这里拼接为一个类型化数组（不经 DataFrame）
+        batches = list(bot.candle_source.batches(token, bot.kline_interval_var.get(), start_ts, end_ts))
+        records = np.concatenate(batches) if batches else np.empty(0, dtype=KLINE_DTYPE)
+        if len(records) == 0:
+            return token, [], "历史数据不足"
+        results = bot.sweep_token(token, records, job['periods'], job['configs'])
+        return token, [dict(config_id=config_id, periods=job['period_id'], **result)
+                       for config_id, result in zip(job['config_ids'], results)], None
+    except Exception as e:
+        return token, [], str(e)
+
+
+def sync_history_once(tokens, start_date, end_date, settings):
+    """在主进程中一次性补齐各币种本地K线，返回让子进程只读本地库的 settings"""
+    if settings.get('data_source', 'local') != 'local':
+        return settings
+    bot = HyperliquidTradingBot.create_headless(settings)
+    interval = bot.kline_interval_var.get()
+    start_ts, end_ts = bot.date_range_ms(start_date, end_date)
+    for token in tokens:
+        bot.history_store.migrate_csv(token, interval)
+    bot.history_downloader.sync_many([(token, interval, start_ts, end_ts) for token in tokens])
+    return dict(settings, sync_history=False)
+
+
+def run_parameter_sweep(tokens, start_date, end_date, settings, grid, workers=None, chunk_size=200):
+    """并行执行参数扫描，按平均回报排序返回汇总结果"""
+    period_sets, configs = expand_sweep_grid(grid)
+    # 同一币种会被多个任务读取：先在主进程补齐，子进程只读
+    settings = sync_history_once(tokens, start_date, end_date, settings)
+    jobs = []
+    for token in tokens:
+        for period_id, periods in enumerate(period_sets):
+            for start in range(0, len(configs), chunk_size):
+                jobs.append({
+                    'token': token, 'start_date': start_date, 'end_date': end_date, 'settings': settings,
+                    'periods': periods, 'period_id': period_id,
+                    'configs': configs[start:start + chunk_size],
+                    'config_ids': list(range(start, min(start + chunk_size, len(configs))))
+                })
+    if not jobs:
+        return []
+
+    rows = defaultdict(list)
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    for job in jobs:
+        job['settings'] = dict(settings, weight_budget=settings.get('weight_budget', 6000) // workers)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(run_sweep_job, job) for job in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            token, results, error = future.result()
+            if error:
+                print(f"{token}: 扫描出错 {error}")
+            for result in results:
+                rows[(result['periods'], result['config_id'])].append(dict(result, token=token))
+            print(f"扫描进度: {done}/{len(jobs)}")
+
+    ranked = []
+    for (period_id, config_id), results in rows.items():
+        config = configs[config_id]
+        returns = [r['total_return'] for r in results]
+        ranked.append({
+            'weights': config['weights_label'],
+            'signal_threshold': config['signal_threshold'],
+            'execution_mode': config['execution_mode'],
+            'take_profit_pct': config['take_profit_pct'],
+            'stop_loss_pct': config['stop_loss_pct'],
+            'periods': ",".join(f"{k}={v}" for k, v in period_sets[period_id].items()),
+            'tokens': len(results),
+            'avg_return': float(np.mean(returns)),
+            'worst_return': float(np.min(returns)),
+            'avg_win_rate': float(np.mean([r['win_rate'] for r in results])),
+            'total_trades': sum(r['trades'] for r in results)
+        })
+    ranked.sort(key=lambda row: (row['avg_return'], row['worst_return']), reverse=True)
+    for rank, row in enumerate(ranked, 1):
+        row['rank'] = rank
+    return ranked
+
+
+def write_sweep_results(ranked, path):
+    """写出排序后的扫描结果表"""
+    fields = ['rank', 'avg_return', 'worst_return', 'avg_win_rate', 'total_trades', 'tokens',
+              'weights', 'signal_threshold', 'execution_mode', 'take_profit_pct', 'stop_loss_pct', 'periods']
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(ranked)
+
+
+def run_sweep_cli(args):
+    """命令行参数扫描"""
+    with open(args.sweep, 'r', encoding='utf-8') as f:
+        grid = json.load(f)
+    settings = load_backtest_settings(args.config)
+    if args.interval:
+        settings['kline_interval'] = args.interval
+    settings['data_source'] = args.source
+    tokens = args.tokens or grid.get('tokens') or ""
+    if isinstance(tokens, str):
+        tokens = [t.strip().upper() for t in tokens.split(",") if t.strip()]
+
+    period_sets, configs = expand_sweep_grid(grid)
+    print(f"开始参数扫描: {tokens}, {len(configs)}组参数 × {len(period_sets)}组指标周期")
+    ranked = run_parameter_sweep(tokens, args.start, args.end, settings, grid, args.workers)
+    output = args.sweep_output or f"sweep_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    write_sweep_results(ranked, output)
+    for row in ranked[:10]:
+        print(f"#{row['rank']} 平均回报 {row['avg_return']:.2%} | 最差 {row['worst_return']:.2%} | "
+              f"{row['weights']} 阈值{row['signal_threshold']} {row['execution_mode']} "
+              f"止盈{row['take_profit_pct']} 止损{row['stop_loss_pct']}")
+    print(f"扫描结果已写入 {output}")
+
+
+def load_backtest_settings(config_file):
+    """从配置文件读取回测相关配置"""
+    if not os.path.exists(config_file):
+        return {}
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    return {key: config[key] for key in BACKTEST_SETTING_KEYS if key in config}
+
+
+def run_backtest_cli(args):
+    """命令行无界面回测"""
+    settings = load_backtest_settings(args.config)
+    if args.interval:
+        settings['kline_interval'] = args.interval
+    settings['vectorized'] = not args.per_bar
+    settings['data_source'] = args.source
+    tokens = [t.strip().upper() for t in args.backtest.split(",") if t.strip()]
+
+    print(f"开始回测: {tokens}, 期间 {args.start} to {args.end}, 进程数 {args.workers or os.cpu_count()}")
+    results = {}
+    for token, result, error in run_parallel_backtests(tokens, args.start, args.end, settings, args.workers):
+        if error:
+            print(f"{token}: 回测出错 {error}")
+        elif result is None:
+            print(f"{token}: 历史数据不足")
+        else:
+            results[token] = result
+            print(f"{token}: 胜率 {result['win_rate']:.2%} | 总回报 {result['total_return']:.2%} | 交易数 {result['trades']}")
+    print(f"回测完成: {len(results)}/{len(tokens)} 个币种")
+
+
+def run_download_cli(args):
+    """命令行批量预下载历史K线（多币种并发，可中断续传）"""
+    settings = load_backtest_settings(args.config)
+    interval = args.interval or settings.get('kline_interval', '1d')
+    tokens = [t.strip().upper() for t in args.download.split(",") if t.strip()]
+    start_ts = int(pd.to_datetime(args.start).timestamp() * 1000)
+    end_ts = int(pd.to_datetime(args.end).timestamp() * 1000)
+
+    bot = HyperliquidTradingBot.create_headless(settings)
+    bot.history_downloader.max_workers = args.workers or 4
+    stats = bot.history_downloader.sync_many([(token, interval, start_ts, end_ts) for token in tokens])
+    for (token, _), stat in stats.items():
+        print(f"{token}: {stat['pages']}页 | 新增{stat['appended']}条 | 失败{stat['failed']}页 | 本地共{bot.history_store.count(token, interval)}条")
+
+
+def run_journal_query_cli(args):
+    """命令行查询结构化交易记录：按币种、时间范围、类型过滤，逐行输出 JSON"""
+    journal = TradeJournal(args.journal_dir)
+    symbols = None
+    if args.journal_query not in ('*', 'ALL'):
+        symbols = [t.strip().upper() for t in args.journal_query.split(",") if t.strip()]
+    start = datetime.fromisoformat(args.since).timestamp() if args.since else None
+    end = datetime.fromisoformat(args.until).timestamp() if args.until else None
+    kinds = [k.strip() for k in args.kind.split(",") if k.strip()] if args.kind else None
+
+    count = 0
+    for record in journal.query(symbols, start, end, kinds):
+        print(json.dumps(record, ensure_ascii=False))
+        count += 1
+    print(f"共{count}条记录", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Hyperliquid 多策略自动化交易程序")
+    parser.add_argument('--backtest', metavar='TOKENS', help="无界面回测，逗号分隔的币种，如 BTC,ETH")
+    parser.add_argument('--start', default="2025-01-01", help="回测开始日期")
+    parser.add_argument('--end', default="2025-10-30", help="回测结束日期")
+    parser.add_argument('--interval', help="K线周期（默认取配置文件）")
+    parser.add_argument('--workers', type=int, help="进程数（默认CPU核数）")
+    parser.add_argument('--per-bar', action='store_true', help="使用逐根重算的回测模式")
+    parser.add_argument('--config', default="trading_config.json", help="配置文件路径")
+    parser.add_argument('--source', default="local", help="历史数据源: local / binance / synthetic / replay:<文件>")
+    parser.add_argument('--download', metavar='TOKENS', help="预下载历史K线到本地K线库，逗号分隔的币种")
+    parser.add_argument('--sweep', metavar='GRID', help="参数扫描网格（JSON文件）")
+    parser.add_argument('--tokens', help="参数扫描的币种，逗号分隔（默认取网格文件）")
+    parser.add_argument('--sweep-output', help="扫描结果CSV路径")
+    parser.add_argument('--journal-query', metavar='TOKENS', help="查询交易记录，逗号分隔的币种，* 表示全部")
+    parser.add_argument('--since', help="交易记录查询开始时间，如 2025-10-01 或 2025-10-01T08:00")
+    parser.add_argument('--until', help="交易记录查询结束时间")
+    parser.add_argument('--kind', help="交易记录类型过滤，逗号分隔: signal,order,fill,order_end,risk")
+    parser.add_argument('--journal-dir', default="journal", help="交易记录目录")
+    return parser.parse_args(argv)
+
+
 def main():
+    args = parse_args()
+    if args.journal_query:
+        run_journal_query_cli(args)
+        return
+    if args.download:
+        run_download_cli(args)
+        return
+    if args.sweep:
+        run_sweep_cli(args)
+        return
+    if args.backtest:
+        run_backtest_cli(args)
+        return
+
     root = tk.Tk()
     app = HyperliquidTradingBot(root)
     root.mainloop()
@@ -0,0 +1,56 @@
+"""向量化回测与逐根重算回测的一致性"""
+
+import numpy as np
+import pytest
+
+import HyperliquidTradingBot as hl
+
+LABEL_KEYS = ('ma', 'rsi_signal', 'macd_signal', 'bollinger')
+
+
+@pytest.fixture(scope='module')
+def bot():
+    # 较低阈值保证样本区间内有成交，覆盖持仓状态机
+    bot = hl.HyperliquidTradingBot.create_headless(
+        {'data_source': 'synthetic', 'sync_history': False, 'signal_threshold': 0.3}
+    )
+    bot.log_message = lambda *args, **kwargs: None
+    return bot
+
+
+@pytest.fixture(scope='module')
+def records():
+    start = 1_600_000_000_000
+    step = hl.KLINE_INTERVAL_MS['1h']
+    batches = hl.SyntheticSource(seed=7, volatility=0.02).batches('BTC', '1h', start, start + 599 * step)
+    return np.concatenate(list(batches))
+
+
+def test_signal_labels_match_per_bar(bot, records):
+    closes = records['close'].astype(float)
+    vectorized = bot.backtest_signal_fn('BTC', closes, vectorized=True)
+    per_bar = bot.backtest_signal_fn('BTC', closes, vectorized=False)
+    mismatches = [i for i in range(59, len(closes))
+                  if [vectorized(i)[key] for key in LABEL_KEYS] != [per_bar(i)[key] for key in LABEL_KEYS]]
+    assert mismatches == []
+
+
+def test_indicator_series_match_batch_indicators(bot, records):
+    closes = records['close'].astype(float)
+    series = hl.backtest_indicator_series(closes)
+    for i in (hl.SIGNAL_WINDOW - 2, hl.SIGNAL_WINDOW - 1, 250, len(closes) - 1):
+        window = closes[max(0, i - hl.SIGNAL_WINDOW + 1):i + 1].tolist()
+        macd, signal_line = bot.calculate_macd(window)
+        assert series['macd'][i] == pytest.approx(macd, rel=1e-9, abs=1e-12)
+        assert series['macd_signal'][i] == pytest.approx(signal_line, rel=1e-9, abs=1e-12)
+
+
+@pytest.mark.parametrize('batch_size', [600, 137])
+def test_stream_results_match(bot, records, batch_size):
+    batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+    vectorized = bot.backtest_stream('BTC', batches, vectorized=True)
+    per_bar = bot.backtest_stream('BTC', [records], vectorized=False)
+    assert per_bar['trades'] > 0
+    assert vectorized['trades'] == per_bar['trades']
+    assert vectorized['balance'] == pytest.approx(per_bar['balance'])
+    assert vectorized['bars'] == per_bar['bars'] == len(records)
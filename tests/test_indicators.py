@@ -0,0 +1,31 @@
+"""向量化EMA内核与逐元素递推一致"""
+
+import numpy as np
+import pytest
+
+import HyperliquidTradingBot as hl
+
+
+def ema_loop(values, period):
+    """逐元素递推的参考实现：第 period-1 根为SMA"""
+    out = [np.nan] * len(values)
+    if len(values) < period:
+        return out
+    alpha = 2 / (period + 1.0)
+    out[period - 1] = sum(values[:period]) / period
+    for i in range(period, len(values)):
+        out[i] = alpha * values[i] + (1 - alpha) * out[i - 1]
+    return out
+
+
+@pytest.mark.parametrize('length, period, block', [(5, 12, 256), (12, 12, 256), (1000, 26, 256), (600, 9, 64)])
+def test_ema_kernel_matches_loop(length, period, block):
+    values = (100 * np.exp(np.cumsum(np.random.default_rng(length).normal(0, 0.01, length)))).tolist()
+    np.testing.assert_allclose(hl.ema_kernel(values, period, block=block), ema_loop(values, period), rtol=1e-10)
+
+
+def test_ema_kernel_matrix_rows_are_independent():
+    matrix = np.random.default_rng(1).normal(100, 1, (3, 80))
+    result = hl.ema_kernel(matrix, 12)
+    for row, values in zip(result, matrix):
+        np.testing.assert_allclose(row, ema_loop(values.tolist(), 12), rtol=1e-10)
@@ -0,0 +1,35 @@
+"""结构化交易记录的写入与查询"""
+
+import time
+
+import numpy as np
+import pytest
+
+import HyperliquidTradingBot as hl
+
+
+class TestTradeJournal:
+    def test_query_filters(self, tmp_path):
+        journal = hl.TradeJournal(str(tmp_path), flush_interval=0)
+        journal.record('order', 'btc', size=1.0)
+        journal.record('fill', 'BTC', size=np.float64(1.0))
+        journal.record('signal', 'eth', score=0.5)
+        assert [r['kind'] for r in journal.query(symbols=['btc'])] == ['order', 'fill']
+        assert [r['symbol'] for r in journal.query(kinds=['signal'])] == ['ETH']
+        assert list(journal.query(start=time.time() + 60)) == []
+        journal.close()
+
+    def test_reserved_fields_rejected(self, tmp_path):
+        journal = hl.TradeJournal(str(tmp_path))
+        with pytest.raises(ValueError):
+            journal.record('order', 'BTC', ts=0)
+        journal.close()
+
+    def test_index_survives_reopen(self, tmp_path):
+        journal = hl.TradeJournal(str(tmp_path), flush_interval=0)
+        journal.record('order', 'BTC')
+        journal.close()
+        reopened = hl.TradeJournal(str(tmp_path))
+        reopened.record('fill', 'BTC')
+        assert [r['kind'] for r in reopened.query()] == ['order', 'fill']
+        reopened.close()
@@ -0,0 +1,122 @@
+"""K线缓存增量计划、本地K线库与缺口区间计算"""
+
+import numpy as np
+import pytest
+
+import HyperliquidTradingBot as hl
+
+HOUR = hl.KLINE_INTERVAL_MS['1h']
+
+
+def make_records(open_times, close=1.0):
+    records = np.zeros(len(open_times), dtype=hl.KLINE_DTYPE)
+    records['open_time'] = open_times
+    records['close'] = close
+    records['close_time'] = np.asarray(open_times) + HOUR - 1
+    return records
+
+
+def hourly(start, count):
+    return [start + i * HOUR for i in range(count)]
+
+
+class TestKlineStorePlan:
+    def setup_method(self):
+        self.store = hl.KlineStore(fetcher=None, min_rows=100, live_ttl=5)
+        self.now = 1_700_000_000.0
+        now_ms = int(self.now * 1000)
+        self.current_open = now_ms - now_ms % HOUR
+
+    def merge(self, count, fetched_at, limit=None):
+        rows = make_records(hourly(self.current_open - (count - 1) * HOUR, count))
+        self.store.merge('BTC', '1h', rows, None, limit or count, now=fetched_at)
+
+    def test_empty_cache_fetches_full_window(self):
+        assert self.store.plan_refresh('BTC', '1h', 50, now=self.now) == (100, None)
+
+    def test_same_candle_within_ttl_needs_no_request(self):
+        self.merge(100, self.now)
+        assert self.store.plan_refresh('BTC', '1h', 100, now=self.now + 1) is None
+
+    def test_same_candle_after_ttl_refreshes_live_bar(self):
+        self.merge(100, self.now)
+        assert self.store.plan_refresh('BTC', '1h', 100, now=self.now + 6) == (1, self.current_open)
+
+    def test_candle_boundary_fetches_from_last_cached_bar(self):
+        self.merge(100, self.now)
+        later = self.now + 3 * 3600
+        assert self.store.plan_refresh('BTC', '1h', 100, now=later) == (4, self.current_open)
+
+    def test_long_gap_falls_back_to_full_fetch(self):
+        self.merge(100, self.now)
+        later = self.now + 2000 * 3600
+        assert self.store.plan_refresh('BTC', '1h', 100, now=later) == (100, None)
+
+    def test_short_cache_refetches_full_window(self):
+        self.merge(60, self.now)
+        assert self.store.plan_refresh('BTC', '1h', 100, now=self.now + 1) == (100, None)
+
+    def test_exhausted_history_is_not_refetched(self):
+        # 返回条数少于 limit 表示交易所历史不足，不再重复全量拉取
+        self.merge(60, self.now, limit=100)
+        assert self.store.plan_refresh('BTC', '1h', 100, now=self.now + 1) is None
+
+
+class TestKlineFileStore:
+    @pytest.fixture
+    def store(self, tmp_path):
+        return hl.KlineFileStore(str(tmp_path))
+
+    def test_append_in_order_stays_sorted(self, store):
+        store.append('btc', '1h', make_records(hourly(0, 5)))
+        store.append('btc', '1h', make_records(hourly(5 * HOUR, 5)))
+        records = store.load('BTC', '1h')
+        assert records['open_time'].tolist() == hourly(0, 10)
+        assert store._read_header(store.path('BTC', '1h'))
+
+    def test_out_of_order_append_is_compacted_on_load(self, store):
+        store.append('BTC', '1h', make_records(hourly(5 * HOUR, 5), close=1.0))
+        store.append('BTC', '1h', make_records(hourly(0, 7), close=2.0))
+        assert not store._read_header(store.path('BTC', '1h'))
+        records = store.load('BTC', '1h')
+        assert records['open_time'].tolist() == hourly(0, 10)
+        # 重叠部分以后写入的记录为准
+        assert records['close'][:7].tolist() == [2.0] * 7
+        assert records['close'][7:].tolist() == [1.0] * 3
+
+    def test_compact_deduplicates(self, store):
+        store.append('BTC', '1h', make_records(hourly(0, 3)))
+        store.append('BTC', '1h', make_records(hourly(0, 3)))
+        assert store.count('BTC', '1h') == 6
+        assert store.compact('BTC', '1h') == 3
+        assert store.count('BTC', '1h') == 3
+
+    def test_load_range(self, store):
+        store.append('BTC', '1h', make_records(hourly(0, 10)))
+        records = store.load_range('BTC', '1h', 2 * HOUR, 4 * HOUR)
+        assert records['open_time'].tolist() == hourly(2 * HOUR, 3)
+
+    def test_missing_ranges(self, store):
+        assert store.missing_ranges('BTC', '1h', 0, 9 * HOUR) == [(0, 9 * HOUR)]
+        times = [2 * HOUR, 3 * HOUR, 6 * HOUR]
+        store.append('BTC', '1h', make_records(times))
+        assert store.missing_ranges('BTC', '1h', 0, 9 * HOUR) == [
+            (0, HOUR), (4 * HOUR, 5 * HOUR), (7 * HOUR, 9 * HOUR)
+        ]
+
+    def test_missing_ranges_aligns_to_interval(self, store):
+        store.append('BTC', '1h', make_records(hourly(0, 10)))
+        assert store.missing_ranges('BTC', '1h', 1, 9 * HOUR + 5) == []
+
+
+def test_subtract_ranges():
+    assert hl.subtract_ranges([(0, 10)], []) == [(0, 10)]
+    assert hl.subtract_ranges([(0, 10)], [(3, 5)]) == [(0, 2), (6, 10)]
+    assert hl.subtract_ranges([(0, 10)], [(8, 20), (-5, 1)]) == [(2, 7)]
+    assert hl.subtract_ranges([(0, 10), (20, 30)], [(0, 30)]) == []
+
+
+def test_merge_ranges():
+    assert hl.merge_ranges([]) == []
+    assert hl.merge_ranges([(5, 8), (0, 2), (3, 4), (10, 12)]) == [[0, 8], [10, 12]]
+    assert hl.merge_ranges([(0, 10), (2, 3)]) == [[0, 10]]
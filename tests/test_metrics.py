@@ -0,0 +1,18 @@
+"""Prometheus 文本格式渲染"""
+
+import HyperliquidTradingBot as hl
+
+
+def test_prometheus_text():
+    text = hl.prometheus_text([
+        ('bot_latency_seconds', 'gauge', 'Latency', [({'name': 'a"b', 'q': 'p50'}, 0.25)]),
+        ('bot_up', 'gauge', 'Up', [({}, 1)]),
+    ])
+    assert text == (
+        '# HELP bot_latency_seconds Latency\n'
+        '# TYPE bot_latency_seconds gauge\n'
+        'bot_latency_seconds{name="a\\"b",q="p50"} 0.25\n'
+        '# HELP bot_up Up\n'
+        '# TYPE bot_up gauge\n'
+        'bot_up 1.0\n'
+    )
@@ -0,0 +1,162 @@
+"""订单状态机：有订单号挂单、cloid 确认、成交记录确认与 unknown 终态"""
+
+import pytest
+
+import HyperliquidTradingBot as hl
+
+
+class FakeExchange:
+    def __init__(self):
+        self.open_orders = []
+        self.by_oid = {}
+        self.by_cloid = {}
+        self.fills = []
+        self.fills_error = None
+        self.cancelled = []
+        self.calls = 0
+
+    def fetch_open_orders(self):
+        self.calls += 1
+        return list(self.open_orders)
+
+    def query_order(self, oid):
+        return self.by_oid.get(oid, {'status': 'unknownOid'})
+
+    def query_order_by_cloid(self, cloid):
+        return self.by_cloid.get(cloid, {'status': 'unknownOid'})
+
+    def fetch_fills(self, since_ms):
+        if self.fills_error:
+            raise self.fills_error
+        return [fill for fill in self.fills if fill['time'] >= since_ms]
+
+    def cancel_order(self, symbol, oid):
+        self.cancelled.append((symbol, oid))
+
+
+def order_status(status, oid, sz, orig_sz):
+    return {'status': 'order', 'order': {'order': {'oid': oid, 'sz': str(sz), 'origSz': str(orig_sz)},
+                                         'status': status}}
+
+
+@pytest.fixture
+def exchange():
+    return FakeExchange()
+
+
+@pytest.fixture
+def manager(exchange):
+    manager = hl.OrderManager(exchange.fetch_open_orders, exchange.query_order, exchange.query_order_by_cloid,
+                              exchange.fetch_fills, exchange.cancel_order, timeout=300, confirm_timeout=30,
+                              poll_interval=5)
+    manager.finished = []
+    manager.listeners.append(manager.finished.append)
+    return manager
+
+
+def test_resting_order_partial_then_filled(manager, exchange):
+    key = manager.track('BTC', 'buy', 2.0, 100.0, oid=7)
+    t0 = manager.orders[key]['timestamp']
+    exchange.open_orders = [{'oid': 7, 'sz': '1.5', 'origSz': '2.0'}]
+    manager.poll(now=t0 + 1, force=True)
+    assert manager.orders[key]['status'] == hl.ORDER_PARTIAL
+    assert manager.orders[key]['filled'] == pytest.approx(0.5)
+
+    exchange.open_orders = []
+    exchange.by_oid[7] = order_status('filled', 7, 0, 2.0)
+    manager.poll(now=t0 + 2, force=True)
+    assert [o['status'] for o in manager.finished] == [hl.ORDER_FILLED]
+    assert manager.finished[0]['filled'] == 2.0
+    assert not manager.orders
+
+
+def test_resting_order_times_out_and_is_cancelled(manager, exchange):
+    key = manager.track('ETH', 'sell', 1.0, 10.0, oid=3)
+    t0 = manager.orders[key]['timestamp']
+    exchange.open_orders = [{'oid': 3, 'sz': '1.0', 'origSz': '1.0'}]
+    manager.poll(now=t0 + 301, force=True)
+    assert exchange.cancelled == [('ETH', 3)]
+    assert manager.finished[0]['status'] == hl.ORDER_CANCELLED
+
+
+def test_unconfirmed_order_confirmed_by_cloid(manager, exchange):
+    cloid = hl.new_cloid()
+    key = manager.track('BTC', 'buy', 1.0, 100.0, cloid=cloid)
+    t0 = manager.orders[key]['timestamp']
+    manager.poll(now=t0 + 1, force=True)
+    assert manager.orders[key]['status'] == hl.ORDER_SUBMITTED
+
+    exchange.by_cloid[cloid] = order_status('filled', 11, 0, 1.0)
+    manager.poll(now=t0 + 2, force=True)
+    assert manager.finished[0]['status'] == hl.ORDER_FILLED
+    assert manager.finished[0]['oid'] == 11
+
+
+def test_cloid_order_still_resting_switches_to_oid_tracking(manager, exchange):
+    cloid = hl.new_cloid()
+    key = manager.track('BTC', 'buy', 1.0, 100.0, cloid=cloid)
+    t0 = manager.orders[key]['timestamp']
+    exchange.by_cloid[cloid] = order_status('open', 12, 1.0, 1.0)
+    manager.poll(now=t0 + 1, force=True)
+    assert manager.orders[key]['status'] == hl.ORDER_RESTING
+    assert manager.orders[key]['oid'] == 12
+
+
+def test_unconfirmed_order_confirmed_by_fills(manager, exchange):
+    key = manager.track('SOL', 'sell', 3.0, 20.0)
+    t0 = manager.orders[key]['timestamp']
+    exchange.fills.append({'coin': 'SOL', 'side': 'A', 'sz': '3.0', 'time': int(t0 * 1000) + 10})
+    manager.poll(now=t0 + 1, force=True)
+    assert manager.finished[0]['status'] == hl.ORDER_FILLED
+
+
+def test_no_fills_after_timeout_is_rejected(manager, exchange):
+    key = manager.track('SOL', 'buy', 1.0, 20.0, cloid=hl.new_cloid())
+    t0 = manager.orders[key]['timestamp']
+    manager.poll(now=t0 + 31, force=True)
+    assert manager.finished[0]['status'] == hl.ORDER_REJECTED
+
+
+def test_unattributable_fills_end_unknown(manager, exchange):
+    first = manager.track('SOL', 'buy', 1.0, 20.0)
+    manager.track('SOL', 'buy', 1.0, 20.0)
+    t0 = manager.orders[first]['timestamp']
+    # 两笔同方向订单都无订单号/cloid，成交无法归属
+    exchange.fills.append({'coin': 'SOL', 'side': 'B', 'sz': '1.0', 'time': int(t0 * 1000) + 10})
+    manager.poll(now=t0 + 31, force=True)
+    assert [o['status'] for o in manager.finished] == [hl.ORDER_UNKNOWN, hl.ORDER_UNKNOWN]
+
+
+def test_fills_unavailable_ends_unknown_not_rejected(manager, exchange):
+    key = manager.track('BTC', 'buy', 1.0, 100.0)
+    t0 = manager.orders[key]['timestamp']
+    exchange.fills_error = RuntimeError("timeout")
+    manager.poll(now=t0 + 31, force=True)
+    assert manager.finished[0]['status'] == hl.ORDER_UNKNOWN
+    assert hl.ORDER_UNKNOWN not in hl.ACTIVE_ORDER_STATES
+
+
+def test_poll_is_throttled_except_right_after_submit(manager, exchange):
+    key = manager.track('BTC', 'buy', 1.0, 100.0, oid=1)
+    t0 = manager.orders[key]['timestamp']
+    exchange.open_orders = [{'oid': 1, 'sz': '1', 'origSz': '1'}]
+    for dt in (0.5, 1.1, 2, 4, 5.9, 6.2):
+        manager.poll(now=t0 + dt)
+    assert exchange.calls == 2
+
+
+@pytest.mark.parametrize('response, expected', [
+    ({'status': 'unknownOid'}, (None, None)),
+    (order_status('filled', 1, 0, 1), hl.ORDER_FILLED),
+    (order_status('canceled', 1, 1, 1), hl.ORDER_CANCELLED),
+    (order_status('marginCanceled', 1, 1, 1), hl.ORDER_CANCELLED),
+    (order_status('rejected', 1, 1, 1), hl.ORDER_REJECTED),
+    (order_status('open', 1, 1, 1), None),
+])
+def test_parse_order_status(response, expected):
+    status, info = hl.parse_order_status(response)
+    if isinstance(expected, tuple):
+        assert (status, info) == expected
+    else:
+        assert status == expected
+        assert info['oid'] == 1
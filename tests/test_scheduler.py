@@ -0,0 +1,45 @@
+"""交易循环事件调度"""
+
+import pytest
+
+import HyperliquidTradingBot as hl
+
+
+class TestTradingScheduler:
+    def setup_method(self):
+        self.scheduler = hl.TradingScheduler(interval='1h', heartbeat=60, price_move_pct=0.5)
+        self.now = 1_700_000_100.0
+
+    def test_first_tick_runs_full_cycle(self):
+        assert set(self.scheduler.due(self.now)) == {'candle_close', 'heartbeat'}
+
+    def test_quiet_tick_after_cycle(self):
+        self.scheduler.mark_cycle({'BTC': 100.0}, now=self.now)
+        assert self.scheduler.due(self.now + 1) == []
+        assert self.scheduler.due(self.now + 61) == ['heartbeat']
+
+    def test_candle_close_fires_after_delay(self):
+        self.scheduler.mark_cycle({}, now=self.now)
+        close = self.scheduler.next_close
+        assert close % 3600 == pytest.approx(self.scheduler.close_delay)
+        assert 'candle_close' not in self.scheduler.due(close - 0.1)
+        assert 'candle_close' in self.scheduler.due(close)
+
+    def test_events_are_drained_once(self):
+        self.scheduler.mark_cycle({'BTC': 100.0}, now=self.now)
+        assert self.scheduler.observe_prices({'BTC': 100.2}) is None
+        assert self.scheduler.observe_prices({'BTC': 100.6}) == 'BTC'
+        self.scheduler.notify('fill')
+        self.scheduler.notify('fill')
+        assert self.scheduler.wake.is_set()
+        assert self.scheduler.due(self.now + 1) == ['price_move', 'fill']
+        assert self.scheduler.due(self.now + 2) == []
+
+    def test_stop_distance_notifies_on_entry_only(self):
+        self.scheduler.mark_cycle({}, now=self.now)
+        self.scheduler.observe_stop_distance('BTC', True)
+        self.scheduler.observe_stop_distance('BTC', True)
+        assert self.scheduler.due(self.now + 1) == ['stop_distance']
+        self.scheduler.observe_stop_distance('BTC', False)
+        self.scheduler.observe_stop_distance('BTC', True)
+        assert self.scheduler.due(self.now + 2) == ['stop_distance']
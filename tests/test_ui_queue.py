@@ -0,0 +1,65 @@
+"""后台线程只经 UiQueue 更新界面"""
+
+import HyperliquidTradingBot as hl
+
+
+class TkGuard:
+    """代替 Tk 根窗口：后台线程的任何调用都记录下来"""
+
+    def __init__(self):
+        self.touched = []
+
+    def __getattr__(self, name):
+        self.touched.append(name)
+        raise AssertionError(f"Tk root accessed off the main loop: {name}")
+
+
+class InlineThread:
+    """同步执行 target，便于断言后台线程的行为"""
+
+    def __init__(self, target, daemon=None, **kwargs):
+        self.target = target
+
+    def start(self):
+        self.target()
+
+
+def test_ui_queue_merges_keyed_updates():
+    queue = hl.UiQueue(maxsize=2)
+    seen = []
+    queue.post(seen.append, 'a')
+    queue.post(seen.append, 'table-1', key='table')
+    queue.post(seen.append, 'table-2', key='table')
+    queue.post(seen.append, 'b')
+    queue.post(seen.append, 'c')
+    assert queue.dropped == 1
+    assert queue.drain() == 3
+    assert seen == ['b', 'c', 'table-2']
+
+
+def test_run_backtest_collector_only_posts_to_queue(monkeypatch):
+    bot = hl.HyperliquidTradingBot.create_headless({'sync_history': False})
+    bot.root = TkGuard()
+    bot.ui_queue = hl.UiQueue()
+    bot.log_buffer = hl.LogRingBuffer()
+    bot.tokens_entry = hl.StaticVar('BTC, ETH, SOL')
+    bot.backtest_settings = lambda: {}
+    bot.refresh_log_console = lambda: None
+    displayed = []
+    bot.display_backtest_results = displayed.append
+
+    def fake_backtests(tokens, start_date, end_date, settings, workers=None):
+        yield 'ETH', {'win_rate': 0.5, 'total_return': 0.1, 'trades': 4}, None
+        yield 'SOL', None, 'boom'
+        yield 'BTC', {'win_rate': 0.6, 'total_return': 0.2, 'trades': 5}, None
+
+    monkeypatch.setattr(hl, 'run_parallel_backtests', fake_backtests)
+    monkeypatch.setattr(hl.threading, 'Thread', InlineThread)
+    bot.run_backtest()
+
+    assert bot.root.touched == []
+    assert displayed == []
+    bot.ui_queue.drain()
+    assert len(displayed) == 1
+    assert list(displayed[0]) == ['BTC', 'ETH']
+    assert any('回测完成' in record.message for record in bot.log_buffer.window(0, 0, 100))